@@ -0,0 +1,306 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# Benchmark of the server and clients on localhost, each workload runs on a new server with new clients and
+# directories. The first client writes the workload, and we measure how long each change takes to reach all the
+# other clients. Results are printed as JSON
+#   python benchmark.py [workload ...] [--clients N] [--output results.json]
+# Options of the server and the clients (SYNC_WORKERS, SYNC_COMPRESSION...) are taken from the environment as usual
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+CLIENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client.py')
+# Seconds between the checks of the client directories
+POLL_INTERVAL = 0.005
+# Seconds we wait for the server to listen
+START_TIMEOUT = 10
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+# Peak resident memory of process in KiB, None where /proc is missing
+def peak_rss(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))], 4)
+
+
+def content_hash(data):
+    return hashlib.sha256(data).digest()
+
+
+# Server and clients of one identifier over temporary directories, clients[0] is the writer
+class Setup:
+    def __init__(self, clients_count, time_series):
+        self.directory = tempfile.mkdtemp(prefix='sync-benchmark-')
+        self.time_series = time_series
+        self.port = free_port()
+        server_directory = os.path.join(self.directory, 'server')
+        os.makedirs(server_directory)
+        self.server = subprocess.Popen([sys.executable, SERVER_PATH, str(self.port)], cwd=server_directory,
+                                       stdout=subprocess.PIPE, text=True)
+        self.wait_listening()
+        self.paths = [os.path.join(self.directory, f'client{index}') for index in range(clients_count)]
+        os.makedirs(self.paths[0])
+        self.clients = [self.start_client(self.paths[0])]
+        self.identifier = self.server.stdout.readline().strip()
+        for path in self.paths[1:]:
+            self.clients.append(self.start_client(path, self.identifier))
+
+    def wait_listening(self):
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                return
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def start_client(self, path, identifier=None):
+        args = [sys.executable, CLIENT_PATH, '127.0.0.1', str(self.port), path, str(self.time_series)]
+        # State files of the clients are removed with the run, and a run never finds the state of an earlier one
+        env = dict(os.environ, SYNC_STATE_DIRECTORY=os.path.join(self.directory, 'state'))
+        return subprocess.Popen(args + ([identifier] if identifier else []), env=env)
+
+    def writer_path(self, *names):
+        return os.path.join(self.paths[0], *names)
+
+    def readers(self):
+        return self.paths[1:]
+
+    def peak_rss(self):
+        return {'server': peak_rss(self.server.pid), 'clients': [peak_rss(client.pid) for client in self.clients]}
+
+    def close(self):
+        for process in self.clients + [self.server]:
+            process.terminate()
+        for process in self.clients + [self.server]:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.server.stdout.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# Expected state of the paths in the reader clients, and the time each of them got it
+class Expectations:
+    def __init__(self, setup):
+        self.setup = setup
+        # Content hash (None if the path must not exist) and the time it was written, by path relative to the clients
+        self.expected = {}
+        # (size, mtime) we already checked of each reader path, so the same file is not hashed twice
+        self.checked = {}
+
+    def write(self, relative_path, data):
+        path = self.setup.writer_path(relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.expected[relative_path] = (content_hash(data), time.perf_counter())
+
+    def moved(self, src_relative_path, dst_relative_path, data, moved_time):
+        self.expected[src_relative_path] = (None, moved_time)
+        self.expected[dst_relative_path] = (content_hash(data), moved_time)
+
+    def is_reached(self, reader_path, relative_path, expected_hash):
+        path = os.path.join(reader_path, relative_path)
+        if expected_hash is None:
+            return not os.path.lexists(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        key = (reader_path, relative_path)
+        if self.checked.get(key) == (stat.st_size, stat.st_mtime_ns, expected_hash):
+            return False
+        self.checked[key] = (stat.st_size, stat.st_mtime_ns, expected_hash)
+        try:
+            with open(path, 'rb') as f:
+                return content_hash(f.read()) == expected_hash
+        except OSError:
+            return False
+
+    # Wait until all the readers have all the expected paths, return the latencies and the time the last one arrived
+    def wait(self, timeout):
+        pending = {(reader_path, relative_path) for reader_path in self.setup.readers()
+                   for relative_path in self.expected}
+        latencies = []
+        last_arrival = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        while pending and time.monotonic() < deadline:
+            now = time.perf_counter()
+            for reader_path, relative_path in list(pending):
+                expected_hash, written_time = self.expected[relative_path]
+                if self.is_reached(reader_path, relative_path, expected_hash):
+                    latencies.append(now - written_time)
+                    last_arrival = now
+                    pending.discard((reader_path, relative_path))
+            if pending:
+                time.sleep(POLL_INTERVAL)
+        self.expected.clear()
+        self.checked.clear()
+        return latencies, last_arrival, len(pending)
+
+
+def result(name, setup, changes, size, start, latencies, end, missing):
+    seconds = end - start
+    return {
+        'workload': name,
+        'clients': len(setup.clients),
+        'changes': changes,
+        'bytes': size,
+        'seconds': round(seconds, 4),
+        'files_per_second': round(changes / seconds, 2) if seconds > 0 else None,
+        'mb_per_second': round(size / seconds / 1e6, 3) if seconds > 0 else None,
+        'latency_seconds': dict([(f'p{percent}', percentile(latencies, percent)) for percent in LATENCY_PERCENTILES]
+                                + [('max', percentile(latencies, 100))]),
+        'missing': missing,
+        'peak_rss_kb': setup.peak_rss(),
+    }
+
+
+# Many small files in a few directories
+def small_files(setup, args):
+    expectations = Expectations(setup)
+    start = time.perf_counter()
+    for index in range(args.small_files):
+        expectations.write(os.path.join('small', f'd{index % 16}', f'f{index}'), os.urandom(args.small_size))
+    latencies, end, missing = expectations.wait(args.timeout)
+    return result('small_files', setup, args.small_files, args.small_files * args.small_size, start, latencies, end,
+                  missing)
+
+
+# A few huge files
+def huge_files(setup, args):
+    expectations = Expectations(setup)
+    size = args.huge_size * 1024 * 1024
+    start = time.perf_counter()
+    for index in range(args.huge_files):
+        expectations.write(os.path.join('huge', f'f{index}'), os.urandom(size))
+    latencies, end, missing = expectations.wait(args.timeout)
+    return result('huge_files', setup, args.huge_files, args.huge_files * size, start, latencies, end, missing)
+
+
+# Each file is rewritten many times in a row, the latency is from the last write until the readers have it
+def modify_storm(setup, args):
+    expectations = Expectations(setup)
+    for index in range(args.storm_files):
+        expectations.write(os.path.join('storm', f'f{index}'), os.urandom(args.small_size))
+    expectations.wait(args.timeout)
+
+    start = time.perf_counter()
+    for _ in range(args.storm_rounds):
+        for index in range(args.storm_files):
+            expectations.write(os.path.join('storm', f'f{index}'), os.urandom(args.small_size))
+    latencies, end, missing = expectations.wait(args.timeout)
+    changes = args.storm_files * args.storm_rounds
+    return result('modify_storm', setup, changes, changes * args.small_size, start, latencies, end, missing)
+
+
+# Move of the top of a deep tree, the latency is until all its files are in their new place
+def deep_moves(setup, args):
+    expectations = Expectations(setup)
+    deep_path = os.path.join(*[f'level{level}' for level in range(args.depth)])
+    files = [os.path.join(deep_path, f'f{index}') for index in range(args.depth_files)]
+    contents = [os.urandom(args.small_size) for _ in files]
+    for file, data in zip(files, contents):
+        expectations.write(os.path.join('tree', file), data)
+    expectations.wait(args.timeout)
+
+    start = time.perf_counter()
+    os.rename(setup.writer_path('tree'), setup.writer_path('moved'))
+    for file, data in zip(files, contents):
+        expectations.moved(os.path.join('tree', file), os.path.join('moved', file), data, start)
+    latencies, end, missing = expectations.wait(args.timeout)
+    return result('deep_moves', setup, len(files), 0, start, latencies, end, missing)
+
+
+# Small files with many clients of the same identifier
+def shared_identifier(setup, args):
+    return dict(small_files(setup, args), workload='shared_identifier')
+
+
+WORKLOADS = {
+    'small_files': small_files,
+    'huge_files': huge_files,
+    'modify_storm': modify_storm,
+    'deep_moves': deep_moves,
+    'shared_identifier': shared_identifier,
+}
+
+
+def run_workload(name, args):
+    clients = args.shared_clients if name == 'shared_identifier' else args.clients
+    setup = Setup(clients, args.time_series)
+    try:
+        # All clients are connected and watching once they got this file
+        expectations = Expectations(setup)
+        expectations.write('ready', b'ready')
+        _, _, missing = expectations.wait(args.timeout)
+        if missing:
+            return {'workload': name, 'clients': clients, 'error': 'clients did not connect'}
+        return WORKLOADS[name](setup, args)
+    finally:
+        setup.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark of the server and clients on localhost')
+    parser.add_argument('workloads', nargs='*', help=f'workloads to run ({", ".join(WORKLOADS)}), all by default')
+    parser.add_argument('--clients', type=int, default=2, help='clients of the identifier, the first one writes')
+    parser.add_argument('--shared-clients', type=int, default=8, help='clients of shared_identifier workload')
+    parser.add_argument('--time-series', type=int, default=1, help='seconds between polls of clients without push')
+    parser.add_argument('--small-files', type=int, default=1000)
+    parser.add_argument('--small-size', type=int, default=4096, help='bytes of each small file')
+    parser.add_argument('--huge-files', type=int, default=2)
+    parser.add_argument('--huge-size', type=int, default=64, help='MiB of each huge file')
+    parser.add_argument('--storm-files', type=int, default=20)
+    parser.add_argument('--storm-rounds', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=20, help='directory levels of deep_moves')
+    parser.add_argument('--depth-files', type=int, default=50)
+    parser.add_argument('--timeout', type=float, default=120, help='seconds we wait for each workload to sync')
+    parser.add_argument('--output', help='file to write the results to, besides stdout')
+    args = parser.parse_args()
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f'unknown workload {name}')
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = [run_workload(name, args) for name in args.workloads or WORKLOADS]
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
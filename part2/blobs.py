@@ -0,0 +1,155 @@
+import hashlib
+import itertools
+import os
+
+import content_cache
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Content of all identifiers files is kept here once, in files named by the sha256 of their content
+# Identifier directories hold hard links to these blobs, so identical files take disk space only once
+BLOBS_DIRECTORY = 'blobs'
+# Links to blobs are created here first and then moved to their place in identifier directory
+LINKS_DIRECTORY = os.path.join(BLOBS_DIRECTORY, 'links')
+READ_SIZE = 1024 * 1024
+# Worker processes share the blobs, so a blob is linked or removed by one process at a time under lock of this file
+LOCK_PATH = 'blobs.lock'
+
+# Blob path by (device, inode), so we find the blob of identifier file without reading it
+blob_inodes = {}
+link_counter = itertools.count()
+# Open lock file if the blobs are shared with other processes
+lock_file = None
+
+
+def blob_path(content_hash):
+    name = content_hash.hex()
+    return os.path.join(BLOBS_DIRECTORY, name[:2], name)
+
+
+def file_key(path):
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino
+
+
+# Find all blobs we have, blobs that no identifier file links to anymore are removed
+def load():
+    os.makedirs(LINKS_DIRECTORY, exist_ok=True)
+    for name in os.listdir(LINKS_DIRECTORY):
+        os.remove(os.path.join(LINKS_DIRECTORY, name))
+    for root, subdirs, files in os.walk(BLOBS_DIRECTORY):
+        for file in files:
+            path = os.path.join(root, file)
+            stat = os.stat(path)
+            if stat.st_nlink == 1:
+                os.remove(path)
+            else:
+                blob_inodes[(stat.st_dev, stat.st_ino)] = path
+
+
+# Called by each worker process, each process needs its own open lock file
+def share():
+    global lock_file
+    if fcntl:
+        lock_file = open(LOCK_PATH, 'wb')
+
+
+def lock():
+    if lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+
+def unlock():
+    if lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def blob_of(path):
+    try:
+        key = file_key(path)
+    except FileNotFoundError:
+        return None
+    blob = blob_inodes.get(key)
+    # Other worker process may have removed the blob, and then its inode may belong to another file
+    if blob and lock_file:
+        try:
+            is_valid = file_key(blob) == key
+        except FileNotFoundError:
+            is_valid = False
+        if not is_valid:
+            del blob_inodes[key]
+            return None
+    return blob
+
+
+# Return content hash of open file of identifier directory, None if it is not a blob
+# The open file keeps its inode, so the hash is of the content we read even if the path is replaced meanwhile
+def open_file_hash(f):
+    stat = os.fstat(f.fileno())
+    blob = blob_inodes.get((stat.st_dev, stat.st_ino))
+    # Other worker process may have removed the blob, and then its inode may belong to another file
+    if blob and lock_file:
+        try:
+            if file_key(blob) != (stat.st_dev, stat.st_ino):
+                return None
+        except FileNotFoundError:
+            return None
+    return bytes.fromhex(os.path.basename(blob)) if blob else None
+
+
+def content_hash(path):
+    blob = blob_of(path)
+    if blob:
+        return bytes.fromhex(os.path.basename(blob))
+    # File from before we had blobs, we have to read it
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.digest()
+
+
+# Replace path with temp file that has content_hash
+# If we already have blob with this content the temp file is dropped, otherwise it becomes a new blob
+def replace(temp_path, content_hash, path):
+    blob = blob_path(content_hash)
+    lock()
+    try:
+        if os.path.isfile(blob):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(temp_path, blob)
+        # Blob may be new, or made by other worker process after we loaded the blobs
+        blob_inodes[file_key(blob)] = blob
+
+        old_blob = blob_of(path)
+        if old_blob == blob:
+            return
+        link_path = os.path.join(LINKS_DIRECTORY, f'{os.getpid()}-{next(link_counter)}')
+        os.link(blob, link_path)
+        os.replace(link_path, path)
+        release(old_blob)
+    finally:
+        unlock()
+
+
+# Remove file of identifier directory, and its blob if it was the last link to it
+def remove(path):
+    lock()
+    try:
+        blob = blob_of(path)
+        os.remove(path)
+        release(blob)
+    finally:
+        unlock()
+
+
+def release(blob):
+    if blob and os.stat(blob).st_nlink == 1:
+        del blob_inodes[file_key(blob)]
+        os.remove(blob)
+        content_cache.discard(bytes.fromhex(os.path.basename(blob)))
@@ -1,10 +1,21 @@
+import hashlib
 import os
+import queue
+import select
 import socket
 import sys
+import threading
 import time
+import zlib
 from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
 
+import compression
+import delta
+import protocol
+import record_log
+from protocol import ClientDisconnectedException
+
 # Client commands
 CREATE_COMMAND = 1
 DELETE_COMMAND = 2
@@ -12,15 +23,124 @@ MODIFY_COMMAND = 3
 MOVE_COMMAND = 4
 PULL_COMMAND = 5
 UPDATES_COMMAND = 6
+FEATURES_COMMAND = 7
+ENABLE_FEATURES_COMMAND = 8
+SIGNATURES_COMMAND = 9
+MODIFY_DELTA_COMMAND = 10
+PULL_DELTA_COMMAND = 11
+PULL_MANIFEST_COMMAND = 12
+RESUME_COMMAND = 13
+CURSOR_COMMAND = 14
+SESSION_COMMAND = 15
+ACK_COMMAND = 16
+UPLOAD_OFFSET_COMMAND = 18
+CHUNKED_UPLOAD_COMMAND = 19
+RESUME_DOWNLOAD_COMMAND = 20
+
+# First byte of session hello instead of is_identifier, servers without sessions answer it as FEATURES_COMMAND
+# In session we send each request in frames: size (4 bytes), request id (4 bytes) and flags, without the identifier
+SESSION_OPEN = 3
+SESSION_JOIN = 4
+# Flags of frame, the last frame of each request has FRAME_END
+FRAME_END = 1
+MAX_FRAME_SIZE = (1 << 32) - 1
+
+# Features we enable on server with ENABLE_FEATURES_COMMAND (bit flags)
+FEATURE_PUSH = 1
+FEATURE_DELTA = 2
+FEATURE_LARGE_FILES = 4
+FEATURE_MANIFEST_PULL = 8
+FEATURE_CURSOR = 16
+FEATURE_COMPRESSION = 32
+FEATURE_RESUME = 64
+
+# Manifest entries of PULL_MANIFEST_COMMAND
+MANIFEST_END = 0
+MANIFEST_FILE = 1
+MANIFEST_DIRECTORY = 2
+MANIFEST_PARTIAL = 3
+
+# Modified files smaller than this are sent in full, bigger files are sent as delta if the server supports it
+DELTA_MIN_SIZE = 64 * 1024
+# Files that are received or rebuilt from delta are written next to the original with this suffix, and then renamed
+# over it. If the connection is cut in the middle, the server continues the download from the end of this file
+TEMP_PATTERN = ".sync-partial"
+# Files of this size and bigger are uploaded in chunks to servers with resume feature, if the connection is cut the
+# next upload of the same content continues from the last chunk the server got
+RESUME_MIN_SIZE = int(os.environ.get('SYNC_RESUME_MIN_SIZE', 8 * 1024 * 1024))
+RESUME_CHUNK_SIZE = 1024 * 1024
+# Max bytes we send in one call when we fill a file that got shorter while we sent it
+CHUNK_SIZE = 65536
+# Files smaller than this are compressed at once, bigger files are compressed by worker thread while we send them
+WORKER_COMPRESS_SIZE = 1024 * 1024
+
+# Set SYNC_PUSH=0 to poll the server every time_series seconds even if it can push updates
+PUSH_UPDATES = os.environ.get('SYNC_PUSH', '1') != '0'
+# Set SYNC_COMPRESSION=lzma to compress the files we send with lzma, or SYNC_COMPRESSION=none to send them raw
+COMPRESSION = os.environ.get('SYNC_COMPRESSION', 'zlib')
+# Number of connections the first upload of new identifier uses, each of them with a thread that reads and sends files
+# Set SYNC_UPLOAD_CONNECTIONS=1 to upload on the main connection only
+UPLOAD_CONNECTIONS = int(os.environ.get('SYNC_UPLOAD_CONNECTIONS', '4'))
+# Paths the upload threads can wait for
+UPLOAD_QUEUE_SIZE = 1024
+# Seconds we wait for the server to answer FEATURES_COMMAND, old servers never answer
+NEGOTIATION_TIMEOUT = 1
+# Seconds we wait for more events of a path before we send its change, so the many events of one save are sent once
+# Set SYNC_COALESCE_WINDOW=0 to send each change as soon as the coalescer thread gets it
+COALESCE_WINDOW = float(os.environ.get('SYNC_COALESCE_WINDOW', '0.2'))
+# Path that never stops changing is still sent once in this many seconds
+COALESCE_MAX_DELAY = 2
+# Seconds we remember the changes we applied from the server, their watchdog events come long before
+APPLIED_WINDOW = 30
+APPLIED_DIRECTORY = 'directory'
+APPLIED_REMOVED = 'removed'
+# Deleted file waits this many seconds for a file with the same content, then both are sent as one move
+# Tools that rename by delete and create (git checkout, atomic saves) are sent as the two paths instead of the file
+# Set SYNC_RENAME_WINDOW=0 to send deletes and creates as they are
+RENAME_WINDOW = float(os.environ.get('SYNC_RENAME_WINDOW', '1'))
+# State of each watched directory is kept here, in a file named by the directory and the identifier
+STATE_DIRECTORY = os.environ.get('SYNC_STATE_DIRECTORY', os.path.join(os.path.expanduser('~'), '.sync-client'))
+# State file records
+STATE_FILE = 1
+STATE_REMOVE = 2
+STATE_DIRECTORY_ENTRY = 3
+# Last cursor the server sent us, the record has empty path
+STATE_CURSOR = 4
+STATE_PAYLOAD_SIZES = {STATE_FILE: record_log.FILE_ENTRY.size, STATE_CURSOR: protocol.CURSOR.size}
+# Index entry of directory
+DIRECTORY_ENTRY = (0, 0, None)
 
 observer = None
+# Coalescer of the watchdog events, it sends the changes to server
+coalescer = None
+# Buffered reader of the server socket, only the main thread reads from it
+reader = None
+# Features the server agreed to, None if the server doesn't know FEATURES_COMMAND
+server_features = None
+# Handle of our session on server, all our connections join it. None if the server doesn't support sessions
+session = None
+# Requests the server didn't acknowledge yet by the socket they were sent on
+in_flight = {}
+last_request_id = 0
+request_lock = threading.Lock()
+# Watchdog thread and main thread both send to server, so each packet is sent under this lock
+send_lock = threading.Lock()
+# Files we asked the server signatures for (to upload delta) or delta of (to download it), so if they are moved
+# before the answer arrives we ask again with the new path
+pending_uploads = set()
+pending_downloads = set()
+# Files we asked the server from where to continue their chunked upload, with the size, modification time and hash
+# they had when we asked
+pending_resumes = {}
+pending_lock = threading.Lock()
 
 
 # Start watchdog observer on base_path parameter
 def start_watchdog(base_path, s, identifier):
-    global observer
+    global observer, coalescer
     if observer:
         return
+    coalescer = EventCoalescer(base_path, s, identifier)
     # Initialize logging event handler
     event_handler = Handler(base_path, s, identifier)
 
@@ -34,11 +154,14 @@ def start_watchdog(base_path, s, identifier):
 
 # Stop running watchdog observer
 def stop_watchdog():
-    global observer
+    global observer, coalescer
     if observer:
         observer.stop()
         wait_observer()
         observer = None
+    if coalescer:
+        coalescer.stop()
+        coalescer = None
 
 
 # Wait for observer to exit
@@ -48,180 +171,937 @@ def wait_observer():
         observer.join()
 
 
-class ClientDisconnectedException(BaseException):
-    def __init__(self):
-        super().__init__(self, "Client Disconnected")
+# Bytes of file sizes in messages, servers with large files feature use 8 bytes so files can pass 4 GiB
+def size_length():
+    return 8 if server_features and server_features & FEATURE_LARGE_FILES else 4
+
+
+# Encoding we compress files we send with, None if the server doesn't get encoding byte after file size
+def encoding():
+    if not server_features or not server_features & FEATURE_COMPRESSION:
+        return None
+    return compression.ENCODINGS.get(COMPRESSION, compression.ENCODING_RAW)
+
+
+# Receive file_size bytes of file content in chunks, into temp file that replaces path at the end
+# Resumed download has the content before offset in the temp file already
+def receive_file(s, path, file_size, offset=0):
+    try:
+        f = open(path + TEMP_PATTERN, 'r+b' if offset else 'wb')
+    except FileNotFoundError:
+        if offset:
+            # Partial file is gone since we sent the manifest, the next pull will send all the file
+            receive_content(lambda data: None, file_size)
+            return
+        # Parent directories are created only when missing, pull of many files in one directory doesn't check each time
+        make_directories(os.path.dirname(path))
+        f = open(path + TEMP_PATTERN, 'wb')
+    writer = delta.HashingWriter(f)
+    with f:
+        if offset:
+            f.truncate(offset)
+            for data in iter(lambda: f.read(delta.MAX_LITERAL_SIZE), b''):
+                writer.sha256.update(data)
+        receive_content(writer.write, file_size)
+    replace_applied(path, writer.sha256.digest())
+
+
+def receive_content(write, file_size):
+    # Server sends the encoding of the content if we enabled compression
+    file_encoding = reader.read_int(1) if encoding() is not None else compression.ENCODING_RAW
+    if file_encoding == compression.ENCODING_RAW:
+        reader.read_to(write, file_size)
+    else:
+        receive_compressed(compression.Decoder(file_encoding, file_size, write))
+
+
+# Replace path with the temp file we wrote content_hash to
+# It is added to the applied changes first, so the watchdog events of the replace are known as ours
+def replace_applied(path, content_hash):
+    stat = os.stat(path + TEMP_PATTERN)
+    applied.add_file(path, stat, content_hash)
+    os.replace(path + TEMP_PATTERN, path)
+    content_index.set(path, stat, content_hash)
+
+
+# Create directory path and its missing parents, each of them is added to the applied changes before it is created
+def make_directories(path):
+    missing = []
+    while not os.path.isdir(path):
+        missing.append(path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    for directory in reversed(missing):
+        applied.add_directory(directory)
+        try:
+            os.mkdir(directory)
+        except FileExistsError:
+            pass
+        content_index.add_directory(directory)
+
+
+# Pass the data of the frames to decoder as they arrive, until the end frame
+def receive_compressed(decoder):
+    while True:
+        frame_size = reader.read_int(4)
+        if not frame_size:
+            break
+        reader.read_to(decoder.write, frame_size)
+    decoder.close()
+
+
+# Start of message of command, in session the server knows the identifier already
+def request_header(identifier, command):
+    if session is not None:
+        return command.to_bytes(1, 'little')
+    return int(1).to_bytes(1, 'little') + identifier.encode('utf-8') + command.to_bytes(1, 'little')
+
+
+# Return new request id of request sent on s, it is in flight until the server acknowledges it
+def new_request(s):
+    global last_request_id
+    with request_lock:
+        last_request_id = (last_request_id + 1) & 0xFFFFFFFF
+        in_flight.setdefault(s, set()).add(last_request_id)
+        return last_request_id
+
+
+def frame_header(request_id, size, is_end=True):
+    return protocol.FRAME_HEADER.pack(size, request_id, FRAME_END if is_end else 0)
+
+
+# Server handled request, if it failed the server skipped it and went on with the next requests
+def receive_ack(s, server_reader=None):
+    request_id, _ = (server_reader or reader).read_struct(protocol.ACK)
+    with request_lock:
+        in_flight.get(s, set()).discard(request_id)
+
+
+def send_to_server(s, packet, lock=send_lock):
+    with lock:
+        if session is not None:
+            packet = frame_header(new_request(s), len(packet)) + packet
+        s.sendall(packet)
+
+
+# Send header and all the chunks together, so no other packet is sent in the middle
+# In session each chunk is a frame of the request, and an empty frame ends it
+def send_stream_to_server(s, header, chunks, lock=send_lock):
+    with lock:
+        if session is None:
+            s.sendall(header)
+            for chunk in chunks:
+                s.sendall(chunk)
+            return
+        request_id = new_request(s)
+        s.sendall(frame_header(request_id, len(header), False) + header)
+        for chunk in chunks:
+            if chunk:
+                s.sendall(frame_header(request_id, len(chunk), False) + chunk)
+        s.sendall(frame_header(request_id, 0))
+
+
+# Send size bytes of file from offset straight from the disk
+# If sha256 is given the bytes pass through memory to update it, so the file is not read again to hash it
+def send_file_range(s, f, offset, size, sha256=None):
+    sent = 0
+    if sha256 is None:
+        sent = s.sendfile(f, offset, size) if size else 0
+    while sent < size and sha256 is not None:
+        data = compression.read_at(f, offset + sent, min(size - sent, CHUNK_SIZE))
+        if not data:
+            break
+        sha256.update(data)
+        s.sendall(data)
+        sent += len(data)
+    # If the file got shorter meanwhile we fill it with zeros, the event of this change will fix it
+    while sent < size:
+        data = bytes(min(size - sent, CHUNK_SIZE))
+        if sha256 is not None:
+            sha256.update(data)
+        s.sendall(data)
+        sent += len(data)
+
+
+# Send header, file size and the file content straight from the disk, so the file is never loaded to memory
+# Each upload connection has its own lock, so they send in parallel
+# Return the stat of the file and the sha256 of the content we sent for the content index, None if nothing was sent
+def send_file_to_server(s, header, file_path, lock=send_lock):
+    try:
+        f = open(file_path, 'rb')
+    except (FileNotFoundError, PermissionError):
+        return None
+    with f:
+        stat = os.fstat(f.fileno())
+        file_size = stat.st_size
+        # Server with 4 bytes sizes can't get bigger files
+        if file_size >= 1 << (8 * size_length()):
+            return None
+        # Content is hashed as it is sent, unless the index knows the hash of this version of the file already
+        content_hash = content_index.unchanged_hash(file_path, stat)
+        sha256 = hashlib.sha256() if content_hash is None else None
+        header += file_size.to_bytes(size_length(), 'little')
+        file_encoding = compression.ENCODING_RAW
+        if encoding() is not None:
+            file_encoding = compression.choose_encoding(f, file_size, encoding())
+            header += file_encoding.to_bytes(1, 'little')
+        if file_encoding != compression.ENCODING_RAW:
+            frames = compression.compressed_frames(f, file_size, file_encoding, sha256=sha256)
+            # Big file is compressed by worker thread, so the next frame is compressed while we send this one
+            if file_size >= WORKER_COMPRESS_SIZE:
+                frames = compression.threaded(frames)
+            send_stream_to_server(s, header, frames, lock)
+        else:
+            send_raw_file(s, header, f, file_size, sha256, lock)
+    return stat, content_hash or sha256.digest()
+
+
+def send_raw_file(s, header, f, file_size, sha256, lock):
+    with lock:
+        if session is None:
+            s.sendall(header)
+            send_file_range(s, f, 0, file_size, sha256)
+            return
+        # File bigger than one frame is sent in more frames of the same request
+        request_id = new_request(s)
+        offset = 0
+        while True:
+            size = min(file_size - offset, MAX_FRAME_SIZE - len(header))
+            is_end = offset + size == file_size
+            s.sendall(frame_header(request_id, len(header) + size, is_end) + header)
+            send_file_range(s, f, offset, size, sha256)
+            offset += size
+            header = b''
+            if is_end:
+                return
+
+
+def command_header(identifier, command, is_directory, sent_path):
+    sent_path = sent_path.encode('utf-8')
+    return request_header(identifier, command) + is_directory.to_bytes(1, 'little') \
+           + len(sent_path).to_bytes(4, 'little') + sent_path
+
+
+# Ask the server for signatures of its copy of file_path, we send the delta when they arrive
+def request_signatures(s, identifier, base_path, file_path):
+    with pending_lock:
+        pending_uploads.add(file_path)
+    send_to_server(s, command_header(identifier, SIGNATURES_COMMAND, 0, os.path.relpath(file_path, base_path)))
+
+
+# Send our signatures of file_path, the server will answer with the delta to its copy
+def request_delta(s, identifier, base_path, file_path):
+    with pending_lock:
+        pending_downloads.add(file_path)
+    header = command_header(identifier, PULL_DELTA_COMMAND, 0, os.path.relpath(file_path, base_path))
+    send_stream_to_server(s, header, delta.file_signatures(file_path))
+
+
+# Update pending paths after src_path moved to dst_path, return the new paths of the moved pending files
+def move_pending_paths(pending, src_path, dst_path):
+    with pending_lock:
+        moved = [path for path in pending if path == src_path or path.startswith(src_path + os.sep)]
+        for path in moved:
+            # Pending resumes are dictionary, the other pending paths are sets
+            if isinstance(pending, dict):
+                del pending[path]
+            else:
+                pending.remove(path)
+    return [dst_path + path[len(src_path):] for path in moved]
+
+
+def is_resumable(file_path):
+    if not server_features or not server_features & FEATURE_RESUME:
+        return False
+    try:
+        return os.path.getsize(file_path) >= RESUME_MIN_SIZE
+    except OSError:
+        return False
+
+
+# Ask the server from where to continue the upload of file_path, we send the chunks when the answer arrives
+def request_upload_offset(s, identifier, base_path, file_path):
+    try:
+        stat = os.stat(file_path)
+        # File that didn't change since we sent it is not read, the server will answer that it has it
+        content_hash = content_index.unchanged_hash(file_path, stat)
+        if content_hash is None:
+            _, content_hash = file_size_and_hash(file_path)
+    except (FileNotFoundError, PermissionError):
+        return
+    with pending_lock:
+        pending_resumes[file_path] = (stat.st_size, stat.st_mtime_ns, content_hash)
+    send_to_server(s, command_header(identifier, UPLOAD_OFFSET_COMMAND, 0, os.path.relpath(file_path, base_path))
+                   + protocol.MANIFEST_FILE_HEADER.pack(stat.st_size, content_hash))
+
+
+# Server answered from where to continue the upload, we send the chunks from there
+def send_chunks_to_server(s, identifier, base_path, path):
+    file_size, content_hash, offset = reader.read_struct(protocol.UPLOAD_OFFSET)
+    with pending_lock:
+        request = pending_resumes.get(path)
+        # Answer to older request of path, we wait for the answer to the last one
+        if request and request[2] != content_hash:
+            return
+        pending_resumes.pop(path, None)
+    try:
+        f = open(path, 'rb')
+    except (FileNotFoundError, PermissionError):
+        return
+    with f:
+        stat = os.fstat(f.fileno())
+        # If the file changed since we asked, or the server asks again after a chunk it couldn't check, we ask again
+        # with the current content
+        is_changed = request != (stat.st_size, stat.st_mtime_ns, content_hash) or file_size != stat.st_size
+        if not is_changed:
+            file_encoding = compression.ENCODING_RAW
+            if encoding() is not None:
+                file_encoding = compression.choose_encoding(f, file_size, encoding())
+            header = command_header(identifier, CHUNKED_UPLOAD_COMMAND, 0, os.path.relpath(path, base_path)) \
+                     + protocol.CHUNKED_UPLOAD_HEADER.pack(file_size, content_hash, offset, file_encoding)
+            chunks = file_chunks(f, file_size, offset, file_encoding)
+            if file_encoding != compression.ENCODING_RAW and file_size - offset >= WORKER_COMPRESS_SIZE:
+                chunks = compression.threaded(chunks)
+            send_stream_to_server(s, header, chunks)
+    if is_changed:
+        push_file_to_server(identifier, s, path, base_path)
+        return
+    content_index.set(path, stat, content_hash)
+
+
+# Return generator of the chunks of file from offset, each with its sizes and crc32 so the server checks it alone
+# If the file got shorter meanwhile it is filled with zeros, the server will find that its hash is wrong
+def file_chunks(f, file_size, offset, file_encoding):
+    while offset < file_size:
+        size = min(file_size - offset, RESUME_CHUNK_SIZE)
+        content = compression.read_at(f, offset, size).ljust(size, b'\0')
+        offset += size
+        data = content
+        if file_encoding != compression.ENCODING_RAW:
+            data = compression.compress_chunk(content, file_encoding)
+        yield protocol.CHUNK_HEADER.pack(size, len(data), zlib.crc32(data)) + data
+    yield protocol.CHUNK_HEADER.pack(0, 0, 0)
+
+
+# Apply the updates the server sends until it answered all our requests for upload offsets
+def wait_upload_offsets(identifier, s, base_path):
+    while pending_resumes:
+        command = reader.read_int(1, signed=True)
+        # If command == -1 it means we send invalid identifier
+        if command == -1:
+            raise ClientDisconnectedException()
+        if command == CURSOR_COMMAND:
+            receive_cursor()
+            continue
+        if command == ACK_COMMAND:
+            receive_ack(s)
+            continue
+        apply_update_from_server(command, s, base_path, identifier)
 
 
-def recv(client_socket, recv_size):
-    recv_data = b''
-    while len(recv_data) < recv_size:
-        recv_data += client_socket.recv(recv_size - len(recv_data))
+def receive_signatures(s):
+    block_size, count, base_size = reader.read_struct(protocol.SIGNATURES_HEADER)
+    table = delta.parse_signatures(reader.read(count * delta.SIGNATURE_SIZE))
+    base_hash = bytes(reader.read(delta.HASH_SIZE))
+    return block_size, base_size, table, base_hash
+
+
+# Server sent signatures of its copy, we send the delta from it to our file
+def send_delta_to_server(s, identifier, base_path, path):
+    block_size, base_size, table, base_hash = receive_signatures(s)
+    with pending_lock:
+        pending_uploads.discard(path)
+    if not os.path.isfile(path):
+        return
 
-    return recv_data
+    header = command_header(identifier, MODIFY_DELTA_COMMAND, 0, os.path.relpath(path, base_path)) + base_hash \
+             + block_size.to_bytes(4, 'little')
+    try:
+        f = open(path, 'rb')
+    except (FileNotFoundError, PermissionError):
+        return
+    # All the file is read for the delta, so its sha256 for the content index is found on the way
+    stat = os.fstat(f.fileno())
+    file_reader = delta.HashingReader(f)
+    send_stream_to_server(s, header, delta.file_delta_instructions(file_reader, block_size, base_size, table))
+    content_index.set(path, stat, file_reader.sha256.digest())
+
+
+# Return sha256 of our copy of path, a missing file is empty and a directory has no hash
+# File that didn't change since it was indexed is not read
+def base_content_hash(path):
+    if os.path.isdir(path):
+        return None
+    try:
+        content_hash = content_index.unchanged_hash(path, os.stat(path))
+    except FileNotFoundError:
+        content_hash = None
+    return content_hash or delta.file_hash(path)
+
+
+# Server sent delta from our copy to its file, we rebuild the file from them
+def receive_delta_from_server(s, identifier, base_path, path):
+    status = reader.read_int(1)
+    with pending_lock:
+        pending_downloads.discard(path)
+    # If status is 0 the file doesn't exist on server anymore
+    if not status:
+        return
+    base_hash = bytes(reader.read(delta.HASH_SIZE))
+
+    # If our file changed since we sent the signatures, the copy instructions are useless
+    is_base_valid = base_content_hash(path) == base_hash
+    base_file = open(path, 'rb') if is_base_valid and os.path.isfile(path) else None
+    out_file = None
+    if is_base_valid:
+        make_directories(os.path.dirname(path))
+        out_file = open(path + TEMP_PATTERN, 'wb')
+    writer = delta.HashingWriter(out_file)
+    try:
+        while True:
+            instruction = reader.read_int(1)
+            if instruction == delta.DELTA_END:
+                break
+            if instruction == delta.DELTA_COPY:
+                start, count = reader.read_struct(protocol.COPY_HEADER)
+                if base_file:
+                    delta.copy_blocks(base_file, writer, start, count, delta.BLOCK_SIZE)
+            else:
+                data_size = reader.read_int(4)
+                if out_file:
+                    reader.read_to(writer.write, data_size)
+                else:
+                    reader.skip(data_size)
+    finally:
+        if base_file:
+            base_file.close()
+        if out_file:
+            out_file.close()
+
+    if is_base_valid:
+        replace_applied(path, writer.sha256.digest())
+    else:
+        request_delta(s, identifier, base_path, path)
 
 
 # First connection to server with identifier, we receive all directory
 def pull_all_from_server(identifier, s, base_path):
-    is_identifier = 1
-    is_identifier = is_identifier.to_bytes(1, 'little')
-    identifier = identifier.encode('utf-8')
-    updates = PULL_COMMAND.to_bytes(1, 'little')
-    data = is_identifier + identifier + updates
-    s.sendall(data)
+    send_to_server(s, request_header(identifier, PULL_COMMAND))
+    receive_pull_from_server(s, base_path, identifier)
+
 
+# Apply the packets the server sends for pull, until the special packet that indicates there is no more files
+def receive_pull_from_server(s, base_path, identifier):
     while True:
-        command = s.recv(1)
-        # If empty array it means the server exit
-        if not command:
-            raise ClientDisconnectedException()
-        command = int.from_bytes(command, 'little', signed=True)
+        # If the server exit, the reader raises ClientDisconnectedException
+        command = reader.read_int(1, signed=True)
         # If command == -1 it means we send invalid identifier
         if command == -1:
             raise ClientDisconnectedException()
-        # If we got the special packet that indicates there is no more files
-        if command != CREATE_COMMAND:
+        if command == 0:
             break
-        is_directory = int.from_bytes(s.recv(1), 'little')
-        path_size = int.from_bytes(s.recv(4), 'little')
-        path = os.path.join(base_path, s.recv(path_size).decode('utf-8'))
-        path = path.replace("/", os.sep)
-        path = path.replace('\\', os.sep)
-        if is_directory:
-            os.makedirs(path, exist_ok=True)
+        # Changes we sent before the pull move our cursor, so the server can send it before the pull
+        if command == CURSOR_COMMAND:
+            receive_cursor()
             continue
-        file_size = int.from_bytes(s.recv(4), 'little')
-        file_data = recv(s, file_size)
+        if command == ACK_COMMAND:
+            receive_ack(s)
+            continue
+        apply_update_from_server(command, s, base_path, identifier)
+
+
+def file_size_and_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(delta.MAX_LITERAL_SIZE), b''):
+            sha256.update(chunk)
+        return f.tell(), sha256.digest()
+
+
+def manifest_entry(entry_type, sent_path):
+    sent_path = sent_path.encode('utf-8')
+    return entry_type.to_bytes(1, 'little') + len(sent_path).to_bytes(4, 'little') + sent_path
+
+
+# Return generator of manifest entries of all directories and files under base_path
+# Partial files of downloads that were cut are added to partials, and sent to servers that can continue them
+def local_manifest(base_path, partials):
+    for root, subdirs, files in os.walk(base_path):
+        for subdir in subdirs:
+            content_index.add_directory(os.path.join(root, subdir))
+            yield manifest_entry(MANIFEST_DIRECTORY, os.path.relpath(os.path.join(root, subdir), base_path))
+        for file in files:
+            file_path = os.path.join(root, file)
+            # Files we didn't finish to write are not really ours, the server will send them again or their rest
+            if file_path.endswith(TEMP_PATTERN):
+                partials.append(file_path)
+                try:
+                    if server_features & FEATURE_RESUME and os.path.getsize(file_path):
+                        file_size, file_hash = file_size_and_hash(file_path)
+                        yield manifest_entry(MANIFEST_PARTIAL, os.path.relpath(file_path[:-len(TEMP_PATTERN)],
+                                                                               base_path)) \
+                            + protocol.MANIFEST_FILE_HEADER.pack(file_size, file_hash)
+                except (FileNotFoundError, PermissionError):
+                    pass
+                continue
+            try:
+                stat = os.stat(file_path)
+                file_size, file_hash = stat.st_size, content_index.unchanged_hash(file_path, stat)
+                # Only files that changed since they were indexed are read
+                if file_hash is None:
+                    file_size, file_hash = file_size_and_hash(file_path)
+                    # Files the server has a different copy of are indexed again when it sends them
+                    content_index.set(file_path, stat, file_hash)
+            except (FileNotFoundError, PermissionError):
+                continue
+            yield manifest_entry(MANIFEST_FILE, os.path.relpath(file_path, base_path)) \
+                + protocol.MANIFEST_FILE_HEADER.pack(file_size, file_hash)
+    yield MANIFEST_END.to_bytes(1, 'little')
 
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb+') as f:
-            f.write(file_data)
 
+# Connection with identifier to directory we already have, the server sends only the files we don't have yet,
+# deletions of what it doesn't have, and delta notifications for big files that changed
+def pull_changes_from_server(identifier, s, base_path):
+    partials = []
+    send_stream_to_server(s, request_header(identifier, PULL_MANIFEST_COMMAND), local_manifest(base_path, partials))
+    receive_pull_from_server(s, base_path, identifier)
+    # Partial files the server didn't continue are of files it doesn't have anymore
+    for partial in partials:
+        if os.path.isfile(partial):
+            os.remove(partial)
 
+
+# Each removed path is added to the applied changes before it is removed
 def delete_recursive(path):
     for root, subdirs, files in os.walk(path, topdown=False):
         for file in files:
-            os.remove(os.path.join(root, file))
+            remove_applied(os.path.join(root, file), os.remove)
         for subdir in subdirs:
-            os.rmdir(os.path.join(root, subdir))
+            remove_applied(os.path.join(root, subdir), os.rmdir)
     if os.path.isdir(path):
-        os.rmdir(path)
+        remove_applied(path, os.rmdir)
+
+
+def remove_applied(path, remove):
+    applied.add_removed(path)
+    remove(path)
+    content_index.remove(path)
 
 
-def handle_command_from_server(command, is_directory, path, base_path, s):
+def handle_command_from_server(command, is_directory, path, base_path, s, identifier):
     if command == CREATE_COMMAND:
         if is_directory:
-            os.makedirs(path, exist_ok=True)
+            make_directories(path)
             return
-        file_size = int.from_bytes(s.recv(4), 'little')
-        file_data = recv(s, file_size)
-
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb+') as f:
-            f.write(file_data)
+        file_size = reader.read_int(size_length())
+        receive_file(s, path, file_size)
     elif command == DELETE_COMMAND:
         if not os.path.isdir(path):
             if os.path.isfile(path):
                 # If it file
-                os.remove(path)
+                remove_applied(path, os.remove)
         else:
             delete_recursive(path)
     elif command == MODIFY_COMMAND:
-        file_size = int.from_bytes(s.recv(4), 'little')
-        file_data = recv(s, file_size)
-
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb+') as f:
-            f.write(file_data)
+        file_size = reader.read_int(size_length())
+        receive_file(s, path, file_size)
     elif command == MOVE_COMMAND:
-        dst_path_size = int.from_bytes(s.recv(4), 'little')
-        dst_path = os.path.join(base_path, s.recv(dst_path_size).decode('utf-8'))
+        dst_path_size = reader.read_int(4)
+        dst_path = os.path.join(base_path, reader.read_string(dst_path_size))
         dst_path = dst_path.replace("/", os.sep)
         dst_path = dst_path.replace('\\', os.sep)
 
         # If is file and destination path exists we delete it
         if not is_directory and os.path.isfile(dst_path):
-            os.remove(dst_path)
+            remove_applied(dst_path, os.remove)
 
-        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        make_directories(os.path.dirname(dst_path))
 
         # If path is dir and the source dir is empty dir, we delete it, otherwise rename the file
         if is_directory and os.path.isdir(dst_path):
-            if not os.listdir(path):
-                os.rmdir(path)
-        else:
+            if os.path.isdir(path) and not os.listdir(path):
+                remove_applied(path, os.rmdir)
+        elif os.path.exists(path):
+            # Source is missing if it was moved on server before the initial pull reached it
+            applied.add_move(path, dst_path)
             os.rename(path, dst_path)
+            content_index.move(path, dst_path)
+
+        # Delta we asked for the old path will not come, so we ask it for the new path
+        for moved_path in move_pending_paths(pending_downloads, path, dst_path):
+            request_delta(s, identifier, base_path, moved_path)
+        # Watchdog event of the move is ours and is not handled, so our pending changes move with the files here
+        for moved_path in move_pending_paths(pending_uploads, path, dst_path):
+            request_signatures(s, identifier, base_path, moved_path)
+        for moved_path in move_pending_paths(pending_resumes, path, dst_path):
+            request_upload_offset(s, identifier, base_path, moved_path)
+        if coalescer:
+            coalescer.move_pending(path, dst_path)
+    elif command == MODIFY_DELTA_COMMAND:
+        request_delta(s, identifier, base_path, path)
+    elif command == PULL_DELTA_COMMAND:
+        receive_delta_from_server(s, identifier, base_path, path)
+    elif command == SIGNATURES_COMMAND:
+        send_delta_to_server(s, identifier, base_path, path)
+    elif command == UPLOAD_OFFSET_COMMAND:
+        send_chunks_to_server(s, identifier, base_path, path)
+    elif command == RESUME_DOWNLOAD_COMMAND:
+        offset = reader.read_int(8)
+        file_size = reader.read_int(size_length())
+        receive_file(s, path, file_size, offset)
+
+
+# Receive one update packet after its command byte and apply it on base_path
+def apply_update_from_server(command, s, base_path, identifier):
+    is_directory, path_size = reader.read_struct(protocol.PATH_HEADER)
+    path = os.path.join(base_path, reader.read_string(path_size))
+    path = path.replace("/", os.sep)
+    path = path.replace('\\', os.sep)
+    handle_command_from_server(command, is_directory, path, base_path, s, identifier)
+
+
+def send_updates_request(identifier, s):
+    send_to_server(s, request_header(identifier, UPDATES_COMMAND))
 
 
 def pull_updates_from_server(identifier, s, base_path):
-    is_identifier = 1
-    is_identifier = is_identifier.to_bytes(1, 'little')
-    identifier = identifier.encode('utf-8')
-    updates = UPDATES_COMMAND.to_bytes(1, 'little')
-    data = is_identifier + identifier + updates
-    s.sendall(data)
+    send_updates_request(identifier, s)
+
+    # If the server exit, the reader raises ClientDisconnectedException
+    counts = reader.read_int(4)
+    for _ in range(counts):
+        command = reader.read_int(1)
+        apply_update_from_server(command, s, base_path, identifier)
+
 
-    counts = s.recv(4)
-    if not counts:
+# Read update packets from server as they come, if the server doesn't push we ask for them every time_series seconds
+def receive_updates_from_server(identifier, s, base_path, time_series):
+    is_pushed = server_features & FEATURE_PUSH
+    next_poll = time.time() + time_series
+    while True:
+        if not is_pushed:
+            timeout = next_poll - time.time()
+            if timeout <= 0:
+                send_updates_request(identifier, s)
+                next_poll = time.time() + time_series
+                continue
+            # Bytes already in the reader buffer will not make the socket readable
+            if not reader.available():
+                readable, _, _ = select.select([s], [], [], timeout)
+                if not readable:
+                    continue
+
+        # If the server exit, the reader raises ClientDisconnectedException
+        command = reader.read_int(1)
+        if command == CURSOR_COMMAND:
+            receive_cursor()
+            continue
+        if command == ACK_COMMAND:
+            receive_ack(s)
+            continue
+        apply_update_from_server(command, s, base_path, identifier)
+
+
+# Server sends its cursor after the changes we got, so we know from where to resume
+def receive_cursor():
+    cursor = reader.read_struct(protocol.CURSOR)
+    # Deltas we asked for are not applied yet, so the saved cursor stays before their changes
+    if not pending_downloads:
+        content_index.set_cursor(cursor)
+
+
+# Ask the server for the changes after the cursor we saved, instead of sending the manifest of all our directory
+# Return False if the server doesn't have all these changes anymore, and then we have to pull
+def resume_from_server(identifier, s, base_path):
+    cursor = content_index.cursor
+    if cursor is None or not server_features & FEATURE_CURSOR:
+        return False
+    send_to_server(s, request_header(identifier, RESUME_COMMAND) + protocol.CURSOR.pack(*cursor))
+    while True:
+        # Changes of other clients may be pushed to us before the answer
+        command = reader.read_int(1)
+        if command == RESUME_COMMAND:
+            return bool(reader.read_int(1))
+        if command == CURSOR_COMMAND:
+            receive_cursor()
+            continue
+        if command == ACK_COMMAND:
+            receive_ack(s)
+            continue
+        apply_update_from_server(command, s, base_path, identifier)
+
+
+# Open session on server, or join our session, and enable the features we support that the server supports too
+# Servers without sessions answer the hello as FEATURES_COMMAND
+# Return the enabled features, or None if the server doesn't know FEATURES_COMMAND
+def negotiate_features(identifier, s, server_reader=None, push=PUSH_UPDATES):
+    global session
+    server_reader = server_reader or reader
+    # Old servers ignore unknown commands without payload, so the first message is only the command
+    hello = SESSION_OPEN if session is None else SESSION_JOIN
+    packet = hello.to_bytes(1, 'little') + identifier.encode('utf-8') + FEATURES_COMMAND.to_bytes(1, 'little')
+    if session is not None:
+        packet += session.to_bytes(4, 'little')
+    s.sendall(packet)
+
+    s.settimeout(NEGOTIATION_TIMEOUT)
+    try:
+        command = server_reader.read_int(1, signed=True)
+    except socket.timeout:
+        return None
+    finally:
+        s.settimeout(None)
+
+    # If -1 it means we send invalid identifier
+    if command == -1:
         raise ClientDisconnectedException()
+    if command == SESSION_COMMAND:
+        session, server_supported = server_reader.read_struct(protocol.SESSION)
+    else:
+        server_supported = server_reader.read_int(1)
 
-    counts = int.from_bytes(counts, 'little')
-    for _ in range(counts):
-        command = int.from_bytes(s.recv(1), 'little')
-        is_directory = int.from_bytes(s.recv(1), 'little')
-        path_size = int.from_bytes(s.recv(4), 'little')
-        path = os.path.join(base_path, s.recv(path_size).decode('utf-8'))
-        path = path.replace("/", os.sep)
-        path = path.replace('\\', os.sep)
-        handle_command_from_server(command, is_directory, path, base_path, s)
-
-
-def push_file_to_server(identifier, s, file_path, base_path):
-    is_identifier = int(1).to_bytes(1, 'little')
-    identifier = identifier.encode('utf-8')
-    create = CREATE_COMMAND.to_bytes(1, 'little')
+    features = FEATURE_DELTA | FEATURE_LARGE_FILES | FEATURE_MANIFEST_PULL | FEATURE_CURSOR | FEATURE_RESUME
+    if push:
+        features |= FEATURE_PUSH
+    if COMPRESSION != 'none':
+        features |= FEATURE_COMPRESSION
+    features &= server_supported
+    send_to_server(s, request_header(identifier, ENABLE_FEATURES_COMMAND) + features.to_bytes(1, 'little'))
+    return features
+
+
+def push_file_to_server(identifier, s, file_path, base_path, lock=send_lock):
     # Append listening directory name with file path
     sent_file_path = os.path.relpath(file_path, base_path)
-    path_size = len(sent_file_path).to_bytes(4, 'little')
-    is_directory = os.path.isdir(file_path).to_bytes(1, 'little')
-    if os.path.isdir(file_path):
-        packet_to_send = is_identifier + identifier + create + is_directory + path_size + sent_file_path.encode('utf-8')
+    is_directory = os.path.isdir(file_path)
+    header = command_header(identifier, CREATE_COMMAND, is_directory, sent_file_path)
+    if is_directory:
+        send_to_server(s, header, lock)
+        content_index.add_directory(file_path)
     else:
         # If the file is not exists we return
         if not os.path.isfile(file_path):
             return
 
-        try:
-            with open(file_path, 'rb') as f:
-                data = f.read()
-        except PermissionError:
+        # Answer of the server comes to the main connection, so upload connections send all files whole
+        if lock is send_lock and is_resumable(file_path):
+            request_upload_offset(s, identifier, base_path, file_path)
             return
+        sent = send_file_to_server(s, header, file_path, lock)
+        if sent:
+            content_index.set(file_path, *sent)
 
-        file_size = len(data).to_bytes(4, 'little')
-        packet_to_send = is_identifier + identifier + create + is_directory + path_size + sent_file_path.encode(
-            'utf-8') + file_size + data
-    s.sendall(packet_to_send)
 
-
-def push_all_to_server(identifier, s, path):
+# Return generator of all files and empty directories of path
+def upload_paths(path):
     for root, subdirs, files in os.walk(path):
+        # Empty directory is found when we reach it, so we don't list each directory twice
+        if not subdirs and not files and root != path:
+            yield root
         for file in files:
-            push_file_to_server(identifier, s, os.path.join(root, file), path)
+            yield os.path.join(root, file)
+
+
+def push_all_to_server(identifier, s, path):
+    for file_path in upload_paths(path):
+        push_file_to_server(identifier, s, file_path, path)
+
+
+# Extra connection to server that only uploads files
+class UploadConnection:
+    def __init__(self, address):
+        self.socket = socket.create_connection(address)
+        self.reader = protocol.FrameReader(self.socket)
+        self.lock = threading.Lock()
+
+    # Enable the features of the main connection, but the server doesn't push updates to upload connection
+    def negotiate(self, identifier):
+        return negotiate_features(identifier, self.socket, self.reader, push=False)
+
+    # Wait until the server handled all the files we sent, in session it acknowledges each of them
+    # Server without sessions answers FEATURES_COMMAND after all the files we sent before it
+    def wait_server(self, identifier):
+        if session is None:
+            send_to_server(self.socket, request_header(identifier, FEATURES_COMMAND), self.lock)
+            self.reader.read(2)
+            return
+        while in_flight.get(self.socket):
+            if self.reader.read_int(1) != ACK_COMMAND:
+                raise ClientDisconnectedException()
+            receive_ack(self.socket, self.reader)
+
+    def close(self):
+        with request_lock:
+            in_flight.pop(self.socket, None)
+        self.socket.close()
+
+
+# Thread of upload connection, sends the paths it takes until it takes None
+# If connection is None it connects by itself, and paths it can't send or leaves to the main connection are added to
+# failed
+def upload_files(identifier, base_path, address, connection, paths, failed):
+    if connection is None:
+        try:
+            connection = UploadConnection(address)
+            connection.negotiate(identifier)
+        except (OSError, ClientDisconnectedException):
+            connection = None
+    while True:
+        file_path = paths.get()
+        if file_path is None:
+            break
+        # Big files are left to the main connection, it uploads them in chunks
+        if connection and not is_resumable(file_path):
+            try:
+                push_file_to_server(identifier, connection.socket, file_path, base_path, connection.lock)
+                continue
+            except OSError:
+                connection.close()
+                connection = None
+        failed.append(file_path)
+
+    if connection:
+        try:
+            connection.wait_server(identifier)
+        except (OSError, ClientDisconnectedException):
+            pass
+        connection.close()
+
+
+# Upload all files of path on UPLOAD_CONNECTIONS new connections, while we walk the directory
+# Return the paths that were not sent, or None if we can't open upload connections
+def parallel_push_all_to_server(identifier, s, path):
+    global server_features
+    address = s.getpeername()
+    try:
+        connection = UploadConnection(address)
+        # Features of the first upload connection are the features of all of them, the main connection gets them
+        # only after the upload
+        server_features = connection.negotiate(identifier)
+    except (OSError, ClientDisconnectedException):
+        return None
+    # Server without features sends the files of the upload connections back to the main connection, and it handles
+    # one client at a time anyway, so the main connection uploads alone
+    if server_features is None:
+        connection.close()
+        return None
+    # Server with sessions doesn't send changes of our session back to us, so the main connection joins it now and
+    # the session stays after the upload connections close
+    if session is not None:
+        server_features = negotiate_features(identifier, s)
+
+    paths = queue.Queue(UPLOAD_QUEUE_SIZE)
+    failed = []
+    threads = []
+    for _ in range(UPLOAD_CONNECTIONS):
+        thread = threading.Thread(target=upload_files, args=(identifier, path, address, connection, paths, failed))
+        thread.start()
+        threads.append(thread)
+        connection = None
+
+    for file_path in upload_paths(path):
+        paths.put(file_path)
+    for _ in threads:
+        paths.put(None)
+    for thread in threads:
+        thread.join()
+    return failed
+
+
+# Return the paths of base_path that were created or changed while the client was stopped, and the deleted paths
+# Only files whose size or modification time is not the one in the state are read
+def offline_changes(base_path):
+    changed = []
+    found = set()
+    for root, subdirs, files in os.walk(base_path):
         for subdir in subdirs:
-            if not os.listdir(os.path.join(root, subdir)):
-                push_file_to_server(identifier, s, os.path.join(root, subdir), path)
+            subdir_path = os.path.join(root, subdir)
+            if content_index.get(subdir_path) != DIRECTORY_ENTRY:
+                changed.append(subdir_path)
+            # Directory that replaced a file is created after the delete of the file
+            if content_index.get(subdir_path) in (None, DIRECTORY_ENTRY):
+                found.add(subdir_path)
+        for file in files:
+            file_path = os.path.join(root, file)
+            if file_path.endswith(TEMP_PATTERN) or Handler.IGNORE_PATTERN in file:
+                continue
+            if content_index.get(file_path) != DIRECTORY_ENTRY:
+                found.add(file_path)
+            try:
+                stat = os.stat(file_path)
+                if content_index.unchanged_hash(file_path, stat) is not None:
+                    continue
+                entry = content_index.get(file_path)
+                _, content_hash = file_size_and_hash(file_path)
+            except (FileNotFoundError, PermissionError):
+                continue
+            # File was only touched
+            if entry and entry[2] == content_hash:
+                content_index.set(file_path, stat, content_hash)
+            else:
+                changed.append(file_path)
+
+    deleted = set(path for path in content_index.paths() if path not in found)
+    # Paths under deleted directory are deleted with it
+    return changed, sorted(path for path in deleted if os.path.dirname(path) not in deleted)
+
+
+# Send the changes made in base_path while the client was stopped, before the pull can undo them
+# Changed files are sent whole, so the server has them before it compares our manifest
+def push_offline_changes(identifier, s, base_path):
+    changed, deleted = offline_changes(base_path)
+    for deleted_path in deleted:
+        is_directory = content_index.get(deleted_path) == DIRECTORY_ENTRY
+        send_delete_message(s, identifier, base_path, deleted_path, int(is_directory))
+    for changed_path in changed:
+        push_file_to_server(identifier, s, changed_path, base_path)
+    # Big files are uploaded in chunks only after the server answered, and they must arrive before the manifest
+    wait_upload_offsets(identifier, s, base_path)
+    return bool(changed or deleted)
 
 
 def first_connected_to_server(identifier, s, path):
+    global server_features
     if identifier:
-        # If we accept identifier from command line, we remove the local path directory and get all files from server
-        delete_recursive(path)
-        pull_all_from_server(identifier, s, path)
+        # Without our directory there are no offline changes, the server copy is pulled as in the first run
+        has_state = content_index.load(path, identifier) and os.path.isdir(path)
+        server_features = negotiate_features(identifier, s)
+        is_changed = True
+        if has_state:
+            is_changed = push_offline_changes(identifier, s, path)
+        else:
+            content_index.remove(path)
+        # Server changes we missed are older than our offline changes, so we resume only if we have none
+        if server_features and not is_changed and resume_from_server(identifier, s, path):
+            return identifier
+        if server_features and server_features & FEATURE_MANIFEST_PULL:
+            # If we accept identifier from command line, we get from server only the changes from our local directory
+            os.makedirs(path, exist_ok=True)
+            pull_changes_from_server(identifier, s, path)
+        else:
+            # Server can't compare, so we remove the local path directory and get all files from server
+            delete_recursive(path)
+            pull_all_from_server(identifier, s, path)
+        # Server directory may be empty, but we need our directory to watch it
+        os.makedirs(path, exist_ok=True)
         return identifier
     else:
         # If we dont accepted identifier from command line, we got one from the server and push all files to server
         identifier = get_identifier_from_server(s)
-        push_all_to_server(identifier, s, path)
+        content_index.load(path, identifier)
+        failed = parallel_push_all_to_server(identifier, s, path) if UPLOAD_CONNECTIONS > 1 else None
+        if failed is None:
+            server_features = negotiate_features(identifier, s)
+            push_all_to_server(identifier, s, path)
+            return identifier
+
+        # Main connection enables features only after the upload, so the uploaded files are not pushed back to it
+        if session is None:
+            server_features = negotiate_features(identifier, s)
+        for file_path in failed:
+            push_file_to_server(identifier, s, file_path, path)
         return identifier
 
 
@@ -229,8 +1109,8 @@ def get_identifier_from_server(s):
     is_identifier = 0
     is_identifier = is_identifier.to_bytes(1, 'little')
     data = is_identifier
-    s.sendall(data)
-    return s.recv(128).decode('utf-8')
+    send_to_server(s, data)
+    return reader.read_string(128)
 
 
 # Send create message for update
@@ -240,96 +1120,481 @@ def send_create_message(client_socket, identifier, base_path, src_path, is_direc
 
 # Send delete message for update
 def send_delete_message(client_socket, identifier, base_path, file_path, is_directory):
-    is_identifier = int(1).to_bytes(1, 'little')
-    identifier = identifier.encode('utf-8')
-    delete = DELETE_COMMAND.to_bytes(1, 'little')
     # Append listening directory name with file path
     sent_file_path = os.path.relpath(file_path, base_path)
-    path_size = len(sent_file_path).to_bytes(4, 'little')
-    is_directory = is_directory.to_bytes(1, 'little')
-
-    packet = is_identifier + identifier + delete + is_directory + path_size + sent_file_path.encode('utf-8')
-    client_socket.sendall(packet)
+    send_to_server(client_socket, command_header(identifier, DELETE_COMMAND, is_directory, sent_file_path))
+    content_index.remove(file_path)
 
 
 def send_modify_message(client_socket, identifier, base_path, file_path, is_directory):
-    is_identifier = int(1).to_bytes(1, 'little')
-    identifier = identifier.encode('utf-8')
-    modify = MODIFY_COMMAND.to_bytes(1, 'little')
-    # Append listening directory name with file path
-    sent_file_path = os.path.relpath(file_path, base_path)
-    path_size = len(sent_file_path).to_bytes(4, 'little')
-    is_directory = is_directory.to_bytes(1, 'little')
-
     # If file doesn't exists, return
     if not os.path.isfile(file_path):
         return
 
-    try:
-        with open(file_path, 'rb') as f:
-            data = f.read()
-    except PermissionError:
+    # Big files are sent as delta from the server copy, first we need its signatures
+    if server_features and server_features & FEATURE_DELTA and os.path.getsize(file_path) >= DELTA_MIN_SIZE:
+        request_signatures(client_socket, identifier, base_path, file_path)
         return
 
-    data_size = len(data).to_bytes(4, 'little')
-    packet = is_identifier + identifier + modify + is_directory + path_size + sent_file_path.encode('utf-8') \
-             + data_size + data
-
-    client_socket.sendall(packet)
+    # Append listening directory name with file path
+    sent_file_path = os.path.relpath(file_path, base_path)
+    header = command_header(identifier, MODIFY_COMMAND, is_directory, sent_file_path)
+    sent = send_file_to_server(client_socket, header, file_path)
+    if sent:
+        content_index.set(file_path, *sent)
 
 
 def send_move_message(client_socket, identifier, base_path, src_path, dest_path, is_directory):
-    is_identifier = int(1).to_bytes(1, 'little')
-    identifier = identifier.encode('utf-8')
-    move = MOVE_COMMAND.to_bytes(1, 'little')
     # Append listening directory name with file path
     sent_src_file_path = os.path.relpath(src_path, base_path)
-    src_path_size = len(sent_src_file_path).to_bytes(4, 'little')
-    sent_dest_file_path = os.path.relpath(dest_path, base_path)
-    dest_path_size = len(sent_dest_file_path).to_bytes(4, 'little')
-    is_directory = is_directory.to_bytes(1, 'little')
+    sent_dest_file_path = os.path.relpath(dest_path, base_path).encode('utf-8')
+    packet = command_header(identifier, MOVE_COMMAND, is_directory, sent_src_file_path) \
+             + len(sent_dest_file_path).to_bytes(4, 'little') + sent_dest_file_path
+
+    send_to_server(client_socket, packet)
+    content_index.move(src_path, dest_path)
 
-    packet = is_identifier + identifier + move + is_directory + src_path_size + sent_src_file_path.encode('utf-8') \
-             + dest_path_size + sent_dest_file_path.encode('utf-8')
 
-    client_socket.sendall(packet)
+# Changes of one path that were not sent yet
+class PendingChange:
+    def __init__(self, now):
+        # Path was deleted, so the server copy has to be deleted, and if it was directory
+        self.is_deleted = False
+        self.was_directory = False
+        # CREATE_COMMAND or MODIFY_COMMAND if the path content has to be sent, None if not
+        self.command = None
+        self.first_time = now
+        self.last_time = now
+
+
+# Join the watchdog events of each path until it stops changing for COALESCE_WINDOW, and then send one change for all
+# of them. The content is read only when the change is sent, so many modifies of one file are one upload
+class EventCoalescer:
+    def __init__(self, base_path, client_socket, identifier):
+        self.base_path = base_path
+        self.client_socket = client_socket
+        self.identifier = identifier
+        # Pending changes by path, in the order of their first event
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def change(self, path):
+        now = time.monotonic()
+        change = self.pending.get(path)
+        if change is None:
+            change = self.pending[path] = PendingChange(now)
+        change.last_time = now
+        self.condition.notify()
+        return change
+
+    def paths_under(self, path):
+        return [pending_path for pending_path in self.pending if pending_path.startswith(path + os.sep)]
+
+    # Return if parent directory of path is deleted, then the delete of the parent removes path too
+    def is_parent_deleted(self, path):
+        parent = os.path.dirname(path)
+        while len(parent) > len(self.base_path):
+            change = self.pending.get(parent)
+            if change and change.is_deleted and change.command is None:
+                return True
+            parent = os.path.dirname(parent)
+        return False
+
+    def created(self, path):
+        with self.condition:
+            self.change(path).command = CREATE_COMMAND
+
+    def modified(self, path):
+        with self.condition:
+            change = self.change(path)
+            if change.command is None:
+                # Deleted path that is modified was created again
+                change.command = CREATE_COMMAND if change.is_deleted else MODIFY_COMMAND
+
+    # Create and then delete of path the server never got is nothing, other deletes cancel the pending content
+    def deleted(self, path, is_directory):
+        with self.condition:
+            if self.is_parent_deleted(path):
+                return
+            # Deletes of directory children are merged into the delete of the directory
+            if is_directory:
+                for child in self.paths_under(path):
+                    del self.pending[child]
+            change = self.pending.get(path)
+            if change and change.command == CREATE_COMMAND and content_index.get(path) is None:
+                del self.pending[path]
+                return
+            change = self.change(path)
+            if not change.is_deleted:
+                change.is_deleted = True
+                change.was_directory = is_directory
+            change.command = None
+
+    # Move is sent after all the changes before it, and pending changes of the moved paths move with them
+    def moved(self, src_path, dest_path, is_directory):
+        with self.condition:
+            moved_changes = self.take_moved(src_path)
+            self.send_all()
+            send_move_message(self.client_socket, self.identifier, self.base_path, src_path, dest_path, is_directory)
+            self.put_moved(moved_changes, src_path, dest_path)
+            self.condition.notify()
+
+    # Server moved src_path, so pending changes of the moved paths move with them without sending the move
+    def move_pending(self, src_path, dest_path):
+        with self.condition:
+            self.put_moved(self.take_moved(src_path), src_path, dest_path)
+
+    def take_moved(self, src_path):
+        return {path: self.pending.pop(path) for path in [src_path] + self.paths_under(src_path)
+                if path in self.pending}
+
+    def put_moved(self, moved_changes, src_path, dest_path):
+        for path, change in moved_changes.items():
+            self.pending[dest_path + path[len(src_path):]] = change
+
+    # Deleted file we know the content of waits RENAME_WINDOW, so a create of the same content can still find it
+    def deadline(self, path, change):
+        deadline = min(change.last_time + COALESCE_WINDOW, change.first_time + COALESCE_MAX_DELAY)
+        if self.is_rename_source(path, change):
+            deadline = max(deadline, change.last_time + RENAME_WINDOW)
+        return deadline
+
+    def is_rename_source(self, path, change):
+        return RENAME_WINDOW > 0 and change.is_deleted and change.command is None and not change.was_directory \
+               and content_index.get(path) is not None
+
+    # Created file with the content of a pending deleted file is the same file renamed, so we send move of the deleted
+    # file instead of the content. Return if the move was sent
+    def send_renamed(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        sources = [(pending_path, content_index.get(pending_path)) for pending_path, change in self.pending.items()
+                   if self.is_rename_source(pending_path, change)]
+        sources = [(source, entry) for source, entry in sources if entry and entry[0] == stat.st_size]
+        if not sources or not os.path.isfile(path):
+            return False
+        try:
+            _, content_hash = file_size_and_hash(path)
+        except (FileNotFoundError, PermissionError):
+            return False
+        for source, entry in sources:
+            if entry[2] == content_hash and not os.path.lexists(source):
+                del self.pending[source]
+                send_move_message(self.client_socket, self.identifier, self.base_path, source, path, False)
+                content_index.set(path, stat, content_hash)
+                return True
+        return False
+
+    def send(self, path, change):
+        if change.command == CREATE_COMMAND and not change.is_deleted and self.send_renamed(path):
+            return
+        # File that replaced a file doesn't need the delete, the new content replaces the old one on server
+        if change.is_deleted and (change.command is None or change.was_directory or not os.path.isfile(path)):
+            send_delete_message(self.client_socket, self.identifier, self.base_path, path, change.was_directory)
+        if change.command == CREATE_COMMAND:
+            send_create_message(self.client_socket, self.identifier, self.base_path, path, os.path.isdir(path))
+        elif change.command == MODIFY_COMMAND:
+            send_modify_message(self.client_socket, self.identifier, self.base_path, path, False)
+
+    def send_all(self):
+        while self.pending:
+            path = next(iter(self.pending))
+            self.send(path, self.pending.pop(path))
+
+    # Send the changes that stopped changing, changes are sent under the lock so they keep the order of the events
+    def run(self):
+        with self.condition:
+            try:
+                while not self.stopped:
+                    now = time.monotonic()
+                    ready = [path for path, change in self.pending.items() if now >= self.deadline(path, change)]
+                    for path in ready:
+                        # Delete that was sent as part of a move is not pending anymore
+                        change = self.pending.pop(path, None)
+                        if change:
+                            self.send(path, change)
+                    timeout = None
+                    if self.pending:
+                        timeout = min(self.deadline(path, change) for path, change in self.pending.items()) - now
+                    self.condition.wait(timeout)
+            except (OSError, ClientDisconnectedException):
+                # Server disconnected, the main thread finds it out too and stops
+                self.stopped = True
+
+    # Send what is still pending and stop the thread
+    def stop(self):
+        with self.condition:
+            try:
+                if not self.stopped:
+                    self.send_all()
+            except (OSError, ClientDisconnectedException):
+                pass
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+
+# Changes we applied from the server, so the watchdog events they cause are not sent back to the server
+# Each path keeps what we left there: file stat and content hash, directory, or removed path. Event of path that is
+# still in the state we left it in is ours, any other event is a change of the user
+class AppliedChanges:
+    def __init__(self):
+        # Time and state by path, in the order they were added
+        self.entries = {}
+        # Time and destination by source path of the moves
+        self.moves = {}
+        self.lock = threading.Lock()
+
+    def add(self, entries, path, state):
+        now = time.monotonic()
+        with self.lock:
+            entries.pop(path, None)
+            entries[path] = (now, state)
+            # Oldest entries are first, so they are removed until one is not older than APPLIED_WINDOW
+            while True:
+                oldest = next(iter(entries))
+                if now - entries[oldest][0] <= APPLIED_WINDOW:
+                    break
+                del entries[oldest]
+
+    def get(self, entries, path):
+        with self.lock:
+            entry = entries.get(path)
+        if entry is None or time.monotonic() - entry[0] > APPLIED_WINDOW:
+            return None
+        return entry[1]
+
+    def add_file(self, path, stat, content_hash):
+        self.add(self.entries, path, (stat.st_size, stat.st_mtime_ns, content_hash))
+
+    def add_directory(self, path):
+        self.add(self.entries, path, APPLIED_DIRECTORY)
+
+    def add_removed(self, path):
+        self.add(self.entries, path, APPLIED_REMOVED)
+
+    def add_move(self, src_path, dst_path):
+        self.add(self.moves, src_path, dst_path)
+        self.add_removed(src_path)
+
+    # Return if created or modified event of path is ours
+    def is_written(self, path):
+        state = self.get(self.entries, path)
+        if state is None or state == APPLIED_REMOVED:
+            return False
+        if state == APPLIED_DIRECTORY:
+            return os.path.isdir(path)
+        size, mtime_ns, content_hash = state
+        try:
+            stat = os.stat(path)
+            if stat.st_size != size:
+                return False
+            # Same modification time means the file was not written since, so we don't read it
+            return stat.st_mtime_ns == mtime_ns or file_size_and_hash(path)[1] == content_hash
+        except (FileNotFoundError, PermissionError):
+            return False
+
+    def is_removed(self, path):
+        return self.get(self.entries, path) == APPLIED_REMOVED and not os.path.lexists(path)
+
+    # Move of directory comes with moves of all the paths under it
+    def is_moved(self, src_path, dest_path):
+        parent = src_path
+        while True:
+            moved_path = self.get(self.moves, parent)
+            if moved_path is not None:
+                return dest_path == moved_path + src_path[len(parent):]
+            if os.path.dirname(parent) == parent:
+                return False
+            parent = os.path.dirname(parent)
+
+
+applied = AppliedChanges()
+
+
+def read_state_record(f):
+    return record_log.read_path_record(f, STATE_PAYLOAD_SIZES)
+
+
+# Size, modification time and content hash of the files the server has the same copy of, and its directories, by
+# their path. Deleted file is found here by its content when it is created again with another name
+# The index is kept in the state file of the watched directory, so the next run finds the changes made while the
+# client was stopped. Like the server file index, the state file is a record log that is rewritten when it grows
+class ContentIndex:
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+        # Watched directory and the record log of its state file, None until the index is loaded
+        self.base_path = None
+        self.log = None
+        # Last cursor the server sent us (server run epoch and sequence number), None if we have none
+        self.cursor = None
+
+    # Load the state of base_path synced with identifier, return if the client ran there before
+    def load(self, base_path, identifier):
+        os.makedirs(STATE_DIRECTORY, exist_ok=True)
+        name = hashlib.sha256(f'{base_path}\0{identifier}'.encode('utf-8')).hexdigest()
+        with self.lock:
+            self.base_path = base_path
+            self.log = record_log.RecordLog(os.path.join(STATE_DIRECTORY, name))
+            exists = os.path.isfile(self.log.path)
+            for record_type, path, payload in self.log.load(read_state_record):
+                path = os.path.join(self.base_path, path)
+                if record_type == STATE_FILE:
+                    self.entries[path] = record_log.FILE_ENTRY.unpack(payload)
+                elif record_type == STATE_DIRECTORY_ENTRY:
+                    self.entries[path] = DIRECTORY_ENTRY
+                elif record_type == STATE_CURSOR:
+                    self.cursor = protocol.CURSOR.unpack(payload)
+                else:
+                    self.entries.pop(path, None)
+            self.flush()
+        return exists
+
+    # Return the record of path with entry, or of its removal if entry is None
+    def entry_record(self, path, entry):
+        path = os.path.relpath(path, self.base_path)
+        if entry is None:
+            return record_log.path_record(STATE_REMOVE, path)
+        if entry == DIRECTORY_ENTRY:
+            return record_log.path_record(STATE_DIRECTORY_ENTRY, path)
+        return record_log.path_record(STATE_FILE, path, record_log.FILE_ENTRY.pack(*entry))
+
+    def cursor_record(self):
+        return record_log.path_record(STATE_CURSOR, '', protocol.CURSOR.pack(*self.cursor))
+
+    def write_record(self, path, entry):
+        if self.log is not None:
+            self.log.append(self.entry_record(path, entry))
+
+    # Write the pending records, called once after each change under the lock
+    def flush(self):
+        if self.log is None:
+            return
+        if self.log.is_bloated(len(self.entries)):
+            self.log.compact(self.state_records())
+        self.log.flush()
+
+    # Return generator of the records of all the state, one for each path and one for the cursor
+    def state_records(self):
+        for path, entry in self.entries.items():
+            yield self.entry_record(path, entry)
+        if self.cursor is not None:
+            yield self.cursor_record()
+
+    def put(self, path, entry):
+        # Parents of the watched directory that the first pull created are not ours
+        if self.base_path and not path.startswith(self.base_path + os.sep):
+            return
+        with self.lock:
+            self.entries[path] = entry
+            self.write_record(path, entry)
+            self.flush()
+
+    def set_cursor(self, cursor):
+        with self.lock:
+            self.cursor = cursor
+            if self.log is not None:
+                self.log.append(self.cursor_record())
+                self.flush()
+
+    def set(self, path, stat, content_hash):
+        self.put(path, (stat.st_size, stat.st_mtime_ns, content_hash))
+
+    def add_directory(self, path):
+        self.put(path, DIRECTORY_ENTRY)
+
+    def get(self, path):
+        with self.lock:
+            return self.entries.get(path)
+
+    def paths(self):
+        with self.lock:
+            return list(self.entries)
+
+    # Return content hash of file with stat if it didn't change since it was indexed, None if it did
+    def unchanged_hash(self, path, stat):
+        entry = self.get(path)
+        if entry and entry != DIRECTORY_ENTRY and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            return entry[2]
+        return None
+
+    # Remove path and all paths under it
+    def remove(self, path):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.write_record(path, None)
+            # File has nothing under it
+            if entry is None or entry == DIRECTORY_ENTRY:
+                for child in [child for child in self.entries if child.startswith(path + os.sep)]:
+                    del self.entries[child]
+                    self.write_record(child, None)
+            self.flush()
+
+    def move(self, src_path, dst_path):
+        with self.lock:
+            moved = [path for path in self.entries if path == src_path or path.startswith(src_path + os.sep)]
+            for path in moved:
+                entry = self.entries.pop(path)
+                self.write_record(path, None)
+                self.entries[dst_path + path[len(src_path):]] = entry
+                self.write_record(dst_path + path[len(src_path):], entry)
+            self.flush()
+
+
+content_index = ContentIndex()
 
 
 class Handler(PatternMatchingEventHandler):
     # Linux OS create temp file with this name when modify file, so we ignore events with this file name
+    # We do the same with TEMP_PATTERN when we rebuild file from delta
     IGNORE_PATTERN = ".goutputstream"
 
     def __init__(self, base_path, client_socket, identifier):
-        super(Handler, self).__init__(ignore_patterns=[f'*{Handler.IGNORE_PATTERN}*'])
+        super(Handler, self).__init__(ignore_patterns=[f'*{Handler.IGNORE_PATTERN}*', f'*{TEMP_PATTERN}'])
         self.base_path = base_path
         self.client_socket = client_socket
         self.identifier = identifier
 
+    # Events of the changes we applied from the server are ignored, so they are not sent back to it
     def on_created(self, event):
-        send_create_message(self.client_socket, self.identifier, self.base_path, event.src_path,
-                            os.path.isdir(event.src_path))
+        if applied.is_written(event.src_path):
+            return
+        coalescer.created(event.src_path)
 
     def on_deleted(self, event):
-        send_delete_message(self.client_socket, self.identifier, self.base_path, event.src_path,
-                            os.path.isdir(event.src_path))
+        if applied.is_removed(event.src_path):
+            return
+        coalescer.deleted(event.src_path, event.is_directory)
 
     def on_modified(self, event):
         # If we got modified event on directory we ignore (Windows OS)
-        if os.path.isdir(event.src_path):
+        if os.path.isdir(event.src_path) or applied.is_written(event.src_path):
             return
 
-        send_modify_message(self.client_socket, self.identifier, self.base_path, event.src_path,
-                            os.path.isdir(event.src_path))
+        coalescer.modified(event.src_path)
 
     def on_moved(self, event):
         # If src_path is IGNORE_PATTERN it means that the file event.dest_path is just modified, so we send modify event
         # And we ignore the src_path because this is temp file
-        if Handler.IGNORE_PATTERN in event.src_path:
-            send_modify_message(self.client_socket, self.identifier, self.base_path, event.dest_path,
-                                os.path.isdir(event.dest_path))
+        if Handler.IGNORE_PATTERN in event.src_path or event.src_path.endswith(TEMP_PATTERN):
+            if not applied.is_written(event.dest_path):
+                coalescer.modified(event.dest_path)
+        elif applied.is_moved(event.src_path, event.dest_path):
+            return
         else:
-            send_move_message(self.client_socket, self.identifier, self.base_path, event.src_path, event.dest_path,
-                              os.path.isdir(event.dest_path))
+            coalescer.moved(event.src_path, event.dest_path, os.path.isdir(event.dest_path))
+            # Delta we wanted to send for the old path must be sent now for the new path
+            for moved_path in move_pending_paths(pending_uploads, event.src_path, event.dest_path):
+                request_signatures(self.client_socket, self.identifier, self.base_path, moved_path)
+            for moved_path in move_pending_paths(pending_resumes, event.src_path, event.dest_path):
+                request_upload_offset(self.client_socket, self.identifier, self.base_path, moved_path)
 
 
 def check_port(n):
@@ -375,12 +1640,15 @@ if __name__ == "__main__":
     port_num = int(port_num)
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((ip, port_num))
+    reader = protocol.FrameReader(s)
 
     try:
         identifier = first_connected_to_server(identifier, s, path)
         start_watchdog(path, s, identifier)
+        if server_features is not None:
+            receive_updates_from_server(identifier, s, path, time_series)
         while True:
-            # Set the thread sleep time
+            # Server doesn't support features, so we poll it: set the thread sleep time
             time.sleep(time_series)
             pull_updates_from_server(identifier, s, path)
     except (KeyboardInterrupt, ClientDisconnectedException):
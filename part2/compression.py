@@ -0,0 +1,183 @@
+import lzma
+import os
+import queue
+import threading
+import zlib
+
+from protocol import ClientDisconnectedException
+
+# Encoding of file content, sent in one byte after the file size by sides that enabled compression
+ENCODING_RAW = 0
+ENCODING_ZLIB = 1
+ENCODING_LZMA = 2
+ENCODINGS = {'zlib': ENCODING_ZLIB, 'lzma': ENCODING_LZMA}
+
+# File is compressed in chunks of this size, each compressed part is sent as frame: size (4 bytes) and data
+# Frame of size 0 ends the file
+CHUNK_SIZE = 256 * 1024
+ZLIB_LEVEL = 6
+# Start of the file is compressed first, if it doesn't get smaller by MIN_SAVING the file is sent raw
+# Already compressed files (images, archives, video) are found this way without reading all of them
+SAMPLE_SIZE = 16 * 1024
+MIN_SAVING = 0.1
+# Smaller files are always sent raw, the frames would take more than compression saves
+MIN_SIZE = 512
+# Chunks compressed by the worker thread ahead of the socket
+WORKER_CHUNKS = 4
+# Raised by the decompressors for data that isn't valid in its encoding
+DECOMPRESS_ERRORS = (zlib.error, lzma.LZMAError)
+
+
+def read_at(f, offset, size):
+    if hasattr(os, 'pread'):
+        return os.pread(f.fileno(), size, offset)
+    f.seek(offset)
+    return f.read(size)
+
+
+def compressor(encoding):
+    return lzma.LZMACompressor() if encoding == ENCODING_LZMA else zlib.compressobj(ZLIB_LEVEL)
+
+
+def decompressor(encoding):
+    return lzma.LZMADecompressor() if encoding == ENCODING_LZMA else zlib.decompressobj()
+
+
+# Return the encoding the file of size is sent with, encoding if its sample gets smaller and ENCODING_RAW if not
+def choose_encoding(f, size, encoding):
+    if encoding == ENCODING_RAW or size < MIN_SIZE:
+        return ENCODING_RAW
+    sample = read_at(f, 0, min(size, SAMPLE_SIZE))
+    if len(zlib.compress(sample, 1)) > len(sample) * (1 - MIN_SAVING):
+        return ENCODING_RAW
+    return encoding
+
+
+def frame(data):
+    return len(data).to_bytes(4, 'little') + data
+
+
+# Return generator of the frames of file compressed with encoding, exactly size bytes of the file from offset are
+# compressed. If the file got shorter meanwhile it is filled with zeros, the event of this change will fix it
+# If sha256 is given it is updated with the content as it is read
+def compressed_frames(f, size, encoding, offset=0, sha256=None):
+    compress = compressor(encoding)
+    end = offset + size
+    while offset < end:
+        chunk = read_at(f, offset, min(end - offset, CHUNK_SIZE))
+        if not chunk:
+            chunk = bytes(min(end - offset, CHUNK_SIZE))
+        if sha256:
+            sha256.update(chunk)
+        offset += len(chunk)
+        data = compress.compress(chunk)
+        if data:
+            yield frame(data)
+    data = compress.flush()
+    if data:
+        yield frame(data)
+    yield frame(b'')
+
+
+# Return all the frames of small file data at once
+def compress_data(data, encoding):
+    compress = compressor(encoding)
+    return frame(compress.compress(data) + compress.flush()) + frame(b'')
+
+
+# Each chunk of resumable upload is compressed alone, so the upload can continue after any of them
+def compress_chunk(data, encoding):
+    compress = compressor(encoding)
+    return compress.compress(data) + compress.flush()
+
+
+# Return the content of chunk, the other side promised size bytes
+def decompress_chunk(data, encoding, size):
+    content = bytearray()
+    decoder = Decoder(encoding, size, content.extend)
+    decoder.write(data)
+    decoder.close()
+    return content
+
+
+# Decompress the data of frames as they arrive and pass it to write, the other side promised size bytes
+class Decoder:
+    def __init__(self, encoding, size, write):
+        self.decompress = decompressor(encoding)
+        self.size = size
+        self.written = 0
+        self.output = write
+
+    # Data is decompressed in parts of at most CHUNK_SIZE, so a small frame can't take all our memory
+    # Corrupt data is of broken other side like any other protocol error
+    def write(self, data):
+        while True:
+            try:
+                output = self.decompress.decompress(data, CHUNK_SIZE)
+            except DECOMPRESS_ERRORS:
+                raise ClientDisconnectedException()
+            self.write_output(output)
+            if isinstance(self.decompress, lzma.LZMADecompressor):
+                if self.decompress.needs_input or self.decompress.eof:
+                    return
+                data = b''
+            else:
+                data = self.decompress.unconsumed_tail
+                if not data:
+                    return
+
+    def write_output(self, data):
+        self.written += len(data)
+        # The other side can't send more than it promised
+        if self.written > self.size:
+            raise ClientDisconnectedException()
+        self.output(data)
+
+    # Called after the end frame
+    def close(self):
+        if not isinstance(self.decompress, lzma.LZMADecompressor):
+            try:
+                output = self.decompress.flush()
+            except DECOMPRESS_ERRORS:
+                raise ClientDisconnectedException()
+            self.write_output(output)
+        if self.written != self.size:
+            raise ClientDisconnectedException()
+
+
+# Run generator of chunks in worker thread and return generator of its chunks, so compression runs while the previous
+# chunks are sent
+def threaded(chunks):
+    chunks_queue = queue.Queue(WORKER_CHUNKS)
+    # Set when the reader stopped before the end, so the worker thread doesn't wait for room forever
+    stopped = threading.Event()
+
+    def put(chunk):
+        while not stopped.is_set():
+            try:
+                chunks_queue.put(chunk, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            chunk = chunks_queue.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stopped.set()
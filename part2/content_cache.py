@@ -0,0 +1,67 @@
+import os
+import threading
+from collections import OrderedDict
+
+import compression
+
+# Contents we sent lately, so a file that many clients pull or get pushed is read and compressed once and the other
+# clients are served from memory. Entries are found by the content hash and the encoding, so a changed file never
+# gets the old content. Set SYNC_CACHE_SIZE=0 to read each file again for each client
+CACHE_SIZE = int(os.environ.get('SYNC_CACHE_SIZE', 64 * 1024 * 1024))
+# Bigger contents are not cached, raw big files are sent with sendfile from the page cache anyway
+MAX_ENTRY_SIZE = 4 * 1024 * 1024
+
+# Content by (content hash, encoding), the least recently used first
+entries = OrderedDict()
+size = 0
+hits = 0
+misses = 0
+# Cache is used by the event loop and by the read ahead threads
+lock = threading.Lock()
+
+
+# Return the content of content_hash in encoding, None if it is not in the cache
+def get(content_hash, encoding):
+    global hits, misses
+    if content_hash is None or not CACHE_SIZE:
+        return None
+    key = (content_hash, encoding)
+    with lock:
+        data = entries.get(key)
+        if data is None:
+            misses += 1
+            return None
+        entries.move_to_end(key)
+        hits += 1
+        return data
+
+
+def put(content_hash, encoding, data):
+    global size
+    if content_hash is None or len(data) > min(MAX_ENTRY_SIZE, CACHE_SIZE):
+        return
+    data = bytes(data)
+    key = (content_hash, encoding)
+    with lock:
+        old = entries.pop(key, None)
+        if old is not None:
+            size -= len(old)
+        entries[key] = data
+        size += len(data)
+        while size > CACHE_SIZE:
+            _, old = entries.popitem(last=False)
+            size -= len(old)
+
+
+# Remove content that no file has anymore, so it doesn't take the room of live contents
+def discard(content_hash):
+    global size
+    with lock:
+        for encoding in (compression.ENCODING_RAW, compression.ENCODING_ZLIB, compression.ENCODING_LZMA):
+            old = entries.pop((content_hash, encoding), None)
+            if old is not None:
+                size -= len(old)
+
+
+def gauges():
+    return {'cache_bytes': size, 'cache_entries': len(entries), 'cache_hits': hits, 'cache_misses': misses}
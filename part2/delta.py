@@ -0,0 +1,246 @@
+import hashlib
+import os
+import zlib
+
+# Files are compared in blocks of this size, each block has weak (rolling) and strong checksum
+BLOCK_SIZE = 8192
+# Literal data is sent in chunks of at most this size
+MAX_LITERAL_SIZE = 1024 * 1024
+# When MISS_CHECK_SIZE bytes in a row matched nothing and less than MIN_MATCHED_RATIO of the file so far matched blocks
+# of the base, the rest of the file is sent as literals. Looking for matches byte by byte costs more than sending a
+# file that was rewritten
+MISS_CHECK_SIZE = 128 * 1024
+MIN_MATCHED_RATIO = 0.25
+ADLER_MOD = 65521
+
+# Delta instructions
+DELTA_END = 0
+DELTA_COPY = 1
+DELTA_DATA = 2
+
+SIGNATURE_SIZE = 20
+# Whole file hash is sha256, the same hash the file indexes keep, so the base is checked without reading it
+HASH_SIZE = 32
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(MAX_LITERAL_SIZE), b''):
+                sha256.update(chunk)
+    return sha256.digest()
+
+
+# Return generator of the signatures of path in chunks: block size, blocks count, file size, signature of each
+# block and file hash. A missing file has the signatures of an empty file
+def file_signatures(path):
+    f = open(path, 'rb') if os.path.isfile(path) else None
+    return _file_signatures(f)
+
+
+def _file_signatures(f):
+    file_size = os.fstat(f.fileno()).st_size if f else 0
+    count = (file_size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    yield BLOCK_SIZE.to_bytes(4, 'little') + count.to_bytes(4, 'little') + file_size.to_bytes(8, 'little')
+
+    sha256 = hashlib.sha256()
+    if f:
+        with f:
+            signatures = bytearray()
+            # Read exactly count blocks, so the reader gets what we promised even if the file changes meanwhile
+            for _ in range(count):
+                block = f.read(BLOCK_SIZE)
+                sha256.update(block)
+                signatures += zlib.adler32(block).to_bytes(4, 'little') + hashlib.md5(block).digest()
+                if len(signatures) >= MAX_LITERAL_SIZE:
+                    yield bytes(signatures)
+                    signatures.clear()
+            yield bytes(signatures)
+    yield sha256.digest()
+
+
+# Build lookup table of weak checksum to list of (strong checksum, block index)
+# Signatures can be parsed in parts, each part is added to table and its first block is first_index
+def parse_signatures(data, table=None, first_index=0):
+    if table is None:
+        table = {}
+    for index in range(len(data) // SIGNATURE_SIZE):
+        offset = index * SIGNATURE_SIZE
+        weak = int.from_bytes(data[offset:offset + 4], 'little')
+        table.setdefault(weak, []).append((bytes(data[offset + 4:offset + SIGNATURE_SIZE]), first_index + index))
+    return table
+
+
+def encode_copy(start, count):
+    return DELTA_COPY.to_bytes(1, 'little') + start.to_bytes(4, 'little') + count.to_bytes(4, 'little')
+
+
+def encode_data(data):
+    return DELTA_DATA.to_bytes(1, 'little') + len(data).to_bytes(4, 'little') + data
+
+
+def find_block(table, block, weak):
+    candidates = table.get(weak)
+    if not candidates:
+        return None
+    strong = hashlib.md5(block).digest()
+    for candidate_strong, index in candidates:
+        if candidate_strong == strong:
+            return index
+    return None
+
+
+# Return generator of the encoded instructions that rebuild path from a file with the given signatures
+# The window rolls byte by byte only where blocks don't match, so appends and small edits cost only the changed bytes
+def delta_instructions(path, block_size, base_size, table):
+    return file_delta_instructions(open(path, 'rb'), block_size, base_size, table)
+
+
+# Same as delta_instructions for open file, the generator closes it
+def file_delta_instructions(f, block_size, base_size, table):
+    with f:
+        if table:
+            yield from _matched_instructions(f, block_size, base_size, table)
+        else:
+            # Nothing to match with, all the file is literal
+            for chunk in iter(lambda: f.read(MAX_LITERAL_SIZE), b''):
+                yield encode_data(chunk)
+    yield DELTA_END.to_bytes(1, 'little')
+
+
+def _matched_instructions(f, block_size, base_size, table):
+    # We keep in memory only the file part from the first literal byte not sent yet until the end of the window
+    buffer = b''
+    buffer_start = 0
+    is_eof = False
+    position = 0
+    literal_start = 0
+    # Consecutive matched blocks are merged to one copy instruction
+    copy_start = copy_count = 0
+    matched_size = 0
+    a = b = None
+
+    while True:
+        offset = position - buffer_start
+        if offset + block_size >= len(buffer) and not is_eof:
+            chunk = f.read(MAX_LITERAL_SIZE)
+            is_eof = not chunk
+            buffer = buffer[literal_start - buffer_start:] + chunk
+            buffer_start = literal_start
+            continue
+        if offset + block_size > len(buffer):
+            break
+
+        if a is None:
+            weak = zlib.adler32(buffer[offset:offset + block_size])
+            a, b = weak & 0xffff, weak >> 16
+        index = find_block(table, buffer[offset:offset + block_size], (b << 16) | a)
+        if index is not None:
+            if literal_start < position:
+                if copy_count:
+                    yield encode_copy(copy_start, copy_count)
+                    copy_count = 0
+                yield encode_data(buffer[literal_start - buffer_start:offset])
+            if copy_count and copy_start + copy_count == index:
+                copy_count += 1
+            else:
+                if copy_count:
+                    yield encode_copy(copy_start, copy_count)
+                copy_start, copy_count = index, 1
+            position += block_size
+            matched_size += block_size
+            literal_start = position
+            a = None
+            continue
+
+        # Roll the window one byte forward
+        if offset + block_size < len(buffer):
+            out_byte, in_byte = buffer[offset], buffer[offset + block_size]
+            a = (a - out_byte + in_byte) % ADLER_MOD
+            b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+        position += 1
+        literal_size = position - literal_start
+        # Few blocks matched so far, the literal and the rest of the file are sent as they are
+        if literal_size >= MISS_CHECK_SIZE and matched_size < position * MIN_MATCHED_RATIO:
+            if copy_count:
+                yield encode_copy(copy_start, copy_count)
+            data = buffer[literal_start - buffer_start:]
+            for start in range(0, len(data), MAX_LITERAL_SIZE):
+                yield encode_data(data[start:start + MAX_LITERAL_SIZE])
+            for chunk in iter(lambda: f.read(MAX_LITERAL_SIZE), b''):
+                yield encode_data(chunk)
+            return
+        if literal_size >= MAX_LITERAL_SIZE:
+            if copy_count:
+                yield encode_copy(copy_start, copy_count)
+                copy_count = 0
+            yield encode_data(buffer[literal_start - buffer_start:offset + 1])
+            literal_start = position
+
+    # Here the buffer holds the file from literal_start to its end
+    data_size = buffer_start + len(buffer)
+    # The last block of the base file may be shorter than block size, it can match only the tail of the file
+    tail_size = base_size % block_size
+    if tail_size and data_size - literal_start >= tail_size:
+        tail = buffer[len(buffer) - tail_size:]
+        index = find_block(table, tail, zlib.adler32(tail))
+        if index == base_size // block_size:
+            if literal_start < data_size - tail_size:
+                if copy_count:
+                    yield encode_copy(copy_start, copy_count)
+                    copy_count = 0
+                yield encode_data(buffer[literal_start - buffer_start:len(buffer) - tail_size])
+            if copy_count and copy_start + copy_count == index:
+                copy_count += 1
+            else:
+                if copy_count:
+                    yield encode_copy(copy_start, copy_count)
+                copy_start, copy_count = index, 1
+            literal_start = data_size
+
+    if copy_count:
+        yield encode_copy(copy_start, copy_count)
+    if literal_start < data_size:
+        yield encode_data(buffer[literal_start - buffer_start:])
+
+
+# Copy count blocks from base file (opened) to out file, starting at block start
+def copy_blocks(base_file, out_file, start, count, block_size):
+    base_file.seek(start * block_size)
+    remaining = count * block_size
+    while remaining > 0:
+        chunk = base_file.read(min(remaining, MAX_LITERAL_SIZE))
+        if not chunk:
+            break
+        out_file.write(chunk)
+        remaining -= len(chunk)
+
+
+# File writer that also calculates the sha256 of all written data
+class HashingWriter:
+    def __init__(self, f):
+        self.file = f
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.file.write(data)
+
+
+# File reader that also calculates the sha256 of all read data, the file is read in order from its start
+class HashingReader:
+    def __init__(self, f):
+        self.file = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size):
+        data = self.file.read(size)
+        self.sha256.update(data)
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
@@ -0,0 +1,132 @@
+import os
+import threading
+
+import blobs
+import record_log
+
+# Index of each identifier files is kept here in a file named by the identifier
+# The index file is a record log, each change appends a record and the file is rewritten only when it grows
+INDEXES_DIRECTORY = 'indexes'
+
+# Index records
+RECORD_SET = 1
+RECORD_REMOVE = 2
+RECORD_PAYLOAD_SIZES = {RECORD_SET: record_log.FILE_ENTRY.size}
+
+# Loaded indexes by identifier
+indexes = {}
+# Indexes are read also by the pull read ahead threads
+lock = threading.RLock()
+
+
+def read_record(f):
+    return record_log.read_path_record(f, RECORD_PAYLOAD_SIZES)
+
+
+# Size, modification time and content hash of all files of one identifier, by their path relative to the identifier
+class FileIndex:
+    def __init__(self, identifier):
+        self.identifier = identifier
+        os.makedirs(INDEXES_DIRECTORY, exist_ok=True)
+        self.log = record_log.RecordLog(os.path.join(INDEXES_DIRECTORY, identifier))
+        self.entries = {}
+        for record_type, path, payload in self.log.load(read_record):
+            if record_type == RECORD_SET:
+                self.entries[path] = record_log.FILE_ENTRY.unpack(payload)
+            else:
+                self.entries.pop(path, None)
+        if self.log.is_bloated(len(self.entries)):
+            self.compact()
+
+    # Write the pending records, called once after each command
+    def flush(self):
+        self.log.flush()
+        if self.log.is_bloated(len(self.entries)):
+            self.compact()
+
+    # Rewrite the index file with one record for each file
+    def compact(self):
+        self.log.compact(record_log.path_record(RECORD_SET, path, record_log.FILE_ENTRY.pack(*entry))
+                         for path, entry in self.entries.items())
+
+    def close(self):
+        self.log.close()
+
+    def set(self, path, entry):
+        self.entries[path] = entry
+        self.log.append(record_log.path_record(RECORD_SET, path, record_log.FILE_ENTRY.pack(*entry)))
+
+    def remove(self, path):
+        if self.entries.pop(path, None):
+            self.log.append(record_log.path_record(RECORD_REMOVE, path))
+
+    # Paths of path and all files under it if it is a directory
+    def paths_under(self, path):
+        return [file for file in self.entries if file == path or file.startswith(path + os.sep)]
+
+
+def get_index(identifier):
+    with lock:
+        if identifier not in indexes:
+            indexes[identifier] = FileIndex(identifier)
+        return indexes[identifier]
+
+
+# Close the index of identifier without clients, it is loaded again when a client comes
+def evict(identifier):
+    with lock:
+        index = indexes.pop(identifier, None)
+        if index:
+            index.close()
+
+
+def relative_path(identifier, path):
+    return os.path.relpath(path, identifier)
+
+
+# Return content hash of file in identifier directory, from the index if the file didn't change since it was indexed
+def content_hash(identifier, path):
+    index = get_index(identifier)
+    stat = os.stat(path)
+    entry = index.entries.get(relative_path(identifier, path))
+    if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+        return entry[2]
+    # The file is read without the lock, so other threads don't wait for it
+    file_hash = blobs.content_hash(path)
+    # Index may have been evicted meanwhile, so it is taken again under the lock
+    with lock:
+        index = get_index(identifier)
+        index.set(relative_path(identifier, path), (stat.st_size, stat.st_mtime_ns, file_hash))
+        index.flush()
+    return file_hash
+
+
+# File was written with the given content hash
+def update(identifier, path, file_hash):
+    stat = os.stat(path)
+    with lock:
+        index = get_index(identifier)
+        index.set(relative_path(identifier, path), (stat.st_size, stat.st_mtime_ns, file_hash))
+        index.flush()
+
+
+# File or directory was removed
+def remove(identifier, path):
+    with lock:
+        index = get_index(identifier)
+        for file in index.paths_under(relative_path(identifier, path)):
+            index.remove(file)
+        index.flush()
+
+
+# File or directory was moved from src_path to dst_path
+def move(identifier, src_path, dst_path):
+    src_path = relative_path(identifier, src_path)
+    dst_path = relative_path(identifier, dst_path)
+    with lock:
+        index = get_index(identifier)
+        for file in index.paths_under(src_path):
+            entry = index.entries[file]
+            index.remove(file)
+            index.set(dst_path + file[len(src_path):], entry)
+        index.flush()
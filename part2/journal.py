@@ -0,0 +1,141 @@
+import os
+import random
+import time
+from bisect import bisect_right
+
+import record_log
+
+# Changes of each identifier are kept here in a directory named by the identifier, so clients get them also after the
+# server restarted. Each directory has segment files named by the sequence number of their first change
+JOURNALS_DIRECTORY = 'journals'
+# Epoch of the journals, cursors with other epoch point to journals we don't have
+EPOCH_PATH = os.path.join(JOURNALS_DIRECTORY, 'epoch')
+# Changes are appended to segment until it is bigger than this, and then a new segment starts
+SEGMENT_SIZE = 1024 * 1024
+# Changes are kept this many seconds after all connected clients got them, so disconnected clients can resume
+RESUME_WINDOW = 300
+# Max changes kept only for disconnected clients, older cursors can't resume and the client pulls again
+MAX_RESUME_CHANGES = 10000
+HASH_SIZE = 32
+
+epoch = None
+# Journals with changes that were appended but not synced to disk yet
+dirty_journals = set()
+
+
+# Load the epoch of the journals, or start new journals if we don't have one
+def load():
+    global epoch
+    os.makedirs(JOURNALS_DIRECTORY, exist_ok=True)
+    if os.path.isfile(EPOCH_PATH):
+        with open(EPOCH_PATH, 'rb') as f:
+            epoch = int.from_bytes(f.read(), 'little')
+        return
+    epoch = random.getrandbits(64)
+    with open(EPOCH_PATH + '.new', 'wb') as f:
+        f.write(epoch.to_bytes(8, 'little'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(EPOCH_PATH + '.new', EPOCH_PATH)
+
+
+# Read one change (packet and content hash of its file, or None) from segment, None if the segment ended
+def read_record(f):
+    packet_size = f.read(4)
+    if len(packet_size) < 4:
+        return None
+    packet_size = int.from_bytes(packet_size, 'little')
+    packet = f.read(packet_size)
+    has_hash = f.read(1)
+    if len(packet) < packet_size or not has_hash:
+        return None
+    if not has_hash[0]:
+        return packet, None
+    content_hash = f.read(HASH_SIZE)
+    if len(content_hash) < HASH_SIZE:
+        return None
+    return packet, content_hash
+
+
+# Append only log of the changes of one identifier
+# File content is not in the journal, only its hash, the content itself is in the blob store
+class Journal:
+    def __init__(self, identifier):
+        self.directory = os.path.join(JOURNALS_DIRECTORY, identifier)
+        os.makedirs(self.directory, exist_ok=True)
+        # First sequence number of each segment, we append to the last one
+        self.segments = sorted(int(name) for name in os.listdir(self.directory) if name.isdigit()) or [0]
+        self.next_sequence = self.segments[-1] + self.load()
+        self.file = open(self.segment_path(self.segments[-1]), 'ab')
+
+    def segment_path(self, first_sequence):
+        return os.path.join(self.directory, f'{first_sequence:020d}')
+
+    # Return the number of changes in the last segment, change the server stopped in the middle of is removed
+    def load(self):
+        path = self.segment_path(self.segments[-1])
+        if not os.path.isfile(path):
+            return 0
+        return sum(1 for _ in record_log.read_records(path, read_record))
+
+    def first_sequence(self):
+        return self.segments[0]
+
+    def append(self, packet, content_hash=None):
+        record = len(packet).to_bytes(4, 'little') + packet
+        record += b'\1' + content_hash if content_hash else b'\0'
+        self.file.write(record)
+        self.next_sequence += 1
+        dirty_journals.add(self)
+        if self.file.tell() >= SEGMENT_SIZE:
+            self.sync()
+            self.file.close()
+            self.segments.append(self.next_sequence)
+            self.file = open(self.segment_path(self.next_sequence), 'ab')
+
+    # Write the appended changes to disk
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # Close the journal of identifier without clients, it is opened again when a client comes
+    def close(self):
+        self.sync()
+        self.file.close()
+        dirty_journals.discard(self)
+
+    # Return the changes from start until end (not included)
+    def read(self, start, end):
+        self.file.flush()
+        changes = []
+        for first_sequence in self.segments[bisect_right(self.segments, start) - 1:]:
+            if first_sequence >= end:
+                break
+            sequence = first_sequence
+            with open(self.segment_path(first_sequence), 'rb') as f:
+                while sequence < end:
+                    record = read_record(f)
+                    if record is None:
+                        break
+                    if sequence >= start:
+                        changes.append(record)
+                    sequence += 1
+        return changes
+
+    # Remove segments that all connected clients passed (all their changes are before cursor), once they are too old
+    # or too many changes ago for disconnected clients to resume from them
+    def truncate(self, cursor):
+        oldest_time = time.time() - RESUME_WINDOW
+        while len(self.segments) > 1 and self.segments[1] <= cursor:
+            path = self.segment_path(self.segments[0])
+            if self.segments[1] > self.next_sequence - MAX_RESUME_CHANGES and os.path.getmtime(path) > oldest_time:
+                break
+            os.remove(path)
+            del self.segments[0]
+
+
+# Sync all journals that were appended since the last commit, so many changes are synced with one fsync
+def commit():
+    for journal in dirty_journals:
+        journal.sync()
+    dirty_journals.clear()
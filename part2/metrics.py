@@ -0,0 +1,131 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import protocol
+
+# Set SYNC_METRICS_FILE to write the metrics of the server to this file every SYNC_METRICS_INTERVAL seconds
+DUMP_PATH = os.environ.get('SYNC_METRICS_FILE')
+DUMP_INTERVAL = float(os.environ.get('SYNC_METRICS_INTERVAL', '10'))
+# Set SYNC_METRICS=1 (or SYNC_METRICS_FILE) to count the commands, socket operations and event loop phases of the
+# server. Otherwise all the calls return at once, and STATS_COMMAND answers only with the current gauges
+ENABLED = os.environ.get('SYNC_METRICS', '0') != '0' or bool(DUMP_PATH)
+PERCENTILES = (50, 90, 99)
+STATS_COMMAND = 17
+
+# Counters and latency histograms by name
+counters = {}
+histograms = {}
+# Read ahead threads add their latencies too
+histograms_lock = threading.Lock()
+start_time = time.time()
+next_dump = time.monotonic() + DUMP_INTERVAL
+
+
+# Latencies in buckets of powers of 2 microseconds, bucket i has the latencies from 2^(i-1) until 2^i microseconds
+class Histogram:
+    def __init__(self):
+        self.buckets = []
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        index = int(seconds * 1000000).bit_length()
+        if index >= len(self.buckets):
+            self.buckets.extend([0] * (index + 1 - len(self.buckets)))
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    # Return the upper bound of the bucket of percent of the latencies
+    def percentile(self, percent):
+        rank = percent / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return round(min((1 << index) / 1000000, self.max), 6)
+        return round(self.max, 6)
+
+    def snapshot(self):
+        snapshot = {'count': self.count, 'total_seconds': round(self.total, 6), 'max_seconds': round(self.max, 6)}
+        for percent in PERCENTILES:
+            snapshot[f'p{percent}_seconds'] = self.percentile(percent)
+        return snapshot
+
+
+# Return the start time of operation we measure, None if metrics are disabled
+def start():
+    return time.perf_counter() if ENABLED else None
+
+
+# Add the time since started to the histogram of name
+def observe(name, started):
+    if started is None:
+        return
+    add(name, time.perf_counter() - started)
+
+
+# Add latency of seconds to the histogram of name
+def add(name, seconds):
+    with histograms_lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(seconds)
+
+
+def count(name, value=1):
+    if ENABLED:
+        counters[name] = counters.get(name, 0) + value
+
+
+def snapshot(gauges):
+    with histograms_lock:
+        latency = {name: histogram.snapshot() for name, histogram in histograms.items()}
+    return {
+        'enabled': ENABLED,
+        'time': time.time(),
+        'uptime_seconds': round(time.time() - start_time, 3),
+        'gauges': gauges,
+        'counters': dict(counters),
+        'latency': latency,
+    }
+
+
+# Seconds the event loop can wait before the next dump, None if we don't dump
+def timeout():
+    if not DUMP_PATH:
+        return None
+    return max(0, next_dump - time.monotonic())
+
+
+# Write the metrics to the dump file if its time came, the file is replaced at once so readers never see half of it
+# Each worker process has its own file, with its index after the path
+def dump_if_due(gauges, suffix=''):
+    global next_dump
+    if not DUMP_PATH or time.monotonic() < next_dump:
+        return
+    next_dump = time.monotonic() + DUMP_INTERVAL
+    path = DUMP_PATH + suffix
+    with open(path + '.new', 'w') as f:
+        json.dump(snapshot(gauges()), f, indent=2)
+    os.replace(path + '.new', path)
+
+
+# Ask server for its metrics with identifier and print them
+#   python metrics.py ip port identifier
+if __name__ == "__main__":
+    s = socket.create_connection((sys.argv[1], int(sys.argv[2])))
+    reader = protocol.FrameReader(s)
+    s.sendall(int(1).to_bytes(1, 'little') + sys.argv[3].encode('utf-8') + STATS_COMMAND.to_bytes(1, 'little'))
+    command = reader.read_int(1, signed=True)
+    # If -1 it means we send invalid identifier
+    if command != STATS_COMMAND:
+        exit(1)
+    print(reader.read_string(reader.read_int(4)))
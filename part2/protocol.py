@@ -0,0 +1,121 @@
+import struct
+
+# Size of the reader buffer, it grows only when a single frame is bigger
+BUFFER_SIZE = 65536
+
+# Headers that are decoded at once
+# Identifier and command after is_identifier byte
+IDENTIFIER_HEADER = struct.Struct('<128sB')
+# Is directory and path size, before the path of most commands
+PATH_HEADER = struct.Struct('<BI')
+# Block size, blocks count and file size at the start of signatures
+SIGNATURES_HEADER = struct.Struct('<IIQ')
+# First block and blocks count of delta copy instruction
+COPY_HEADER = struct.Struct('<II')
+# Size and sha256 of file in manifest
+MANIFEST_FILE_HEADER = struct.Struct('<Q32s')
+# Size and sha256 of file that is uploaded in chunks, and the offset the server has of it
+UPLOAD_OFFSET = struct.Struct('<Q32sQ')
+# Size, sha256, offset of the first chunk and encoding of chunked upload
+CHUNKED_UPLOAD_HEADER = struct.Struct('<Q32sQB')
+# Size of the chunk content, size of the chunk data as sent and crc32 of the sent data
+CHUNK_HEADER = struct.Struct('<III')
+# Server run epoch and sequence number of change log cursor
+CURSOR = struct.Struct('<QQ')
+# Payload size, request id and flags of frame of session client
+FRAME_HEADER = struct.Struct('<IIB')
+# Session handle and server features, the answer to session hello
+SESSION = struct.Struct('<IB')
+# Request id and status of acknowledged request
+ACK = struct.Struct('<IB')
+
+
+class ClientDisconnectedException(BaseException):
+    def __init__(self):
+        super().__init__(self, "Client Disconnected")
+
+
+# Reads frames of socket with recv_into over one preallocated buffer
+# Returned memoryview is a part of the buffer, so it is valid only until the next read or fill
+class FrameReader:
+    def __init__(self, sock, size=BUFFER_SIZE):
+        self.socket = sock
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # Received bytes that were not read yet are buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    def available(self):
+        return self.end - self.start
+
+    # Receive what the socket has, with room for at least needed bytes from start
+    # Return the number of received bytes, raise ClientDisconnectedException if the other side closed the connection
+    def fill(self, needed=1):
+        if self.start == self.end:
+            self.start = self.end = 0
+            # The buffer grew for a big frame, we don't keep it after the frame was read
+            if len(self.buffer) > self.size >= needed:
+                self.buffer = bytearray(self.size)
+                self.view = memoryview(self.buffer)
+        if needed > len(self.buffer):
+            self.grow(needed)
+        elif self.start + needed > len(self.buffer) or self.end == len(self.buffer):
+            # Move the unread bytes to the buffer start
+            unread = bytes(self.view[self.start:self.end])
+            self.view[:len(unread)] = unread
+            self.start, self.end = 0, len(unread)
+
+        received = self.socket.recv_into(self.view[self.end:])
+        if not received:
+            raise ClientDisconnectedException()
+        self.end += received
+        return received
+
+    def grow(self, size):
+        buffer = bytearray(size)
+        buffer[:self.available()] = self.view[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start, self.end = 0, self.end - self.start
+
+    # Add bytes that were received from the socket by someone else, they are read before the bytes we receive next
+    def push(self, data):
+        if len(data) > len(self.buffer) - self.end:
+            self.grow(self.available() + len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    # Take size bytes that are already in the buffer
+    def take(self, size):
+        data = self.view[self.start:self.start + size]
+        self.start += size
+        return data
+
+    # Wait until size bytes arrived (blocking socket) and return them
+    def read(self, size):
+        while self.available() < size:
+            self.fill(size)
+        return self.take(size)
+
+    def read_int(self, size, signed=False):
+        return int.from_bytes(self.read(size), 'little', signed=signed)
+
+    def read_string(self, size):
+        return str(self.read(size), 'utf-8')
+
+    def read_struct(self, header):
+        return header.unpack(self.read(header.size))
+
+    def skip(self, size):
+        self.read_to(lambda data: None, size)
+
+    # Pass the next size bytes to write in chunks as they arrive, so big payloads are never kept in memory
+    def read_to(self, write, size):
+        while size > 0:
+            if not self.available():
+                self.fill()
+            chunk = min(size, self.available())
+            write(self.take(chunk))
+            size -= chunk
@@ -0,0 +1,92 @@
+import os
+import struct
+
+# Files that hold state as a log of records: the server file indexes, the server journals and the client state files
+# Each change appends a record, and the file is read record by record when it is loaded
+# Log is rewritten when it has more records than this many times the entries it holds
+COMPACT_RATIO = 2
+COMPACT_MIN_RECORDS = 1024
+
+# Size, modification time and content hash of indexed file
+FILE_ENTRY = struct.Struct('<Qq32s')
+
+
+# Return generator of the records of path, read_record returns None at the end of the file or at a torn record
+# Process stopped in the middle of a record, so when the generator ends the torn record is removed and the next
+# records are appended right after the last whole one
+def read_records(path, read_record):
+    valid_size = 0
+    with open(path, 'rb') as f:
+        while True:
+            record = read_record(f)
+            if record is None:
+                break
+            yield record
+            valid_size = f.tell()
+    if valid_size < os.path.getsize(path):
+        os.truncate(path, valid_size)
+
+
+# Record of type about path, the size of the payload after the path is known by the type
+def path_record(record_type, path, payload=b''):
+    path = path.encode('utf-8')
+    return record_type.to_bytes(1, 'little') + len(path).to_bytes(4, 'little') + path + payload
+
+
+# Read path record as (type, path, payload), payload_sizes has the payload size of each type that has payload
+# Return None at the end of the file or at a torn record
+def read_path_record(f, payload_sizes):
+    header = f.read(5)
+    if len(header) < 5:
+        return None
+    path_size = int.from_bytes(header[1:5], 'little')
+    path = f.read(path_size)
+    if len(path) < path_size:
+        return None
+    payload_size = payload_sizes.get(header[0], 0)
+    payload = f.read(payload_size)
+    if len(payload) < payload_size:
+        return None
+    return header[0], path.decode('utf-8'), payload
+
+
+# Append only file of records, that its owner rewrites with the records of its entries when it grows
+class RecordLog:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.records = 0
+
+    # Return generator of the records already in the file, the file is opened for append after all were read
+    def load(self, read_record):
+        if os.path.isfile(self.path):
+            for record in read_records(self.path, read_record):
+                self.records += 1
+                yield record
+        self.file = open(self.path, 'ab')
+
+    def append(self, record):
+        self.file.write(record)
+        self.records += 1
+
+    # Return if the log has so many records more than the entries that it should be compacted
+    def is_bloated(self, entries_count):
+        return self.records > COMPACT_MIN_RECORDS and self.records > COMPACT_RATIO * entries_count
+
+    # Rewrite the file with only the given records
+    def compact(self, records):
+        self.file.close()
+        temp_path = self.path + '.compact'
+        self.records = 0
+        with open(temp_path, 'wb') as f:
+            for record in records:
+                f.write(record)
+                self.records += 1
+        os.replace(temp_path, self.path)
+        self.file = open(self.path, 'ab')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -1,8 +1,28 @@
+import hashlib
+import json
 import os
+import queue
+import selectors
 import socket
 import string
 import sys
 import random
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from itertools import islice
+
+import blobs
+import compression
+import content_cache
+import delta
+import file_index
+import journal
+import metrics
+import protocol
+from protocol import ClientDisconnectedException
 
 CREATE_COMMAND = 1
 DELETE_COMMAND = 2
@@ -10,82 +30,837 @@ MODIFY_COMMAND = 3
 MOVE_COMMAND = 4
 PULL_COMMAND = 5
 UPDATES_COMMAND = 6
+FEATURES_COMMAND = 7
+ENABLE_FEATURES_COMMAND = 8
+SIGNATURES_COMMAND = 9
+MODIFY_DELTA_COMMAND = 10
+PULL_DELTA_COMMAND = 11
+PULL_MANIFEST_COMMAND = 12
+RESUME_COMMAND = 13
+CURSOR_COMMAND = 14
+SESSION_COMMAND = 15
+ACK_COMMAND = 16
+STATS_COMMAND = 17
+UPLOAD_OFFSET_COMMAND = 18
+CHUNKED_UPLOAD_COMMAND = 19
+RESUME_DOWNLOAD_COMMAND = 20
+# Names of the commands in the metrics
+COMMAND_NAMES = {CREATE_COMMAND: 'create', DELETE_COMMAND: 'delete', MODIFY_COMMAND: 'modify', MOVE_COMMAND: 'move',
+                 PULL_COMMAND: 'pull', UPDATES_COMMAND: 'updates', FEATURES_COMMAND: 'features',
+                 ENABLE_FEATURES_COMMAND: 'enable_features', SIGNATURES_COMMAND: 'signatures',
+                 MODIFY_DELTA_COMMAND: 'modify_delta', PULL_DELTA_COMMAND: 'pull_delta',
+                 PULL_MANIFEST_COMMAND: 'pull_manifest', RESUME_COMMAND: 'resume', STATS_COMMAND: 'stats',
+                 UPLOAD_OFFSET_COMMAND: 'upload_offset', CHUNKED_UPLOAD_COMMAND: 'chunked_upload'}
+
+# First byte of hello message instead of is_identifier, the identifier and FEATURES_COMMAND follow like in any message
+# so servers without sessions answer it as FEATURES_COMMAND. Join hello is followed by the handle of the session
+# From then on the client sends frames: size (4 bytes), request id (4 bytes) and flags, and the payload of the frames
+# of one request is a message without is_identifier and identifier. Each request is acknowledged by its request id
+SESSION_OPEN = 3
+SESSION_JOIN = 4
+# Flags of frame, the last frame of each request has FRAME_END
+FRAME_END = 1
+# Status of ACK_COMMAND
+REQUEST_OK = 0
+REQUEST_FAILED = 1
+
+# Features that client can enable with ENABLE_FEATURES_COMMAND (bit flags)
+FEATURE_PUSH = 1
+FEATURE_DELTA = 2
+FEATURE_LARGE_FILES = 4
+FEATURE_MANIFEST_PULL = 8
+FEATURE_CURSOR = 16
+FEATURE_COMPRESSION = 32
+FEATURE_RESUME = 64
+SERVER_FEATURES = FEATURE_PUSH | FEATURE_DELTA | FEATURE_LARGE_FILES | FEATURE_MANIFEST_PULL | FEATURE_CURSOR \
+                  | FEATURE_COMPRESSION | FEATURE_RESUME
+
+# Max bytes we read from client socket in one call
+RECV_SIZE = 65536
+# Max size of path in client message
+MAX_STRING_SIZE = 65536
+# Modified files smaller than this are sent in full also to clients with delta feature
+DELTA_MIN_SIZE = 64 * 1024
+# Client signatures are parsed in parts of this many blocks, so a huge count can't make us allocate it at once
+SIGNATURES_PART_BLOCKS = 4096
+# Files of more blocks are sent whole as delta literals, so the lookup table of their signatures stays small
+MAX_SIGNATURE_BLOCKS = 1 << 18
+# Manifest entries of PULL_MANIFEST_COMMAND
+MANIFEST_END = 0
+MANIFEST_FILE = 1
+MANIFEST_DIRECTORY = 2
+# Partial file the client kept of download that was cut, with its size and sha256
+MANIFEST_PARTIAL = 3
+
+# Pulled files smaller than this are read into batches of about BATCH_SIZE bytes, so many files go in one send
+# Bigger files are sent from their file with sendfile
+SMALL_FILE_SIZE = 64 * 1024
+BATCH_SIZE = 256 * 1024
+# Batches and compressed files are made by a background thread, at most this many batches ahead of the socket
+# Set SYNC_READ_AHEAD=0 to make them in the event loop when the socket needs them
+READ_AHEAD = os.environ.get('SYNC_READ_AHEAD', '1') != '0'
+READ_AHEAD_BATCHES = 8
+
+# Files are written here first and then moved to their place, so no one sees half written file
+TEMP_DIRECTORY = 'tmp'
+# Clients with resume feature upload big files in chunks, each chunk is checked by its crc32 and added to the partial
+# file of the upload here. If the connection is cut, the client continues later from the end of the partial file
+# Partial files that nobody continued for PARTIAL_MAX_AGE seconds are removed when the server starts
+PARTIAL_DIRECTORY = os.path.join(TEMP_DIRECTORY, 'partial')
+PARTIAL_MAX_AGE = 7 * 24 * 3600
+RESUME_CHUNK_SIZE = 1024 * 1024
+# Compressed chunk may be a bit bigger than its content
+RESUME_CHUNK_OVERHEAD = 64 * 1024
+
+# Set SYNC_WORKERS to the number of worker processes, each worker owns the identifiers that crc32 gives to it
+# The main process accepts the clients and hands each one to the worker of the identifier in his first message
+WORKERS = int(os.environ.get('SYNC_WORKERS', '1'))
+# First message bytes the main process needs to find the worker: is_identifier and identifier
+DISPATCH_PREFIX_SIZE = 1 + 128
+
+# Clients that moved fewer bytes lately are served first in each loop turn, so clients that send small messages
+# (UPDATES, DELETE, MOVE) don't wait behind bulk uploads and pulls. Bytes count half after BYTES_HALF_LIFE seconds
+BYTES_HALF_LIFE = 1.0
+# Max bytes written to one client in one loop turn, the rest waits for the next turn
+WRITE_BUDGET = int(os.environ.get('SYNC_WRITE_BUDGET', 256 * 1024))
+# When the loop turn took TURN_BUDGET seconds, clients that moved more than BULK_BYTES lately wait for the next turn
+# Their bytes count less while they wait, so they get their turn soon
+TURN_BUDGET = float(os.environ.get('SYNC_TURN_BUDGET', '0.01'))
+BULK_BYTES = 1024 * 1024
+# Packets waiting in out queue are gathered into one sendmsg call, at most this many of them and WRITE_BUDGET bytes
+# So a backlog of many small changes is sent in a few system calls
+SEND_BUFFERS = 64
+
+# Newest changes of each identifier are kept also in memory, clients that are behind them read from the journal
+MEMORY_CHANGES = 1024
+
+# Change log of each identifier by the identifier
+change_logs = {}
+# Sessions of this process by their handle
+sessions = {}
+# Selector that watch the server socket and all client sockets
+selector = selectors.DefaultSelector()
+# Dictionary of all connected clients by their address
+connections = {}
+# Read ahead threads wake the event loop with this socket pair when they have a batch ready
+wakeup_reader, wakeup_writer = socket.socketpair()
+# Clients that wait for their read ahead thread
+waiting_connections = set()
+# Partial files that uploads write to now, another upload of the same file doesn't touch them
+receiving_partials = set()
+# Size and sha256 object of the data of each partial file by its path, uploads continue the hash without reading it
+partial_hashes = {}
+# Index of this worker process and the number of workers
+worker_index = 0
+worker_count = 1
+
+
+class ClientConnection:
+    def __init__(self, client_socket, client_address):
+        self.socket = client_socket
+        self.address = client_address
+        # Bytes we received from client and not parsed yet
+        self.reader = protocol.FrameReader(client_socket)
+        # Bytes we wait to send to client when the socket will be writable
+        self.out_queue = deque()
+        # When the client should be disconnected, we disconnect him after sending all the out queue
+        self.closing = False
+        # Features the client enabled, None for clients that never sent FEATURES_COMMAND
+        self.features = None
+        # Identifier the client sends messages of, and sequence number of the first change of it he didn't get yet
+        self.identifier = None
+        self.cursor = 0
+        # Session of the client, None for clients that send is_identifier and identifier in each message
+        self.session = None
+        # Parser of the client messages, it yields the number of bytes it needs and gets them when they arrived
+        # Negative number means it takes any amount of bytes up to this number, as soon as some arrived
+        self.parser = handle_client(self)
+        self.needed = next(self.parser)
+        # Bytes the client moved lately and when we counted them, older bytes count less
+        self.recent_bytes = 0.0
+        self.recent_time = time.monotonic()
+
+    def load(self):
+        return self.recent_bytes * 0.5 ** ((time.monotonic() - self.recent_time) / BYTES_HALF_LIFE)
+
+    def add_bytes(self, size):
+        self.recent_bytes = self.load() + size
+        self.recent_time = time.monotonic()
+
+    # Send bytes or FilePacket
+    def send(self, packet):
+        items = self.packet_items(packet)
+        if not items:
+            return
+        self.out_queue.extend(items)
+        selector.modify(self.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+
+    # Send all chunks of generator, each chunk is created only when the previous ones were sent
+    def send_stream(self, chunks):
+        self.out_queue.append(chunks)
+        selector.modify(self.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+
+    # Return the out queue items of packet, file content is sent straight from its file unless it is compressed
+    def packet_items(self, packet):
+        if not isinstance(packet, FilePacket):
+            return [memoryview(packet)] if packet else []
+        # Client with 4 bytes sizes can't get bigger files
+        if packet.size >= 1 << (8 * self.size_length()):
+            return []
+        header = packet.header + packet.size.to_bytes(self.size_length(), 'little')
+        if self.encoding() is None:
+            return [memoryview(header), FileSegment(packet.file, packet.size, packet.offset)]
+
+        if packet.encoding is None:
+            packet.encoding = compression.choose_encoding(packet.file, packet.size, self.encoding())
+        header += packet.encoding.to_bytes(1, 'little')
+        if packet.encoding == compression.ENCODING_RAW:
+            return [memoryview(header), FileSegment(packet.file, packet.size, packet.offset)]
+        if packet.size < SMALL_FILE_SIZE:
+            return [memoryview(header + b''.join(packet.frames()))]
+        return [memoryview(header), worker_stream(packet.frames())]
+
+    def has_feature(self, feature):
+        return bool(self.features and self.features & feature)
+
+    # Clients with large files feature get and send file sizes in 8 bytes, so files can be bigger than 4 GiB
+    def size_length(self):
+        return 8 if self.has_feature(FEATURE_LARGE_FILES) else 4
+
+    # Encoding we compress files we send to client with, None if the client doesn't get encoding byte after file size
+    def encoding(self):
+        return compression.ENCODING_ZLIB if self.has_feature(FEATURE_COMPRESSION) else None
+
+    # Changes the client made are not sent back to him, or to the other connections of his session
+    def source(self):
+        return self.session or self.address
+
+
+# Packet with file content, we keep only the open file and send the content from it when the client can get it
+# Files are always replaced and never written in place, so the open file keeps the content we had when it was opened
+class FilePacket:
+    def __init__(self, header, path, offset=0):
+        # All the packet before the file size
+        self.header = header
+        self.file = open(path, 'rb')
+        # Resumed download sends only the content from offset
+        self.offset = offset
+        self.size = os.fstat(self.file.fileno()).st_size - offset
+        # Encoding the content is sent with, None until it is chosen by the sample of the file
+        self.encoding = None
+        # Content hash finds the content in the cache, None if the packet can't use the cache
+        self.content_hash = blobs.open_file_hash(self.file) if not offset else None
+
+    # Read all the content, if the file got shorter meanwhile it is filled with zeros
+    def read(self):
+        data = content_cache.get(self.content_hash, compression.ENCODING_RAW)
+        if data is None:
+            data = compression.read_at(self.file, self.offset, self.size)
+            if len(data) == self.size:
+                content_cache.put(self.content_hash, compression.ENCODING_RAW, data)
+        return data.ljust(self.size, b'\0')
+
+    # Return generator of the frames of the content compressed with encoding
+    # Content that fits the cache is compressed once, and the next clients get all its frames at once from the cache
+    def frames(self):
+        data = content_cache.get(self.content_hash, self.encoding)
+        if data is not None:
+            yield data
+            return
+        if self.size < SMALL_FILE_SIZE:
+            data = compression.compress_data(self.read(), self.encoding)
+            content_cache.put(self.content_hash, self.encoding, data)
+            yield data
+            return
+        frames = compression.compressed_frames(self.file, self.size, self.encoding, self.offset)
+        if self.content_hash is None or self.size > content_cache.MAX_ENTRY_SIZE:
+            yield from frames
+            return
+        parts = []
+        for frame in frames:
+            parts.append(frame)
+            yield frame
+        content_cache.put(self.content_hash, self.encoding, b''.join(parts))
+
+
+# Take batches from generator in background thread, so reading many small files or compressing doesn't stop the
+# event loop
+class ReadAhead:
+    def __init__(self, batches):
+        self.queue = queue.Queue(READ_AHEAD_BATCHES)
+        self.closed = False
+        # Error of the thread, if it stopped before the end of the batches
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(batches,), daemon=True)
+        self.thread.start()
+
+    def run(self, batches):
+        batches = iter(batches)
+        try:
+            while True:
+                # Time to make each batch, without the waits for room in the queue
+                started = metrics.start()
+                batch = next(batches, None)
+                if batch is None:
+                    return
+                metrics.observe('read_ahead.batch', started)
+                if not self.put(batch):
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            self.put(None)
+
+    # Wait for room in queue unless the client disconnected, return if the batch was put
+    def put(self, batch):
+        while not self.closed:
+            try:
+                self.queue.put(batch, timeout=1)
+            except queue.Full:
+                continue
+            try:
+                wakeup_writer.send(b'\0')
+            except BlockingIOError:
+                # Wakeup socket is full, so the event loop will wake anyway
+                pass
+            return True
+        return False
+
+
+# Change of identifier files, packet is all the message, or for changed file the message before the file size
+# The file content is found by its hash in the blob store only when the change is sent, so the log keeps no open files
+class Change:
+    def __init__(self, packet, content_hash=None):
+        self.packet = packet
+        self.content_hash = content_hash
+        # Session or address of the client that made the change, he doesn't get it back
+        self.source = None
+
+
+# Ordered changes of one identifier, each client has a cursor in it
+# Changes are kept once for all the clients in the journal, and the newest of them also in memory
+class ChangeLog:
+    def __init__(self, identifier):
+        self.journal = journal.Journal(identifier)
+        # Sequence number of the first change in changes
+        self.memory_sequence = self.journal.next_sequence
+        self.changes = deque()
+        # Connected clients of the identifier
+        self.connections = set()
+
+    def first_sequence(self):
+        return self.journal.first_sequence()
+
+    def next_sequence(self):
+        return self.journal.next_sequence
+
+    def append(self, change):
+        self.journal.append(change.packet, change.content_hash)
+        self.changes.append(change)
+
+    def changes_from(self, sequence):
+        if sequence >= self.memory_sequence:
+            return list(islice(self.changes, sequence - self.memory_sequence, None))
+        # Client is behind the changes in memory, so the older changes are read from the journal
+        return [Change(packet, content_hash) for packet, content_hash in
+                self.journal.read(sequence, self.memory_sequence)] + list(self.changes)
+
+    # Remove the changes that no client needs anymore from memory, and the old ones also from the journal
+    def truncate(self):
+        cursor = min((connection.cursor for connection in self.connections), default=self.next_sequence())
+        while self.changes and (self.memory_sequence < cursor or len(self.changes) > MEMORY_CHANGES):
+            self.changes.popleft()
+            self.memory_sequence += 1
+        self.journal.truncate(cursor)
+
+    def close(self):
+        self.journal.close()
+
+
+# Connections of one client that authenticated the identifier once, each of them gets a request handler with the
+# identifier. Client opens more connections to the session with its handle
+class Session:
+    def __init__(self, identifier, handle):
+        self.identifier = identifier
+        self.handle = handle
+        self.connections = set()
+
+
+# Frames of one request, the command parsers read the payload of all of them as one message
+class RequestFrames:
+    def __init__(self, size, flags):
+        self.remaining = size
+        self.is_end = flags & FRAME_END
+
+    # Wait for the next frame with payload, return False if the request ended
+    def next_frame(self):
+        while not self.remaining and not self.is_end:
+            self.remaining, _, flags = yield from recv_struct(protocol.FRAME_HEADER)
+            self.is_end = flags & FRAME_END
+        return self.remaining > 0
+
+    # Return the bytes the parser asked for (negative needed like recv_some), None if the request doesn't have them
+    def read(self, needed):
+        parts = []
+        while needed:
+            if not (yield from self.next_frame()):
+                return None
+            if needed < 0:
+                data = yield -min(-needed, self.remaining)
+                needed = 0
+            else:
+                data = yield min(needed, self.remaining)
+                needed -= len(data)
+            self.remaining -= len(data)
+            # Reader memoryview is valid only until the next read, so parts of more than one frame are copied
+            parts.append(bytes(data) if needed else data)
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    # Receive and drop the rest of the request
+    def skip(self):
+        while (yield from self.next_frame()):
+            data = yield -min(self.remaining, RECV_SIZE)
+            self.remaining -= len(data)
+
+
+# Part of file waiting in out queue, the same open file may be sent to many clients each with his own offset
+class FileSegment:
+    def __init__(self, file, size, offset=0):
+        self.file = file
+        self.offset = offset
+        self.remaining = size
 
-# Dictionary that save changes of each client by his ID
-file_changes_dict = {}
-# Array of client sockets and address
-client_sockets = []
 
+def generate_identifier():
+    while True:
+        identifier = ''.join(random.choices(string.ascii_uppercase + string.ascii_lowercase + string.digits, k=128))
+        # New identifier must be ours, so the next connections of its clients are handed to us
+        if worker_of(identifier.encode('utf-8'), worker_count) == worker_index:
+            return identifier
 
-class ClientDisconnectedException(BaseException):
-    def __init__(self):
-        super().__init__(self, "Client Disconnected")
 
+def worker_of(identifier, count):
+    return zlib.crc32(identifier) % count
 
-def generate_identifier():
-    return ''.join(random.choices(string.ascii_uppercase + string.ascii_lowercase + string.digits, k=128))
 
+def path_header(command, is_directory, sent_path):
+    sent_path = sent_path.encode('utf-8')
+    return command.to_bytes(1, 'little') + is_directory.to_bytes(1, 'little') + len(sent_path).to_bytes(4, 'little') \
+           + sent_path
 
-def add_packet_to_update_dict(packet, identifier, client_address):
-    identifier_dict = file_changes_dict[identifier]
-    for address in identifier_dict:
-        if client_address == address:
-            continue
-        identifier_dict[address].append(packet)
 
+# Return path the client sent as our relative path, the client separates it by / or \
+# Absolute paths, .. and NUL are of broken or malicious client, they could reach other identifiers or the blobs
+def relative_path(sent_path):
+    parts = [part for part in sent_path.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or '\0' in sent_path or sent_path[:1] in ('/', '\\') \
+            or os.path.splitdrive(sent_path)[0]:
+        raise ClientDisconnectedException()
+    return os.path.join(*parts)
 
-def recv(client_socket, recv_size):
-    recv_data = b''
-    while len(recv_data) < recv_size:
-        recv_data += client_socket.recv(recv_size - len(recv_data))
 
-    return recv_data
+# Return the path in identifier directory of path the client sent, it is always under the directory
+def identifier_path(identifier, sent_path):
+    path = os.path.join(identifier, relative_path(sent_path))
+    if os.path.commonpath([identifier, path]) != identifier:
+        raise ClientDisconnectedException()
+    return path
 
 
-def send_file_to_client(identifier, path, client_socket):
-    send_path = os.path.relpath(path, identifier)
-    packet = CREATE_COMMAND.to_bytes(1, 'little')
-    is_directory = os.path.isdir(path).to_bytes(1, 'little')
-    packet += is_directory
-    packet += len(send_path).to_bytes(4, 'little')
-    packet += send_path.encode('utf-8')
-    if os.path.isdir(path):
-        client_socket.sendall(packet)
+def get_change_log(identifier):
+    if identifier not in change_logs:
+        change_logs[identifier] = ChangeLog(identifier)
+    return change_logs[identifier]
+
+
+# Client sends messages of identifier, from now on he gets the changes of it
+def attach_client(connection, identifier):
+    if connection.identifier == identifier:
+        return
+    detach_client(connection)
+    change_log = get_change_log(identifier)
+    connection.identifier = identifier
+    connection.cursor = change_log.next_sequence()
+    change_log.connections.add(connection)
+
+
+def detach_client(connection):
+    if connection.identifier is None:
         return
+    change_log = change_logs[connection.identifier]
+    change_log.connections.discard(connection)
+    change_log.truncate()
+    # Identifier without clients keeps no open files, its changes are read from the journal when a client comes
+    if not change_log.connections:
+        change_log.close()
+        del change_logs[connection.identifier]
+        file_index.evict(connection.identifier)
+    connection.identifier = None
+
+
+def add_change(identifier, change, connection):
+    change.source = connection.source()
+    metrics.count('changes')
+    change_log = get_change_log(identifier)
+    change_log.append(change)
+    # Subscribed clients get the change right away, others wait for their next UPDATES_COMMAND
+    for client in change_log.connections:
+        if client.has_feature(FEATURE_PUSH):
+            send_changes(client)
+    change_log.truncate()
+
+
+# Return the changes from client cursor that other clients made, and move the cursor to the end of the log
+def take_changes(connection):
+    change_log = change_logs[connection.identifier]
+    changes = change_log.changes_from(connection.cursor)
+    connection.cursor = change_log.next_sequence()
+    return [change for change in changes if change.source != connection.source()]
+
+
+# Return generator of the packets of changes, each file is opened only when its turn to be sent comes
+def change_packets(connection, changes):
+    for change in changes:
+        try:
+            packet = change_packet(connection, change)
+        except FileNotFoundError:
+            # The content was replaced or removed since the change, and the change that did it comes later in the log
+            continue
+        yield packet
+
+
+def change_packet(connection, change):
+    if change.content_hash is None:
+        return change.packet
+    header = change.packet
+    if header[0] == MODIFY_DELTA_COMMAND:
+        if connection.has_feature(FEATURE_DELTA):
+            return header
+        # Clients without delta feature can't ask for the delta, so they get the full modified file
+        header = MODIFY_COMMAND.to_bytes(1, 'little') + header[1:]
+    return FilePacket(header, blobs.blob_path(change.content_hash))
+
+
+# Send the changes client didn't get yet, followed by his new cursor
+def send_changes(connection):
+    cursor = connection.cursor
+    changes = take_changes(connection)
+    if changes:
+        connection.send_stream(change_packets(connection, changes))
+    if connection.cursor != cursor:
+        send_cursor(connection)
+
+
+def send_cursor(connection):
+    if connection.has_feature(FEATURE_CURSOR):
+        connection.send(CURSOR_COMMAND.to_bytes(1, 'little') + protocol.CURSOR.pack(journal.epoch, connection.cursor))
+
+
+# Wait until recv_size bytes arrived from client and return them
+def recv(recv_size):
+    return (yield recv_size)
+
+
+def recv_int(size):
+    data = yield size
+    return int.from_bytes(data, 'little')
+
+
+# Wait until all the header arrived and return its decoded fields
+def recv_struct(header):
+    data = yield header.size
+    return header.unpack(data)
+
+
+def recv_string(size):
+    # Strings are paths and identifiers, a bigger size means the client sent garbage
+    if size > MAX_STRING_SIZE:
+        raise ClientDisconnectedException()
+    data = yield size
+    try:
+        return str(data, 'utf-8')
+    except UnicodeDecodeError:
+        raise ClientDisconnectedException()
+
+
+# Run parser and return its result, its histogram of name gets the time of all its steps added up
+# Work that read ahead threads do for it is in their own histogram
+def timed(name, parser):
+    if not metrics.ENABLED:
+        return (yield from parser)
+    elapsed = 0
+    data = None
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                needed = parser.send(data)
+            except StopIteration as e:
+                metrics.add(name, elapsed + time.perf_counter() - started)
+                return e.value
+            elapsed += time.perf_counter() - started
+            data = yield needed
+    finally:
+        # Stop the parser with us, so file it was receiving is removed
+        parser.close()
+
+
+# Wait until some bytes arrived from client and return at most max_size of them
+def recv_some(max_size):
+    return (yield -max_size)
+
+
+# Receive file_size bytes into temp file as they arrive, so big files are never kept in memory
+# Clients with compression feature send the encoding of the content first
+# Return the temp file path and the sha256 of the received data
+def recv_file(connection, file_size):
+    encoding = compression.ENCODING_RAW
+    if connection.has_feature(FEATURE_COMPRESSION):
+        encoding = yield from recv_int(1)
+    os.makedirs(TEMP_DIRECTORY, exist_ok=True)
+    f = tempfile.NamedTemporaryFile(dir=TEMP_DIRECTORY, delete=False)
+    writer = delta.HashingWriter(f)
+    # Small file is kept in the cache too, the other clients of the identifier get it right away
+    content = bytearray() if file_size < SMALL_FILE_SIZE else None
+
+    def write(data):
+        writer.write(data)
+        if content is not None:
+            content.extend(data)
+
+    try:
+        with f:
+            if encoding == compression.ENCODING_RAW:
+                while file_size > 0:
+                    data = yield from recv_some(min(file_size, RECV_SIZE))
+                    write(data)
+                    file_size -= len(data)
+            else:
+                yield from recv_compressed(compression.Decoder(encoding, file_size, write))
+    except BaseException:
+        # Client disconnected in the middle of the file
+        os.remove(f.name)
+        raise
+    content_hash = writer.sha256.digest()
+    if content is not None:
+        content_cache.put(content_hash, compression.ENCODING_RAW, content)
+    return f.name, content_hash
+
+
+# Pass the data of the frames to decoder as they arrive, until the end frame
+def recv_compressed(decoder):
+    while True:
+        frame_size = yield from recv_int(4)
+        if not frame_size:
+            break
+        while frame_size > 0:
+            data = yield from recv_some(min(frame_size, RECV_SIZE))
+            decoder.write(data)
+            frame_size -= len(data)
+    decoder.close()
+
 
-    with open(path, 'rb') as f:
-        file_data = f.read()
+# Compare the sizes first, so we look for the file content hash only if it may be the same
+# The content hash comes from the identifier index, so the file is not read
+def is_same_file(identifier, path, file_size, content_hash):
+    return os.path.isfile(path) and os.path.getsize(path) == file_size \
+           and file_index.content_hash(identifier, path) == content_hash
 
-    packet += len(file_data).to_bytes(4, 'little')
-    packet += file_data
 
-    client_socket.sendall(packet)
+# Put file content in the blob store and link path to it
+def store_file(identifier, temp_path, content_hash, path):
+    blobs.replace(temp_path, content_hash, path)
+    file_index.update(identifier, path, content_hash)
 
 
-# Indicates that we reach all of files
-def send_empty_file_to_client(client_socket):
-    packet = int(0).to_bytes(1, 'little')
-    client_socket.sendall(packet)
+def relative_root(root, identifier):
+    return os.path.relpath(root, identifier) if root != identifier else ''
 
 
-def send_all_directory_to_client(path, identifier, client_socket):
+# Return generator of CREATE packets of all the directory, each file is opened only when its turn to be sent comes
+def all_directory_packets(path, identifier):
     for root, subdirs, files in os.walk(path):
+        # Relative path is found once for each directory, and not for each of its files
+        send_root = relative_root(root, identifier)
+        # Empty directory is sent when we reach it, so we don't need to list each directory twice
+        if not subdirs and not files and root != path:
+            yield path_header(CREATE_COMMAND, 1, send_root)
         for file in files:
-            send_file_to_client(identifier, os.path.join(root, file), client_socket)
+            try:
+                packet = FilePacket(path_header(CREATE_COMMAND, 0, os.path.join(send_root, file)),
+                                    os.path.join(root, file))
+            except FileNotFoundError:
+                # File was removed while we were sending, the update of the removal is on its way
+                continue
+            yield packet
+
+    # Send empty message to indicates we sent all files
+    yield int(0).to_bytes(1, 'little')
+
+
+# Join packets into batches, small files are read into the batch and bigger files stay FilePacket for sendfile
+# If encoding is not None, files are sent with encoding byte, and compressible files are compressed into the batch
+def batch_packets(packets, size_length, encoding):
+    batch = bytearray()
+    for packet in packets:
+        if isinstance(packet, FilePacket):
+            # Client with 4 bytes sizes can't get bigger files
+            if packet.size >= 1 << (8 * size_length):
+                packet.file.close()
+                continue
+            header = packet.header + packet.size.to_bytes(size_length, 'little')
+            if encoding is not None:
+                packet.encoding = compression.choose_encoding(packet.file, packet.size, encoding)
+                header += packet.encoding.to_bytes(1, 'little')
+            if packet.encoding:
+                batch += header
+                with packet.file:
+                    for frame in packet.frames():
+                        batch += frame
+                        if len(batch) >= BATCH_SIZE:
+                            yield batch
+                            batch = bytearray()
+                continue
+            if packet.size >= SMALL_FILE_SIZE:
+                if batch:
+                    yield batch
+                    batch = bytearray()
+                yield packet
+                continue
+            with packet.file:
+                batch += header + packet.read()
+        else:
+            batch += packet
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = bytearray()
+    if batch:
+        yield batch
+
+
+# Return stream of chunks made by background thread if READ_AHEAD is set
+def worker_stream(chunks):
+    return ReadAhead(chunks) if READ_AHEAD else chunks
+
+
+# Send pull packets in batches
+def send_pull_packets(connection, packets):
+    connection.send_stream(worker_stream(batch_packets(packets, connection.size_length(), connection.encoding())))
+
+
+# Client sends manifest of what it has (size and hash of each file, and its directories), we send only the difference
+def pull_manifest_command(identifier, connection):
+    # Manifest of client by path, directories map to None
+    manifest = {}
+    # Size and hash of the partial files of client by path
+    partials = {}
+    while True:
+        entry_type = yield from recv_int(1)
+        if entry_type == MANIFEST_END:
+            break
+        path_size = yield from recv_int(4)
+        path = relative_path((yield from recv_string(path_size)))
+        if entry_type == MANIFEST_FILE:
+            manifest[path] = yield from recv_struct(protocol.MANIFEST_FILE_HEADER)
+        elif entry_type == MANIFEST_PARTIAL:
+            partials[path] = yield from recv_struct(protocol.MANIFEST_FILE_HEADER)
+        else:
+            manifest[path] = None
+
+    send_pull_packets(connection, manifest_packets(identifier, manifest, connection.has_feature(FEATURE_DELTA),
+                                                   partials))
+
+
+def is_parent_removed(path, removed):
+    parent = os.path.dirname(path)
+    while parent:
+        if parent in removed:
+            return True
+        parent = os.path.dirname(parent)
+    return False
+
+
+# Return generator of the packets that make client with manifest have our directory of identifier
+def manifest_packets(identifier, manifest, is_delta, partials):
+    # What we have by path relative to identifier, directories map to None
+    server_files = {}
+    for root, subdirs, files in os.walk(identifier):
+        send_root = relative_root(root, identifier)
         for subdir in subdirs:
-            if not os.listdir(os.path.join(root, subdir)):
-                send_file_to_client(identifier, os.path.join(root, subdir), client_socket)
+            server_files[os.path.join(send_root, subdir)] = None
+        for file in files:
+            server_files[os.path.join(send_root, file)] = True
+
+    # Deletions are sent first, so file can take the place of removed directory and the opposite
+    # Parents are shorter than their children, so when we reach a path we already know if its parent was removed
+    removed = set()
+    for path in sorted(manifest, key=len):
+        is_directory = manifest[path] is None
+        if path in server_files and (server_files[path] is None) == is_directory:
+            continue
+        if is_parent_removed(path, removed):
+            continue
+        removed.add(path)
+        yield path_header(DELETE_COMMAND, is_directory, path)
+
+    for path, is_file in server_files.items():
+        entry = manifest.get(path)
+        full_path = os.path.join(identifier, path)
+        if not is_file:
+            if path not in manifest or entry is not None:
+                yield path_header(CREATE_COMMAND, 1, path)
+            continue
+        try:
+            if entry and entry[0] == os.path.getsize(full_path) and \
+                    file_index.content_hash(identifier, full_path) == entry[1]:
+                continue
+            if path in partials:
+                packet = resumed_packet(path, full_path, partials[path])
+                if packet:
+                    yield packet
+                    continue
+            # Client has other version of big file, so it can ask for the delta from it
+            if entry and is_delta and os.path.getsize(full_path) >= DELTA_MIN_SIZE:
+                yield path_header(MODIFY_DELTA_COMMAND, 0, path)
+                continue
+            packet = FilePacket(path_header(CREATE_COMMAND, 0, path), full_path)
+        except FileNotFoundError:
+            # File was removed while we were sending, the update of the removal is on its way
+            continue
+        yield packet
 
     # Send empty message to indicates we sent all files
-    send_empty_file_to_client(client_socket)
+    yield int(0).to_bytes(1, 'little')
+
+
+# Return packet of the rest of file after the partial file of client, None if the partial is not the start of the file
+def resumed_packet(path, full_path, partial):
+    partial_size, partial_hash = partial
+    packet = FilePacket(path_header(RESUME_DOWNLOAD_COMMAND, 0, path) + partial_size.to_bytes(8, 'little'), full_path,
+                        partial_size)
+    # The open file is checked, so the rest we send is of the same file even if it is replaced meanwhile
+    if packet.size > 0 and hash_prefix(packet.file, partial_size).digest() == partial_hash:
+        return packet
+    packet.file.close()
+    return None
+
+
+# Return sha256 object of the first size bytes of open file
+def hash_prefix(f, size):
+    sha256 = hashlib.sha256()
+    offset = 0
+    while offset < size:
+        data = compression.read_at(f, offset, min(size - offset, RESUME_CHUNK_SIZE))
+        if not data:
+            break
+        sha256.update(data)
+        offset += len(data)
+    return sha256
 
 
-def create_command(client_socket, identifier):
-    is_directory = int.from_bytes(client_socket.recv(1), 'little')
-    path_size = int.from_bytes(client_socket.recv(4), 'little')
-    path = os.path.join(identifier, client_socket.recv(path_size).decode('utf-8'))
-    path = path.replace("/", os.sep)
-    path = path.replace('\\', os.sep)
+def create_command(identifier, connection):
+    is_directory, path_size = yield from recv_struct(protocol.PATH_HEADER)
+    path = identifier_path(identifier, (yield from recv_string(path_size)))
 
     packet = CREATE_COMMAND.to_bytes(1, 'little')
     packet += is_directory.to_bytes(1, 'little')
@@ -99,94 +874,374 @@ def create_command(client_socket, identifier):
         os.makedirs(path, exist_ok=True)
         return packet
 
-    file_size = int.from_bytes(client_socket.recv(4), 'little')
-    file_data = recv(client_socket, file_size)
+    file_size = yield from recv_int(connection.size_length())
+    temp_path, content_hash = yield from recv_file(connection, file_size)
 
     # If already exists the same file we return with empty update packet
-    if os.path.isfile(path):
-        with open(path, 'rb') as f:
-            current_data = f.read()
-            if current_data == file_data:
-                return b''
+    if is_same_file(identifier, path, file_size, content_hash):
+        os.remove(temp_path)
+        return b''
 
     os.makedirs(os.path.dirname(path), exist_ok=True)
 
-    with open(path, 'wb+') as f:
-        f.write(file_data)
-    packet += file_size.to_bytes(4, 'little')
-    packet += file_data
-    return packet
+    store_file(identifier, temp_path, content_hash, path)
+    return Change(packet, content_hash)
 
 
 def delete_recursive(path):
     for root, subdirs, files in os.walk(path, topdown=False):
         for file in files:
-            os.remove(os.path.join(root, file))
+            blobs.remove(os.path.join(root, file))
         for subdir in subdirs:
             os.rmdir(os.path.join(root, subdir))
     if os.path.isdir(path):
         os.rmdir(path)
 
 
-def delete_command(client_socket, identifier):
-    is_directory = int.from_bytes(client_socket.recv(1), 'little')
-    path_size = int.from_bytes(client_socket.recv(4), 'little')
-    sent_path = client_socket.recv(path_size).decode('utf-8')
-    path = os.path.join(identifier, sent_path)
-    path = path.replace("/", os.sep)
-    path = path.replace('\\', os.sep)
+def delete_command(identifier):
+    is_directory, path_size = yield from recv_struct(protocol.PATH_HEADER)
+    sent_path = yield from recv_string(path_size)
+    path = identifier_path(identifier, sent_path)
 
     # If file/directory does not exists, return with empty update packet
     if not os.path.isfile(path) and not os.path.isdir(path):
         return b''
 
     if not os.path.isdir(path):
-        os.remove(path)
+        blobs.remove(path)
     else:
         delete_recursive(path)
+    file_index.remove(identifier, path)
 
     return DELETE_COMMAND.to_bytes(1, 'little') + is_directory.to_bytes(1, 'little') + path_size.to_bytes(4, 'little') \
            + sent_path.encode('utf-8')
 
 
-def modify_command(client_socket, identifier):
-    is_directory = int.from_bytes(client_socket.recv(1), 'little')
-    path_size = int.from_bytes(client_socket.recv(4), 'little')
-    sent_path = client_socket.recv(path_size).decode('utf-8')
-    path = os.path.join(identifier, sent_path)
-    path = path.replace("/", os.sep)
-    path = path.replace('\\', os.sep)
-    file_size = int.from_bytes(client_socket.recv(4), 'little')
-    file_data = recv(client_socket, file_size)
+def modify_command(identifier, connection):
+    is_directory, path_size = yield from recv_struct(protocol.PATH_HEADER)
+    sent_path = yield from recv_string(path_size)
+    path = identifier_path(identifier, sent_path)
+    file_size = yield from recv_int(connection.size_length())
+    temp_path, content_hash = yield from recv_file(connection, file_size)
 
     os.makedirs(os.path.dirname(path), exist_ok=True)
 
     # If already exists the same file, we return with empty update packet
-    if os.path.isfile(path):
-        with open(path, 'rb') as f:
-            current_data = f.read()
-            if current_data == file_data:
-                return b''
-
-    with open(path, 'wb+') as f:
-        f.write(file_data)
-
-    return MODIFY_COMMAND.to_bytes(1, 'little') + is_directory.to_bytes(1, 'little') + path_size.to_bytes(4, 'little') \
-           + sent_path.encode('utf-8') + file_size.to_bytes(4, 'little') + file_data
-
-
-def move_command(client_socket, identifier):
-    is_directory = int.from_bytes(client_socket.recv(1), 'little')
-    src_path_size = int.from_bytes(client_socket.recv(4), 'little')
-    sent_src_path = client_socket.recv(src_path_size).decode('utf-8')
-    src_path = os.path.join(identifier, sent_src_path)
-    src_path = src_path.replace("/", os.sep)
-    src_path = src_path.replace('\\', os.sep)
-    dst_path_size = int.from_bytes(client_socket.recv(4), 'little')
-    sent_dst_path = client_socket.recv(dst_path_size).decode('utf-8')
-    dst_path = os.path.join(identifier, sent_dst_path)
-    dst_path = dst_path.replace("/", os.sep)
-    dst_path = dst_path.replace('\\', os.sep)
+    if is_same_file(identifier, path, file_size, content_hash):
+        os.remove(temp_path)
+        return b''
+
+    store_file(identifier, temp_path, content_hash, path)
+
+    # Clients with delta feature will ask for the delta of big files
+    if file_size >= DELTA_MIN_SIZE:
+        return Change(path_header(MODIFY_DELTA_COMMAND, is_directory, sent_path), content_hash)
+    return Change(MODIFY_COMMAND.to_bytes(1, 'little') + is_directory.to_bytes(1, 'little')
+                  + path_size.to_bytes(4, 'little') + sent_path.encode('utf-8'), content_hash)
+
+
+# Partial file of upload of file_size bytes with content_hash to path, each client upload of it continues there
+def partial_path(path, file_size, content_hash):
+    key = f'{path}\0{file_size}\0'.encode('utf-8') + content_hash
+    return os.path.join(PARTIAL_DIRECTORY, hashlib.sha256(key).hexdigest())
+
+
+def partial_size(partial):
+    try:
+        return os.path.getsize(partial)
+    except FileNotFoundError:
+        return 0
+
+
+# Client asks from where to continue the chunked upload of file, before it sends the chunks
+def upload_offset_command(identifier, connection):
+    _, path_size = yield from recv_struct(protocol.PATH_HEADER)
+    sent_path = yield from recv_string(path_size)
+    path = identifier_path(identifier, sent_path)
+    file_size, content_hash = yield from recv_struct(protocol.MANIFEST_FILE_HEADER)
+
+    # If we have the same file already, the client sends no chunks at all
+    if is_same_file(identifier, path, file_size, content_hash):
+        send_upload_offset(connection, sent_path, file_size, content_hash, file_size)
+        return
+    partial = partial_path(path, file_size, content_hash)
+    size = partial_size(partial)
+    if size and partial_hashes.get(partial, (None,))[0] != size:
+        # Partial file of upload from before we started, it is hashed in background thread before we answer
+        connection.send_stream(worker_stream(hashed_partial_offset(partial, sent_path, file_size, content_hash)))
+        return
+    send_upload_offset(connection, sent_path, file_size, content_hash, size)
+
+
+def upload_offset_packet(sent_path, file_size, content_hash, offset):
+    return path_header(UPLOAD_OFFSET_COMMAND, 0, sent_path) \
+           + protocol.UPLOAD_OFFSET.pack(file_size, content_hash, offset)
+
+
+def send_upload_offset(connection, sent_path, file_size, content_hash, offset):
+    connection.send(upload_offset_packet(sent_path, file_size, content_hash, offset))
+
+
+# Return generator of the upload offset packet of partial file, after its sha256 is kept for the upload
+def hashed_partial_offset(partial, sent_path, file_size, content_hash):
+    try:
+        with open(partial, 'rb') as f:
+            offset = min(os.fstat(f.fileno()).st_size, file_size)
+            partial_hashes[partial] = (offset, hash_prefix(f, offset))
+    except FileNotFoundError:
+        offset = 0
+    yield upload_offset_packet(sent_path, file_size, content_hash, offset)
+
+
+# Receive chunks of file from offset and add them to its partial file, the file is stored when all of it arrived and
+# its sha256 is the one the client promised
+def chunked_upload_command(identifier, connection):
+    _, path_size = yield from recv_struct(protocol.PATH_HEADER)
+    sent_path = yield from recv_string(path_size)
+    path = identifier_path(identifier, sent_path)
+    file_size, content_hash, offset, encoding = yield from recv_struct(protocol.CHUNKED_UPLOAD_HEADER)
+
+    partial = partial_path(path, file_size, content_hash)
+    # The partial file was checked chunk by chunk, but only sha256 of all of it tells the content is right
+    # Chunks continue it only from the end we have the sha256 of, the partial file is not read again
+    sha256 = None
+    if offset == 0:
+        sha256 = hashlib.sha256()
+    elif partial_hashes.get(partial, (None,))[0] == offset == partial_size(partial):
+        sha256 = partial_hashes[partial][1].copy()
+    # If another upload writes the partial file, or we don't have the chunks before offset, the chunks are dropped
+    f = None
+    if partial not in receiving_partials and sha256 and offset < file_size:
+        os.makedirs(PARTIAL_DIRECTORY, exist_ok=True)
+        f = open(partial, 'r+b' if offset else 'wb')
+        f.truncate(offset)
+        f.seek(offset)
+        receiving_partials.add(partial)
+    # Chunks after broken chunk are dropped too, the client sends them again
+    is_broken = False
+    written = offset
+    try:
+        received = offset
+        while True:
+            content_size, data_size, checksum = yield from recv_struct(protocol.CHUNK_HEADER)
+            if not content_size:
+                break
+            if content_size > RESUME_CHUNK_SIZE or data_size > RESUME_CHUNK_SIZE + RESUME_CHUNK_OVERHEAD \
+                    or received + content_size > file_size:
+                raise ClientDisconnectedException()
+            data = yield from recv(data_size)
+            received += content_size
+            if not f or is_broken:
+                continue
+            if zlib.crc32(data) != checksum:
+                is_broken = True
+                continue
+            if encoding != compression.ENCODING_RAW:
+                try:
+                    data = compression.decompress_chunk(data, encoding, content_size)
+                except ClientDisconnectedException:
+                    # Chunk that doesn't decompress to its content size is sent again like chunk with wrong checksum
+                    is_broken = True
+                    continue
+            elif data_size != content_size:
+                raise ClientDisconnectedException()
+            f.write(data)
+            sha256.update(data)
+            written += len(data)
+    finally:
+        # Partial file stays when the client disconnected, so its next upload continues from the chunks we got
+        if f:
+            f.close()
+            receiving_partials.discard(partial)
+            partial_hashes[partial] = (written, sha256)
+
+    if not f or received != file_size:
+        return b''
+    if is_broken:
+        # Client continues from the last chunk we could check
+        send_upload_offset(connection, sent_path, file_size, content_hash, written)
+        return b''
+    # All the file arrived, its partial file is stored or removed now
+    del partial_hashes[partial]
+    # File changed while the client sent it, the event of this change will send it again
+    if sha256.digest() != content_hash:
+        os.remove(partial)
+        return b''
+
+    if is_same_file(identifier, path, file_size, content_hash):
+        os.remove(partial)
+        return b''
+
+    # Clients with delta feature will ask for the delta of big files they have an older version of
+    is_modified = os.path.isfile(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    store_file(identifier, partial, content_hash, path)
+    if is_modified and file_size >= DELTA_MIN_SIZE:
+        return Change(path_header(MODIFY_DELTA_COMMAND, 0, sent_path), content_hash)
+    return Change(path_header(CREATE_COMMAND, 0, sent_path), content_hash)
+
+
+# Remove temp files of uploads the server stopped in the middle of, no upload runs before we start
+def remove_temp_files():
+    if not os.path.isdir(TEMP_DIRECTORY):
+        return
+    for name in os.listdir(TEMP_DIRECTORY):
+        path = os.path.join(TEMP_DIRECTORY, name)
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+# Remove partial files of uploads that no client continued for PARTIAL_MAX_AGE seconds
+def remove_stale_partials():
+    if not os.path.isdir(PARTIAL_DIRECTORY):
+        return
+    for name in os.listdir(PARTIAL_DIRECTORY):
+        partial = os.path.join(PARTIAL_DIRECTORY, name)
+        try:
+            if time.time() - os.path.getmtime(partial) > PARTIAL_MAX_AGE:
+                os.remove(partial)
+        except FileNotFoundError:
+            continue
+
+
+# Client asks for signatures of our file before sending us its delta
+def signatures_command(identifier, connection):
+    _, path_size = yield from recv_struct(protocol.PATH_HEADER)
+    sent_path = yield from recv_string(path_size)
+    path = identifier_path(identifier, sent_path)
+
+    send_signatures(connection, sent_path, path)
+
+
+# Signatures and delta are made by the read ahead thread, so big files don't stop the event loop
+def send_signatures(connection, sent_path, path):
+    connection.send(path_header(SIGNATURES_COMMAND, 0, sent_path))
+    connection.send_stream(worker_stream(delta.file_signatures(path)))
+
+
+# Return sha256 of our copy of path, a missing file is empty and a directory has no hash
+def base_content_hash(identifier, path):
+    if os.path.isdir(path):
+        return None
+    try:
+        return file_index.content_hash(identifier, path)
+    except FileNotFoundError:
+        return hashlib.sha256().digest()
+
+
+# Rebuild the file from our copy and the client delta
+def modify_delta_command(identifier, connection):
+    is_directory, path_size = yield from recv_struct(protocol.PATH_HEADER)
+    sent_path = yield from recv_string(path_size)
+    path = identifier_path(identifier, sent_path)
+    base_hash = bytes((yield from recv(delta.HASH_SIZE)))
+    block_size = yield from recv_int(4)
+
+    # If our file changed since the client got its signatures, the copy instructions are useless
+    # The hash comes from the identifier index, so the file is not read
+    is_base_valid = base_content_hash(identifier, path) == base_hash
+    base_file = open(path, 'rb') if is_base_valid and os.path.isfile(path) else None
+    out_file = None
+    if is_base_valid:
+        os.makedirs(TEMP_DIRECTORY, exist_ok=True)
+        out_file = tempfile.NamedTemporaryFile(dir=TEMP_DIRECTORY, delete=False)
+    writer = delta.HashingWriter(out_file)
+    try:
+        while True:
+            instruction = yield from recv_int(1)
+            if instruction == delta.DELTA_END:
+                break
+            if instruction == delta.DELTA_COPY:
+                start, count = yield from recv_struct(protocol.COPY_HEADER)
+                if base_file:
+                    delta.copy_blocks(base_file, writer, start, count, block_size)
+            else:
+                data_size = yield from recv_int(4)
+                while data_size > 0:
+                    data = yield from recv_some(min(data_size, RECV_SIZE))
+                    if out_file:
+                        writer.write(data)
+                    data_size -= len(data)
+    except BaseException:
+        # Client disconnected in the middle of the delta
+        if out_file:
+            out_file.close()
+            os.remove(out_file.name)
+        raise
+    finally:
+        if base_file:
+            base_file.close()
+        if out_file:
+            out_file.close()
+
+    if not is_base_valid:
+        # Send the client our current signatures, so it can build the delta again
+        if not os.path.isdir(path):
+            send_signatures(connection, sent_path, path)
+        return b''
+
+    # If the file didn't change, return with empty update packet
+    if writer.sha256.digest() == base_hash:
+        os.remove(out_file.name)
+        return b''
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    content_hash = writer.sha256.digest()
+    store_file(identifier, out_file.name, content_hash, path)
+
+    if os.path.getsize(path) >= DELTA_MIN_SIZE:
+        return Change(path_header(MODIFY_DELTA_COMMAND, is_directory, sent_path), content_hash)
+    return Change(path_header(MODIFY_COMMAND, is_directory, sent_path), content_hash)
+
+
+# Client sends signatures of its copy and we answer with the delta from it to our file
+def pull_delta_command(identifier, connection):
+    _, path_size = yield from recv_struct(protocol.PATH_HEADER)
+    sent_path = yield from recv_string(path_size)
+    path = identifier_path(identifier, sent_path)
+    block_size, count, base_size = yield from recv_struct(protocol.SIGNATURES_HEADER)
+    # Count must be the blocks of base file, otherwise the client sent garbage
+    if not 0 < block_size <= delta.MAX_LITERAL_SIZE or count != (base_size + block_size - 1) // block_size:
+        raise ClientDisconnectedException()
+    # Signatures are kept as they arrived and parsed by the read ahead thread
+    parts = []
+    index = 0
+    while index < count:
+        part = min(count - index, SIGNATURES_PART_BLOCKS)
+        data = yield from recv(part * delta.SIGNATURE_SIZE)
+        if count <= MAX_SIGNATURE_BLOCKS:
+            parts.append((index, bytes(data)))
+        index += part
+    base_hash = bytes((yield from recv(delta.HASH_SIZE)))
+
+    # If the file doesn't exist anymore we answer with status 0, the update that removed it is on its way
+    try:
+        f = open(path, 'rb') if os.path.isfile(path) else None
+    except FileNotFoundError:
+        f = None
+    if not f:
+        connection.send(path_header(PULL_DELTA_COMMAND, 0, sent_path) + int(0).to_bytes(1, 'little'))
+        return
+
+    connection.send(path_header(PULL_DELTA_COMMAND, 0, sent_path) + int(1).to_bytes(1, 'little') + base_hash)
+    connection.send_stream(worker_stream(signatures_delta(f, block_size, base_size, parts)))
+
+
+# Return generator of the delta from the client signatures parts to open file f
+def signatures_delta(f, block_size, base_size, parts):
+    table = {}
+    for first_index, data in parts:
+        delta.parse_signatures(data, table, first_index)
+    yield from delta.file_delta_instructions(f, block_size, base_size, table)
+
+
+def move_command(identifier):
+    is_directory, src_path_size = yield from recv_struct(protocol.PATH_HEADER)
+    sent_src_path = yield from recv_string(src_path_size)
+    src_path = identifier_path(identifier, sent_src_path)
+    dst_path_size = yield from recv_int(4)
+    sent_dst_path = yield from recv_string(dst_path_size)
+    dst_path = identifier_path(identifier, sent_dst_path)
 
     # If file/directory does not exists, return with empty update packet
     if not os.path.isfile(src_path) and not os.path.isdir(src_path):
@@ -194,7 +1249,8 @@ def move_command(client_socket, identifier):
 
     # Remove destination file if exists
     if not is_directory and os.path.isfile(dst_path):
-        os.remove(dst_path)
+        blobs.remove(dst_path)
+        file_index.remove(identifier, dst_path)
 
     os.makedirs(os.path.dirname(dst_path), exist_ok=True)
 
@@ -204,101 +1260,468 @@ def move_command(client_socket, identifier):
             os.rmdir(src_path)
     else:
         os.rename(src_path, dst_path)
+        file_index.move(identifier, src_path, dst_path)
 
     return MOVE_COMMAND.to_bytes(1, 'little') + is_directory.to_bytes(1, 'little') + src_path_size.to_bytes(4, 'little') \
            + sent_src_path.encode('utf-8') + dst_path_size.to_bytes(4, 'little') + sent_dst_path.encode('utf-8')
 
 
-def handle_command(identifier, command, client_socket, client_address):
+# Time of command is the time we spent on it, the waits for its bytes between the steps of its parser are not counted
+def handle_command(identifier, command, connection):
+    yield from timed('command.' + COMMAND_NAMES.get(command, 'unknown'), run_command(identifier, command, connection))
+
+
+def run_command(identifier, command, connection):
     packet = b''
     if command == CREATE_COMMAND:
-        packet = create_command(client_socket, identifier)
+        packet = yield from create_command(identifier, connection)
     elif command == DELETE_COMMAND:
-        packet = delete_command(client_socket, identifier)
+        packet = yield from delete_command(identifier)
     elif command == MODIFY_COMMAND:
-        packet = modify_command(client_socket, identifier)
+        packet = yield from modify_command(identifier, connection)
     elif command == MOVE_COMMAND:
-        packet = move_command(client_socket, identifier)
+        packet = yield from move_command(identifier)
     elif command == PULL_COMMAND:
-        send_all_directory_to_client(identifier, identifier, client_socket)
+        send_pull_packets(connection, all_directory_packets(identifier, identifier))
+        send_cursor(connection)
+    elif command == PULL_MANIFEST_COMMAND:
+        yield from pull_manifest_command(identifier, connection)
+        send_cursor(connection)
     elif command == UPDATES_COMMAND:
-        update_client(client_socket, identifier, client_address)
+        update_client(connection)
+    elif command == FEATURES_COMMAND:
+        features_command(connection)
+    elif command == ENABLE_FEATURES_COMMAND:
+        yield from enable_features_command(identifier, connection)
+    elif command == SIGNATURES_COMMAND:
+        yield from signatures_command(identifier, connection)
+    elif command == MODIFY_DELTA_COMMAND:
+        packet = yield from modify_delta_command(identifier, connection)
+    elif command == PULL_DELTA_COMMAND:
+        yield from pull_delta_command(identifier, connection)
+    elif command == RESUME_COMMAND:
+        yield from resume_command(identifier, connection)
+    elif command == STATS_COMMAND:
+        stats_command(connection)
+    elif command == UPLOAD_OFFSET_COMMAND:
+        yield from upload_offset_command(identifier, connection)
+    elif command == CHUNKED_UPLOAD_COMMAND:
+        packet = yield from chunked_upload_command(identifier, connection)
 
     if packet:
-        add_packet_to_update_dict(packet, identifier, client_address)
+        if not isinstance(packet, Change):
+            packet = Change(packet)
+        add_change(identifier, packet, connection)
 
 
-def add_client_to_file_dict(identifier, client_address):
-    if identifier not in file_changes_dict:
-        file_changes_dict[identifier] = {client_address: []}
+# Return the changes that client without features can get, the count he reads first must hold only these
+# Blob sizes are taken without opening the files, so a long queue doesn't open a file for each change at once
+def sendable_changes(connection, changes):
+    sendable = []
+    for change in changes:
+        if change.content_hash is not None:
+            try:
+                size = os.path.getsize(blobs.blob_path(change.content_hash))
+            except FileNotFoundError:
+                # The content was replaced or removed since the change, and the change that did it comes later
+                continue
+            # Client with 4 bytes sizes can't get bigger files
+            if size >= 1 << (8 * connection.size_length()):
+                continue
+        sendable.append(change)
+    return sendable
+
+
+# Return generator of the packets of counted changes, each file is opened only when its turn to be sent comes
+# Content removed after the count is sent as delete of the path, so the client still reads as many packets as we
+# counted, and he gets the new content with the change that removed it
+def counted_packets(connection, changes):
+    for change in changes:
+        try:
+            yield change_packet(connection, change)
+        except FileNotFoundError:
+            yield DELETE_COMMAND.to_bytes(1, 'little') + change.packet[1:]
+
+
+# Send all changes client didn't get yet
+def update_client(connection):
+    # Clients that negotiated features read each packet by its command, so they don't need the count
+    if connection.features is None:
+        changes = sendable_changes(connection, take_changes(connection))
+        connection.send(len(changes).to_bytes(4, 'little'))
+        connection.send_stream(counted_packets(connection, changes))
     else:
-        identifier_dict = file_changes_dict[identifier]
-        if client_address not in identifier_dict:
-            identifier_dict[client_address] = []
+        send_changes(connection)
+    change_logs[connection.identifier].truncate()
+
+
+# Reconnected client sends the cursor we sent him last time, so he gets only the changes after it
+# We answer with status 0 if we don't have all these changes anymore, and then the client has to pull again
+def resume_command(identifier, connection):
+    cursor_epoch, sequence = yield from recv_struct(protocol.CURSOR)
+    change_log = change_logs[identifier]
+    is_valid = cursor_epoch == journal.epoch and change_log.first_sequence() <= sequence <= change_log.next_sequence()
+    connection.send(RESUME_COMMAND.to_bytes(1, 'little') + int(is_valid).to_bytes(1, 'little'))
+    if not is_valid:
+        return
 
+    connection.cursor = sequence
+    if connection.has_feature(FEATURE_PUSH):
+        send_changes(connection)
+
+
+# Send client the metrics of this process as JSON, with its size (4 bytes) before it
+def stats_command(connection):
+    data = json.dumps(metrics.snapshot(server_gauges())).encode('utf-8')
+    connection.send(STATS_COMMAND.to_bytes(1, 'little') + len(data).to_bytes(4, 'little') + data)
+
+
+# Current state of this process, clients are behind by pending_changes changes they didn't get yet
+def server_gauges():
+    pending = [change_log.next_sequence() - connection.cursor for change_log in change_logs.values()
+               for connection in change_log.connections]
+    return {
+        'worker': worker_index,
+        'connections': len(connections),
+        'sessions': len(sessions),
+        'identifiers': len(change_logs),
+        'changes_in_memory': sum(len(change_log.changes) for change_log in change_logs.values()),
+        'pending_changes': sum(pending),
+        'max_pending_changes': max(pending, default=0),
+        'out_queue_items': sum(len(connection.out_queue) for connection in connections.values()),
+        'waiting_connections': len(waiting_connections),
+        **content_cache.gauges(),
+    }
+
+
+# Client asks which features we support, from now on all our messages to him start with a command
+def features_command(connection):
+    if connection.features is None:
+        connection.features = 0
+    connection.send(FEATURES_COMMAND.to_bytes(1, 'little') + SERVER_FEATURES.to_bytes(1, 'little'))
+
+
+def enable_features_command(identifier, connection):
+    features = yield from recv_int(1)
+    connection.features = features & SERVER_FEATURES
+
+    # Pushed client will not ask for updates anymore, so we send him what he missed until now
+    if connection.features & FEATURE_PUSH:
+        send_changes(connection)
+
+
+# Client authenticated the identifier with session hello, he opens new session or joins his session
+def session_command(identifier, kind, connection):
+    if kind == SESSION_JOIN:
+        handle = yield from recv_int(4)
+        session = sessions.get(handle)
+        # Client can join only session of the identifier he sent
+        if session is None or session.identifier != identifier:
+            connection.send(int(-1).to_bytes(1, 'little', signed=True))
+            return
+    else:
+        handle = random.getrandbits(32)
+        while handle in sessions:
+            handle = random.getrandbits(32)
+        session = sessions[handle] = Session(identifier, handle)
+
+    session.connections.add(connection)
+    connection.session = session
+    attach_client(connection, identifier)
+    # Like after FEATURES_COMMAND, all our messages to him start with a command
+    if connection.features is None:
+        connection.features = 0
+    connection.send(SESSION_COMMAND.to_bytes(1, 'little') + protocol.SESSION.pack(handle, SERVER_FEATURES))
+    yield from handle_requests(connection)
+
+
+def leave_session(connection):
+    session = connection.session
+    if session is None:
+        return
+    session.connections.discard(connection)
+    if not session.connections:
+        del sessions[session.handle]
+    connection.session = None
 
-# Send all update packets to client
-def update_client(client_socket, identifier, client_address):
-    packets_to_send = file_changes_dict[identifier][client_address]
-    client_socket.sendall(len(packets_to_send).to_bytes(4, 'little'))
 
-    for packet_to_send in packets_to_send:
-        client_socket.sendall(packet_to_send)
+# Parse the frames of session client, each request is handled like message of client without session and then
+# acknowledged, so the client can send many requests without waiting for each of them
+def handle_requests(connection):
+    while True:
+        size, request_id, flags = yield from recv_struct(protocol.FRAME_HEADER)
+        status = yield from handle_request(connection, RequestFrames(size, flags))
+        if status == REQUEST_FAILED:
+            metrics.count('requests.failed')
+        connection.send(ACK_COMMAND.to_bytes(1, 'little') + protocol.ACK.pack(request_id, status))
 
-    packets_to_send.clear()
 
+def request_parser(connection):
+    command = yield from recv_int(1)
+    yield from handle_command(connection.identifier, command, connection)
 
-def handle_client(client_socket, client_address):
-    is_identifier = client_socket.recv(1)
-    # If is_identifier is empty array so the client disconnected
-    if not is_identifier:
-        raise ClientDisconnectedException()
 
-    is_identifier = int.from_bytes(is_identifier, 'little')
-    # If not received identifier we generate one and send it to client, otherwise handle client command
-    if is_identifier == 0:
-        identifier = generate_identifier()
-        print(identifier)
-        os.makedirs(identifier, exist_ok=True)
-        client_socket.sendall(identifier.encode('utf-8'))
-    else:
-        identifier = client_socket.recv(128).decode('utf-8')
-        command = int.from_bytes(client_socket.recv(1), 'little')
-        # If client identify with invalid identifier we send him error code (-1)
-        if not os.path.isdir(identifier):
-            client_socket.sendall(int(-1).to_bytes(1, 'little', signed=True))
-            client_socket.close()
-            raise ClientDisconnectedException()
-        handle_command(identifier, command, client_socket, client_address)
+# Run the parser of request on the payload of its frames
+# Return REQUEST_FAILED if the parser needs more bytes than the request has, leaves some of them or finds them invalid,
+# then the rest of the request is skipped and the next request is parsed as usual
+def handle_request(connection, frames):
+    parser = request_parser(connection)
+    try:
+        needed = next(parser)
+        while True:
+            data = yield from frames.read(needed)
+            if data is None:
+                break
+            needed = parser.send(data)
+    except StopIteration:
+        if not (yield from frames.next_frame()):
+            return REQUEST_OK
+    # Invalid values the parser didn't check fail only this request
+    except (ClientDisconnectedException, OSError, ValueError):
+        pass
+    finally:
+        # Stop the parser, so file it was receiving is removed
+        parser.close()
+    yield from frames.skip()
+    return REQUEST_FAILED
+
+
+# Parse all the messages of one client, each message is handled as soon as all of its bytes arrived
+def handle_client(connection):
+    while True:
+        is_identifier = yield from recv_int(1)
+        # If not received identifier we generate one and send it to client, otherwise handle client command
+        if is_identifier == 0:
+            identifier = generate_identifier()
+            # Printed in one write, so lines of worker processes are not mixed
+            print(identifier + '\n', end='', flush=True)
+            os.makedirs(identifier, exist_ok=True)
+            connection.send(identifier.encode('utf-8'))
+            attach_client(connection, identifier)
+        else:
+            identifier, command = yield from recv_struct(protocol.IDENTIFIER_HEADER)
+            identifier = identifier.decode('utf-8', 'replace')
+            # If client identify with invalid identifier we send him error code (-1) and stop parsing his messages
+            # Identifier is letters and digits only, so it can't point to the blobs or to another directory
+            # Identifier of other worker is invalid here too, its changes are kept by the other worker
+            if not (identifier.isascii() and identifier.isalnum()) or not os.path.isdir(identifier) \
+                    or worker_of(identifier.encode('utf-8'), worker_count) != worker_index:
+                connection.send(int(-1).to_bytes(1, 'little', signed=True))
+                return
+            if is_identifier in (SESSION_OPEN, SESSION_JOIN):
+                yield from session_command(identifier, is_identifier, connection)
+                return
+            # From now on the client gets the changes of identifier
+            attach_client(connection, identifier)
+            yield from handle_command(identifier, command, connection)
+
+
+def accept_client(server):
+    try:
+        client_socket, client_address = server.accept()
+    except BlockingIOError:
+        return
+    add_client(client_socket, client_address)
 
-    # Add client to dict of update changes
-    add_client_to_file_dict(identifier, client_address)
 
+def add_client(client_socket, client_address):
+    client_socket.setblocking(False)
+    connection = ClientConnection(client_socket, client_address)
+    connections[client_address] = connection
+    selector.register(client_socket, selectors.EVENT_READ, connection)
+    metrics.count('clients.connected')
+    return connection
 
-def handle_all_clients():
-    removed_sockets = []
-    global client_sockets
-    for client_socket, client_address in client_sockets:
-        while True:
-            try:
-                handle_client(client_socket, client_address)
-            except socket.timeout:
-                break
-            except (ClientDisconnectedException, ConnectionResetError):
-                removed_sockets.append((client_socket, client_address))
-                break
 
-    # Remove all clients that disconnected
-    client_sockets = list(set(client_sockets) - set(removed_sockets))
-    for remove_socket in removed_sockets:
-        remove_client_from_dict(remove_socket[1])
+# Read all available bytes of client and pass them to his parser
+def read_from_client(connection):
+    # If we received empty data so the client disconnected, the reader raises ClientDisconnectedException
+    started = metrics.start()
+    try:
+        received = connection.reader.fill(max(connection.needed, 1))
+    except BlockingIOError:
+        return
+    metrics.observe('socket.recv', started)
+    metrics.count('socket.bytes_in', received)
+    connection.add_bytes(received)
+    parse_client(connection)
+
+
+# Pass the bytes in client reader to his parser
+def parse_client(connection):
+    reader = connection.reader
+    if connection.closing:
+        reader.take(reader.available())
+        return
+
+    while True:
+        needed = connection.needed
+        if needed < 0 and reader.available():
+            needed = min(-needed, reader.available())
+        elif needed < 0 or reader.available() < needed:
+            break
+        data = reader.take(needed)
+        try:
+            connection.needed = connection.parser.send(data)
+        except StopIteration:
+            # The parser finished, so we disconnect the client after sending him all the out queue
+            connection.closing = True
+            reader.take(reader.available())
+            if not connection.out_queue:
+                raise ClientDisconnectedException()
+            return
+
+
+# Send as many bytes as the socket can take from the out queue, up to WRITE_BUDGET bytes in one turn
+def write_to_client(connection):
+    budget = WRITE_BUDGET
+    while connection.out_queue:
+        # Client stays registered for write events, so he continues in the next turn
+        if budget <= 0:
+            return
+        data = connection.out_queue[0]
+        if isinstance(data, FileSegment):
+            started = metrics.start()
+            try:
+                sent = send_file_segment(connection.socket, data, budget)
+            except BlockingIOError:
+                return
+            metrics.observe('socket.sendfile', started)
+            metrics.count('socket.bytes_out', sent)
+            connection.add_bytes(sent)
+            budget -= sent
+            if sent == 0:
+                # The file is shorter than we promised, we fill it with zeros so the next messages stay in place
+                connection.out_queue[0] = zero_chunks(data.remaining)
+                continue
+            data.offset += sent
+            data.remaining -= sent
+            if not data.remaining:
+                connection.out_queue.popleft()
+            continue
+        if isinstance(data, ReadAhead):
+            try:
+                batch = data.queue.get_nowait()
+            except queue.Empty:
+                # We don't need write events until the read ahead thread wakes us with the next batch
+                waiting_connections.add(connection)
+                selector.modify(connection.socket, selectors.EVENT_READ, connection)
+                return
+            if batch is None:
+                # The client waits for the rest of the packets, so we can't continue without them
+                if data.error:
+                    raise ClientDisconnectedException()
+                connection.out_queue.popleft()
+            else:
+                connection.out_queue.extendleft(reversed(connection.packet_items(batch)))
+            continue
+        if not isinstance(data, memoryview):
+            # Generator of chunks, we take its next chunk and send it before the rest of the generator
+            chunk = next(data, None)
+            if chunk is None:
+                connection.out_queue.popleft()
+            else:
+                connection.out_queue.extendleft(reversed(connection.packet_items(chunk)))
+            continue
+        buffers = gather_buffers(connection, budget)
+        started = metrics.start()
+        try:
+            sent = send_buffers(connection.socket, buffers)
+        except BlockingIOError:
+            return
+        metrics.observe('socket.send', started)
+        metrics.count('socket.bytes_out', sent)
+        connection.add_bytes(sent)
+        budget -= sent
+        for data in buffers:
+            if sent < len(data):
+                connection.out_queue[0] = data[sent:]
+                return
+            sent -= len(data)
+            connection.out_queue.popleft()
+
+    # Out queue is empty, we don't need write events until next send
+    selector.modify(connection.socket, selectors.EVENT_READ, connection)
+    if connection.closing:
+        raise ClientDisconnectedException()
 
 
-def remove_client_from_dict(client_address):
-    for identifier in file_changes_dict:
-        if client_address in file_changes_dict[identifier]:
-            del file_changes_dict[identifier][client_address]
+# Return the bytes at the start of out queue that can be sent together, up to SEND_BUFFERS of them and about budget
+# bytes. Generators in the way give their next chunks, so a stream of small packets is gathered too
+def gather_buffers(connection, budget):
+    out_queue = connection.out_queue
+    buffers = []
+    size = 0
+    index = 0
+    while index < len(out_queue) and len(buffers) < SEND_BUFFERS and size < budget:
+        data = out_queue[index]
+        if isinstance(data, memoryview):
+            buffers.append(data)
+            size += len(data)
+            index += 1
+            continue
+        # File content is sent by itself, with sendfile or from the read ahead thread
+        if isinstance(data, (FileSegment, ReadAhead)):
             break
+        chunk = next(data, None)
+        if chunk is None:
+            del out_queue[index]
+            continue
+        for offset, item in enumerate(connection.packet_items(chunk)):
+            out_queue.insert(index + offset, item)
+    return buffers
+
+
+def send_buffers(client_socket, buffers):
+    # No sendmsg on this OS, so each buffer is sent by itself
+    if len(buffers) == 1 or not hasattr(client_socket, 'sendmsg'):
+        return client_socket.send(buffers[0])
+    return client_socket.sendmsg(buffers)
+
+
+# Send at most max_size bytes of segment
+def send_file_segment(client_socket, segment, max_size):
+    size = min(segment.remaining, max_size)
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(client_socket.fileno(), segment.file.fileno(), segment.offset, size)
+    # No sendfile on this OS, so we read the chunk by ourselves
+    segment.file.seek(segment.offset)
+    chunk = segment.file.read(min(size, RECV_SIZE))
+    return client_socket.send(chunk) if chunk else 0
+
+
+def zero_chunks(size):
+    while size > 0:
+        yield bytes(min(size, RECV_SIZE))
+        size -= RECV_SIZE
+
+
+# Read ahead threads have batches ready, so clients that waited for them can be written again
+def wake_waiting_connections():
+    try:
+        while wakeup_reader.recv(RECV_SIZE):
+            pass
+    except BlockingIOError:
+        pass
+    for connection in waiting_connections:
+        selector.modify(connection.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+    waiting_connections.clear()
+
+
+def disconnect_client(connection):
+    selector.unregister(connection.socket)
+    waiting_connections.discard(connection)
+    # Stop read ahead threads of the client
+    for data in connection.out_queue:
+        if isinstance(data, ReadAhead):
+            data.closed = True
+    # Stop the parser, so file it was receiving is removed
+    connection.parser.close()
+    connection.socket.close()
+    del connections[connection.address]
+    detach_client(connection)
+    leave_session(connection)
+    metrics.count('clients.disconnected')
 
 
 def check_port(n):
@@ -311,38 +1734,227 @@ def check_port(n):
         return 0
 
 
-port = sys.argv[1]
-if check_port(port) == 0:
-    exit()
+# Main process hands client to his worker with the bytes of the first message it received from him
+# Return False if the main process exited
+def receive_handoff(handoff):
+    data, fds, _, _ = socket.recv_fds(handoff, DISPATCH_PREFIX_SIZE, 1)
+    if not fds:
+        return False
+    client_socket = socket.socket(fileno=fds[0])
+    # Client could reset the connection after the main process received his first bytes
+    try:
+        connection = add_client(client_socket, client_socket.getpeername())
+    except OSError:
+        client_socket.close()
+        return True
+    connection.reader.push(data)
+    try:
+        parse_client(connection)
+    except (ClientDisconnectedException, OSError, ValueError, MemoryError):
+        disconnect_client(connection)
+    return True
+
+
+# Return generator of the ready connections that are still connected, the ones that moved fewer bytes lately first
+# After the turn took TURN_BUDGET seconds bulk clients are skipped, their sockets stay ready for the next turn
+def scheduled(ready, turn_start):
+    for connection in sorted(ready, key=ClientConnection.load):
+        if connections.get(connection.address) is not connection:
+            continue
+        if time.monotonic() - turn_start > TURN_BUDGET and connection.load() > BULK_BYTES:
+            metrics.count('clients.deferred')
+            continue
+        yield connection
 
-port = int(port)
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind(('', port))
-server.settimeout(0.2)
-server.listen()
 
-try:
+# Event loop of clients, server is the listening socket or the socket the main process hands clients with
+def serve(server, handoff=None):
     while True:
-        try:
-            # Wait for connection of new client for 0.2 seconds
-            client_socket, client_address = server.accept()
-            client_socket.settimeout(2)
-            client_sockets.append((client_socket, client_address))
-        except socket.timeout:
-            # If not accept new client, we iterate all existing clients and handle their commands
-            handle_all_clients()
-            continue
-
-        while True:
+        # Clients are written after all the reads, so the changes they get were already synced
+        readable = []
+        writable = []
+        # Wait until the server socket or any client socket is ready, so no client waits for another one
+        # With metrics dump we wake up also when the next dump is due
+        started = metrics.start()
+        ready = selector.select(metrics.timeout())
+        metrics.observe('loop.select', started)
+        started = metrics.start()
+        for key, events in ready:
+            if key.fileobj is server:
+                accept_client(server)
+                continue
+            if key.fileobj is handoff:
+                if not receive_handoff(handoff):
+                    return
+                continue
+            if key.fileobj is wakeup_reader:
+                wake_waiting_connections()
+                continue
+
+            if events & selectors.EVENT_READ:
+                readable.append(key.data)
+            if events & selectors.EVENT_WRITE:
+                writable.append(key.data)
+
+        turn_start = time.monotonic()
+        for connection in scheduled(readable, turn_start):
             try:
-                # If new client accepted, handle him until non response timeout of 2 seconds
-                handle_client(client_socket, client_address)
-            except socket.timeout:
-                break
-            except (ClientDisconnectedException, ConnectionResetError):
-                # If client disconnected we remove him for our lists
-                client_sockets.remove((client_socket, client_address))
-                remove_client_from_dict(client_address)
-                break
-except KeyboardInterrupt:
-    pass
+                read_from_client(connection)
+            # Client that sent invalid values or made us run out of memory is disconnected, the other clients go on
+            except (ClientDisconnectedException, OSError, ValueError, MemoryError):
+                # If client disconnected we remove him from our lists
+                disconnect_client(connection)
+        metrics.observe('loop.read', started)
+        # Changes of all the messages we handled are synced together, before any client gets their cursor
+        started = metrics.start()
+        journal.commit()
+        metrics.observe('journal.commit', started)
+        started = metrics.start()
+        for connection in scheduled(writable, turn_start):
+            try:
+                write_to_client(connection)
+            except (ClientDisconnectedException, OSError, ValueError, MemoryError):
+                disconnect_client(connection)
+        metrics.observe('loop.write', started)
+        metrics.dump_if_due(server_gauges, f'.{worker_index}' if worker_count > 1 else '')
+
+
+def start_event_loop():
+    wakeup_reader.setblocking(False)
+    wakeup_writer.setblocking(False)
+    selector.register(wakeup_reader, selectors.EVENT_READ)
+
+
+# Start worker process of index and return its process id and the socket we hand clients to it with
+# The worker closes the sockets of the main process it inherited
+def start_worker(server, index, count, inherited):
+    global selector, wakeup_reader, wakeup_writer, worker_index, worker_count
+    handoff, worker_handoff = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    pid = os.fork()
+    if pid:
+        worker_handoff.close()
+        return pid, handoff
+
+    # Worker process has its own event loop, the main process keeps accepting the clients
+    server.close()
+    handoff.close()
+    for inherited_socket in inherited:
+        inherited_socket.close()
+    selector.close()
+    selector = selectors.DefaultSelector()
+    wakeup_reader, wakeup_writer = socket.socketpair()
+    worker_index, worker_count = index, count
+    blobs.share()
+    start_event_loop()
+    selector.register(worker_handoff, selectors.EVENT_READ)
+    try:
+        serve(None, worker_handoff)
+    except KeyboardInterrupt:
+        pass
+    # Worker must not continue to the code of the main process
+    os._exit(0)
+
+
+# Start worker processes and return process id and handoff socket of each of them
+def start_workers(server, count):
+    workers = []
+    for index in range(count):
+        workers.append(start_worker(server, index, count, [handoff for _, handoff in workers]))
+    return workers
+
+
+# Replace worker of index that exited, its clients reconnect and are handed to the new worker
+def restart_worker(server, workers, index, inherited):
+    pid, handoff = workers[index]
+    selector.unregister(handoff)
+    handoff.close()
+    os.waitpid(pid, 0)
+    workers[index] = start_worker(server, index, len(workers), [handoff for _, handoff in workers[:index]]
+                                  + [handoff for _, handoff in workers[index + 1:]] + inherited)
+    selector.register(workers[index][1], selectors.EVENT_READ, index)
+
+
+# Read the first bytes of each client until we know his identifier, and hand him to the worker of the identifier
+# Clients that ask for a new identifier are handed to the workers in turns
+def dispatch(server, workers):
+    selector.register(server, selectors.EVENT_READ)
+    # Workers never write to their handoff socket, it is readable only when the worker exited
+    for index, (_, handoff) in enumerate(workers):
+        selector.register(handoff, selectors.EVENT_READ, index)
+    # First bytes of clients we didn't hand yet, by their socket
+    prefixes = {}
+    next_worker = 0
+    while True:
+        for key, events in selector.select():
+            if key.fileobj is server:
+                try:
+                    client_socket, _ = server.accept()
+                except BlockingIOError:
+                    continue
+                client_socket.setblocking(False)
+                prefixes[client_socket] = b''
+                selector.register(client_socket, selectors.EVENT_READ)
+                continue
+            if key.data is not None:
+                # Worker could be restarted already, when handing a client to it failed
+                if key.fileobj is workers[key.data][1]:
+                    restart_worker(server, workers, key.data, list(prefixes))
+                continue
+
+            client_socket = key.fileobj
+            try:
+                data = client_socket.recv(DISPATCH_PREFIX_SIZE - len(prefixes[client_socket]))
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b''
+            if not data:
+                selector.unregister(client_socket)
+                del prefixes[client_socket]
+                client_socket.close()
+                continue
+            prefix = prefixes[client_socket] = prefixes[client_socket] + data
+            if prefix[0] == 0:
+                worker = next_worker
+                next_worker = (next_worker + 1) % len(workers)
+            elif len(prefix) < DISPATCH_PREFIX_SIZE:
+                continue
+            else:
+                worker = worker_of(prefix[1:], len(workers))
+
+            selector.unregister(client_socket)
+            del prefixes[client_socket]
+            try:
+                socket.send_fds(workers[worker][1], [prefix], [client_socket.fileno()])
+            except OSError:
+                # Worker exited, the client connects again to its new worker
+                restart_worker(server, workers, worker, list(prefixes))
+            client_socket.close()
+
+
+if __name__ == "__main__":
+    port = sys.argv[1]
+    if check_port(port) == 0:
+        exit()
+
+    port = int(port)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('', port))
+    server.listen()
+    server.setblocking(False)
+    blobs.load()
+    journal.load()
+    remove_temp_files()
+    remove_stale_partials()
+
+    try:
+        # Workers need fork and passing sockets between processes
+        if WORKERS > 1 and hasattr(os, 'fork') and hasattr(socket, 'send_fds'):
+            dispatch(server, start_workers(server, WORKERS))
+        else:
+            start_event_loop()
+            selector.register(server, selectors.EVENT_READ)
+            serve(server)
+    except KeyboardInterrupt:
+        pass
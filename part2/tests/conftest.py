@@ -0,0 +1,113 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+PART2 = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules of part2 import each other by name, as when server.py and client.py run from their directory
+sys.path.insert(0, PART2)
+
+import protocol
+import server
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def path_message(identifier, command, is_directory, path):
+    path = path.encode('utf-8') if isinstance(path, str) else path
+    return b'\1' + identifier + bytes([command, is_directory]) + len(path).to_bytes(4, 'little') + path
+
+
+# Open session of identifier on sock, from now on each request is sent in frames and the server acknowledges it
+def open_session(sock, identifier):
+    sock.sendall(bytes([server.SESSION_OPEN]) + identifier + bytes([server.FEATURES_COMMAND]))
+    assert recv_exactly(sock, 1)[0] == server.SESSION_COMMAND
+    recv_exactly(sock, protocol.SESSION.size)
+
+
+# Send request in one frame and return the status of its acknowledgement
+def send_request(sock, request_id, payload):
+    sock.sendall(protocol.FRAME_HEADER.pack(len(payload), request_id, server.FRAME_END) + payload)
+    assert recv_exactly(sock, 1)[0] == server.ACK_COMMAND
+    acked_id, status = protocol.ACK.unpack(recv_exactly(sock, protocol.ACK.size))
+    assert acked_id == request_id
+    return status
+
+
+# Server process in its own directory, tests talk to it over sockets like the clients
+class ServerProcess:
+    def __init__(self, directory, env):
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.port = probe.getsockname()[1]
+        probe.close()
+        self.directory = directory
+        self.env = env
+        self.start()
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, os.path.join(PART2, 'server.py'), str(self.port)],
+                                        cwd=self.directory, stdout=subprocess.DEVNULL, env=dict(os.environ, **self.env))
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                self.connect().close()
+                return
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def connect(self):
+        return socket.create_connection(('127.0.0.1', self.port), timeout=10)
+
+    def new_identifier(self):
+        with self.connect() as sock:
+            sock.sendall(b'\0')
+            return recv_exactly(sock, 128)
+
+    # Server is alive if its process runs and it still answers new clients
+    def is_alive(self):
+        if self.process.poll() is not None:
+            return False
+        try:
+            self.new_identifier()
+        except OSError:
+            return False
+        return True
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait(10)
+
+    # Start the server again in its directory and port, like after a crash or an upgrade
+    def restart(self):
+        self.close()
+        self.start()
+
+
+# Return function that starts a server with the given environment, servers are stopped after the test
+@pytest.fixture
+def start_server(tmp_path):
+    servers = []
+
+    def start(**env):
+        directory = tmp_path / f'server{len(servers)}'
+        directory.mkdir()
+        servers.append(ServerProcess(directory, env))
+        return servers[-1]
+
+    yield start
+    for sync_server in servers:
+        sync_server.close()
@@ -0,0 +1,51 @@
+import hashlib
+import os
+
+import pytest
+
+import blobs
+
+
+@pytest.fixture
+def blob_store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(blobs, 'blob_inodes', {})
+    blobs.load()
+    os.makedirs('first')
+    os.makedirs('second')
+
+
+def store(path, content):
+    with open('upload', 'wb') as f:
+        f.write(content)
+    blobs.replace('upload', hashlib.sha256(content).digest(), path)
+
+
+def test_same_content_is_stored_once(blob_store):
+    store(os.path.join('first', 'file'), b'content')
+    store(os.path.join('second', 'copy'), b'content')
+    blob = blobs.blob_path(hashlib.sha256(b'content').digest())
+    assert os.path.samefile(blob, os.path.join('first', 'file'))
+    assert os.path.samefile(blob, os.path.join('second', 'copy'))
+    assert not os.path.exists('upload')
+    assert blobs.content_hash(os.path.join('second', 'copy')) == hashlib.sha256(b'content').digest()
+
+
+def test_blob_is_released_with_its_last_file(blob_store):
+    store(os.path.join('first', 'file'), b'content')
+    store(os.path.join('second', 'copy'), b'content')
+    blob = blobs.blob_path(hashlib.sha256(b'content').digest())
+    blobs.remove(os.path.join('first', 'file'))
+    assert os.path.isfile(blob)
+    # Replacing the last file with other content releases the old blob
+    store(os.path.join('second', 'copy'), b'other')
+    assert not os.path.exists(blob)
+    with open(os.path.join('second', 'copy'), 'rb') as f:
+        assert f.read() == b'other'
+
+
+def test_load_removes_blobs_without_files(blob_store):
+    store(os.path.join('first', 'file'), b'content')
+    os.remove(os.path.join('first', 'file'))
+    blobs.load()
+    assert not os.path.exists(blobs.blob_path(hashlib.sha256(b'content').digest()))
@@ -0,0 +1,26 @@
+import os
+
+import client
+import record_log
+
+
+def test_client_state_torn_tail(tmp_path, monkeypatch):
+    monkeypatch.setattr(client, 'STATE_DIRECTORY', str(tmp_path))
+    base_path = str(tmp_path / 'watched')
+    state = client.ContentIndex()
+    assert not state.load(base_path, 'abc')
+    state.put(os.path.join(base_path, 'file'), (5, -1, b'h' * 32))
+    state.add_directory(os.path.join(base_path, 'directory'))
+    state.add_directory(os.path.join(base_path, 'removed'))
+    state.remove(os.path.join(base_path, 'removed'))
+    state.set_cursor((7, 42))
+    valid_size = os.path.getsize(state.log.path)
+    with open(state.log.path, 'ab') as f:
+        f.write(record_log.path_record(client.STATE_CURSOR, '', b'\0' * 5))
+
+    state = client.ContentIndex()
+    assert state.load(base_path, 'abc')
+    assert os.path.getsize(state.log.path) == valid_size
+    assert state.get(os.path.join(base_path, 'file')) == (5, -1, b'h' * 32)
+    assert state.paths() == [os.path.join(base_path, 'file'), os.path.join(base_path, 'directory')]
+    assert state.cursor == (7, 42)
@@ -0,0 +1,79 @@
+import hashlib
+import os
+import socket
+import threading
+
+import pytest
+
+import client
+import compression
+
+
+def write_file(tmp_path, content):
+    path = str(tmp_path / 'file')
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+# Send file like push_file_to_server does, return what send_file_to_server returned and the bytes the server got
+def send_file(path):
+    sender, receiver = socket.socketpair()
+    received = bytearray()
+
+    def receive():
+        for data in iter(lambda: receiver.recv(65536), b''):
+            received.extend(data)
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    with sender:
+        sent = client.send_file_to_server(sender, b'', path)
+    thread.join()
+    receiver.close()
+    return sent, bytes(received)
+
+
+# Return the content of file message after its size, the encoding byte is sent only with compression
+def received_content(data, features):
+    size = int.from_bytes(data[:4], 'little')
+    if not features or data[4] == compression.ENCODING_RAW:
+        return data[5 if features else 4:]
+    content = bytearray()
+    decoder = compression.Decoder(data[4], size, content.extend)
+    offset = 5
+    while True:
+        frame_size = int.from_bytes(data[offset:offset + 4], 'little')
+        offset += 4
+        if not frame_size:
+            break
+        decoder.write(data[offset:offset + frame_size])
+        offset += frame_size
+    decoder.close()
+    return bytes(content)
+
+
+@pytest.mark.parametrize('features', [0, client.FEATURE_COMPRESSION])
+def test_sent_file_is_hashed_on_the_way(tmp_path, monkeypatch, features):
+    monkeypatch.setattr(client, 'server_features', features)
+    monkeypatch.setattr(client, 'content_index', client.ContentIndex())
+    content = b'content' * 100000 + os.urandom(100000)
+    path = write_file(tmp_path, content)
+    (stat, content_hash), received = send_file(path)
+    assert received_content(received, features) == content
+    assert (stat.st_size, stat.st_mtime_ns) == (os.stat(path).st_size, os.stat(path).st_mtime_ns)
+    assert content_hash == hashlib.sha256(content).digest()
+
+
+def test_indexed_file_is_sent_from_the_disk(tmp_path, monkeypatch):
+    content = os.urandom(100000)
+    path = write_file(tmp_path, content)
+    index = client.ContentIndex()
+    index.set(path, os.stat(path), hashlib.sha256(content).digest())
+    monkeypatch.setattr(client, 'server_features', 0)
+    monkeypatch.setattr(client, 'content_index', index)
+    # File that the index knows is not read by us at all
+    monkeypatch.setattr(compression, 'read_at', None)
+    (_, content_hash), received = send_file(path)
+    assert received_content(received, 0) == content
+    assert content_hash == hashlib.sha256(content).digest()
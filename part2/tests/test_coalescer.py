@@ -0,0 +1,90 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+import client
+
+
+# Coalescer that sends nothing until it is stopped, and the messages it sent then
+@pytest.fixture
+def coalescer(tmp_path, monkeypatch):
+    monkeypatch.setattr(client, 'COALESCE_WINDOW', 60)
+    monkeypatch.setattr(client, 'COALESCE_MAX_DELAY', 60)
+    monkeypatch.setattr(client, 'content_index', client.ContentIndex())
+    sent = []
+    for name in ['create', 'delete', 'modify', 'move']:
+        monkeypatch.setattr(client, f'send_{name}_message',
+                            lambda *args, name=name: sent.append((name,) + tuple(args[3:])))
+    event_coalescer = client.EventCoalescer(str(tmp_path), None, b'identifier')
+    event_coalescer.sent = sent
+    yield event_coalescer
+    event_coalescer.stop()
+
+
+def test_modifies_are_one_change(coalescer, tmp_path):
+    path = str(tmp_path / 'file')
+    coalescer.created(path)
+    for _ in range(10):
+        coalescer.modified(path)
+    coalescer.stop()
+    assert coalescer.sent == [('create', path, False)]
+
+
+def test_create_and_delete_of_new_file_is_nothing(coalescer, tmp_path):
+    path = str(tmp_path / 'file')
+    coalescer.created(path)
+    coalescer.modified(path)
+    coalescer.deleted(path, False)
+    coalescer.stop()
+    assert coalescer.sent == []
+
+
+def test_delete_of_known_file_is_sent(coalescer, tmp_path):
+    path = str(tmp_path / 'file')
+    client.content_index.set(path, os.stat(tmp_path), b'h' * 32)
+    coalescer.modified(path)
+    coalescer.deleted(path, False)
+    coalescer.stop()
+    assert coalescer.sent == [('delete', path, False)]
+
+
+def test_deletes_under_deleted_directory_are_merged(coalescer, tmp_path):
+    directory = str(tmp_path / 'directory')
+    coalescer.deleted(os.path.join(directory, 'a'), False)
+    coalescer.deleted(directory, True)
+    coalescer.deleted(os.path.join(directory, 'b'), False)
+    coalescer.stop()
+    assert coalescer.sent == [('delete', directory, True)]
+
+
+def test_pending_changes_move_with_their_paths(coalescer, tmp_path):
+    src = str(tmp_path / 'src')
+    dest = str(tmp_path / 'dest')
+    os.mkdir(dest)
+    coalescer.created(os.path.join(src, 'file'))
+    coalescer.modified(str(tmp_path / 'other'))
+    (tmp_path / 'other').write_bytes(b'other')
+    coalescer.moved(src, dest, True)
+    # Changes before the move are sent first, the pending create is sent under its new path
+    assert coalescer.sent == [('modify', str(tmp_path / 'other'), False), ('move', src, dest, True)]
+    coalescer.stop()
+    assert coalescer.sent[2:] == [('create', os.path.join(dest, 'file'), False)]
+
+
+def test_deleted_and_created_with_same_content_is_move(coalescer, tmp_path, monkeypatch):
+    # Create is sent when it stops changing, the delete waits for RENAME_WINDOW
+    monkeypatch.setattr(client, 'COALESCE_WINDOW', 0.05)
+    monkeypatch.setattr(client, 'RENAME_WINDOW', 60)
+    old_path = str(tmp_path / 'old')
+    new_path = tmp_path / 'new'
+    new_path.write_bytes(b'content')
+    client.content_index.set(old_path, os.stat(new_path), hashlib.sha256(b'content').digest())
+    coalescer.deleted(old_path, False)
+    coalescer.created(str(new_path))
+    deadline = time.monotonic() + 10
+    while not coalescer.sent:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert coalescer.sent == [('move', old_path, str(new_path), False)]
@@ -0,0 +1,48 @@
+import lzma
+import zlib
+
+import pytest
+
+import compression
+from protocol import ClientDisconnectedException
+
+
+def decode(encoding, size, frames):
+    content = bytearray()
+    decoder = compression.Decoder(encoding, size, content.extend)
+    for data in frames:
+        decoder.write(data)
+    decoder.close()
+    return bytes(content)
+
+
+@pytest.mark.parametrize('encoding', [compression.ENCODING_ZLIB, compression.ENCODING_LZMA])
+def test_decoder_round_trip(encoding):
+    content = b'content ' * 100000
+    data = compression.compress_chunk(content, encoding)
+    assert decode(encoding, len(content), [data[i:i + 1000] for i in range(0, len(data), 1000)]) == content
+
+
+@pytest.mark.parametrize('encoding', [compression.ENCODING_ZLIB, compression.ENCODING_LZMA])
+def test_decoder_rejects_corrupt_data(encoding):
+    with pytest.raises(ClientDisconnectedException):
+        decode(encoding, 10, [b'\xff' * 64])
+
+
+def test_decoder_rejects_truncated_data():
+    data = zlib.compress(b'content' * 1000)
+    with pytest.raises(ClientDisconnectedException):
+        decode(compression.ENCODING_ZLIB, 7000, [data[:len(data) // 2]])
+
+
+@pytest.mark.parametrize('encoding', [compression.ENCODING_ZLIB, compression.ENCODING_LZMA])
+def test_decoder_rejects_more_than_promised(encoding):
+    data = compression.compress_chunk(bytes(10 * compression.CHUNK_SIZE), encoding)
+    with pytest.raises(ClientDisconnectedException):
+        decode(encoding, compression.CHUNK_SIZE, [data])
+
+
+def test_decompress_chunk_rejects_corrupt_chunk():
+    data = lzma.compress(b'content')
+    with pytest.raises(ClientDisconnectedException):
+        compression.decompress_chunk(data[:-4] + b'\0\0\0\0', compression.ENCODING_LZMA, 7)
@@ -0,0 +1,94 @@
+import io
+import os
+import random
+
+import delta
+import protocol
+
+
+def signatures_table(path):
+    data = b''.join(delta.file_signatures(path))
+    block_size, count, base_size = protocol.SIGNATURES_HEADER.unpack(data[:protocol.SIGNATURES_HEADER.size])
+    signatures = data[protocol.SIGNATURES_HEADER.size:-delta.HASH_SIZE]
+    assert len(signatures) == count * delta.SIGNATURE_SIZE
+    assert data[-delta.HASH_SIZE:] == delta.file_hash(path)
+    return block_size, base_size, delta.parse_signatures(signatures)
+
+
+# Rebuild the file from base like the client does, return its content and the instructions by type
+def apply_delta(base_path, instructions, block_size):
+    data = io.BytesIO(b''.join(instructions))
+    out = io.BytesIO()
+    counts = {delta.DELTA_COPY: 0, delta.DELTA_DATA: 0}
+    with open(base_path, 'rb') as base_file:
+        while True:
+            instruction = data.read(1)[0]
+            if instruction == delta.DELTA_END:
+                break
+            counts[instruction] += 1
+            if instruction == delta.DELTA_COPY:
+                start, count = protocol.COPY_HEADER.unpack(data.read(protocol.COPY_HEADER.size))
+                delta.copy_blocks(base_file, out, start, count, block_size)
+            else:
+                out.write(data.read(int.from_bytes(data.read(4), 'little')))
+    assert not data.read()
+    return out.getvalue(), counts
+
+
+def round_trip(tmp_path, base, new):
+    base_path = tmp_path / 'base'
+    new_path = tmp_path / 'new'
+    base_path.write_bytes(base)
+    new_path.write_bytes(new)
+    block_size, base_size, table = signatures_table(base_path)
+    content, counts = apply_delta(base_path, delta.delta_instructions(new_path, block_size, base_size, table),
+                                  block_size)
+    assert content == new
+    return counts
+
+
+def test_same_file_is_only_copied(tmp_path):
+    base = os.urandom(10 * delta.BLOCK_SIZE + 123)
+    assert round_trip(tmp_path, base, base) == {delta.DELTA_COPY: 1, delta.DELTA_DATA: 0}
+
+
+def test_append_and_insert(tmp_path):
+    base = os.urandom(50 * delta.BLOCK_SIZE)
+    assert round_trip(tmp_path, base, base + b'appended')[delta.DELTA_DATA] == 1
+    counts = round_trip(tmp_path, base, base[:1000] + b'inserted' + base[1000:])
+    assert counts[delta.DELTA_COPY] == 1 and counts[delta.DELTA_DATA] == 1
+
+
+def test_random_edits(tmp_path):
+    rng = random.Random(1)
+    for _ in range(20):
+        base = bytearray(rng.randbytes(rng.randint(0, 40 * delta.BLOCK_SIZE)))
+        new = bytearray(base)
+        for _ in range(rng.randint(0, 4)):
+            position = rng.randint(0, len(new))
+            new[position:position + rng.randint(0, 3000)] = rng.randbytes(rng.randint(0, 3000))
+        round_trip(tmp_path, bytes(base), bytes(new))
+
+
+def test_empty_and_missing_base(tmp_path):
+    new = os.urandom(3 * delta.BLOCK_SIZE)
+    assert round_trip(tmp_path, b'', new) == {delta.DELTA_COPY: 0, delta.DELTA_DATA: 1}
+    signatures = b''.join(delta.file_signatures(tmp_path / 'missing'))
+    assert signatures == protocol.SIGNATURES_HEADER.pack(delta.BLOCK_SIZE, 0, 0) + delta.file_hash(tmp_path / 'missing')
+
+
+def test_rewritten_file_falls_back_to_literals(tmp_path):
+    size = delta.MISS_CHECK_SIZE * 4
+    counts = round_trip(tmp_path, os.urandom(size), os.urandom(size))
+    assert counts[delta.DELTA_COPY] == 0
+
+
+def test_signatures_parsed_in_parts(tmp_path):
+    path = tmp_path / 'base'
+    path.write_bytes(os.urandom(20 * delta.BLOCK_SIZE))
+    _, _, table = signatures_table(path)
+    data = b''.join(delta.file_signatures(path))[protocol.SIGNATURES_HEADER.size:-delta.HASH_SIZE]
+    split = 7 * delta.SIGNATURE_SIZE
+    parts = delta.parse_signatures(data[:split])
+    delta.parse_signatures(data[split:], parts, 7)
+    assert parts == table
@@ -0,0 +1,28 @@
+import os
+
+import file_index
+import record_log
+
+
+def test_file_index_torn_tail_and_compact(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    index = file_index.FileIndex('abc')
+    for size in range(record_log.COMPACT_MIN_RECORDS * 3):
+        index.set(f'f{size % 10}', (size, size * 1000, b'h' * 32))
+        index.flush()
+    index.remove('f3')
+    index.flush()
+    # Compacted, so the file has a few records for each path and not all the writes
+    assert index.log.records < record_log.COMPACT_MIN_RECORDS * 2
+    index.close()
+    path = index.log.path
+    valid_size = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(record_log.path_record(file_index.RECORD_SET, 'torn', b'\1\2'))
+
+    index = file_index.FileIndex('abc')
+    assert os.path.getsize(path) == valid_size
+    assert sorted(index.entries) == [f'f{i}' for i in range(10) if i != 3]
+    last = record_log.COMPACT_MIN_RECORDS * 3 - 1
+    assert index.entries[f'f{last % 10}'] == (last, last * 1000, b'h' * 32)
+    index.close()
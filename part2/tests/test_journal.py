@@ -0,0 +1,24 @@
+import os
+
+import journal
+
+
+def test_journal_torn_tail_is_removed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    changes = journal.Journal('abc')
+    changes.append(b'create', b'h' * journal.HASH_SIZE)
+    changes.append(b'delete')
+    changes.close()
+    segment = changes.segment_path(0)
+    valid_size = os.path.getsize(segment)
+    # Server stopped in the middle of the third change
+    with open(segment, 'ab') as f:
+        f.write((6).to_bytes(4, 'little') + b'mov')
+
+    changes = journal.Journal('abc')
+    assert changes.next_sequence == 2
+    assert os.path.getsize(segment) == valid_size
+    changes.append(b'modify', b'm' * journal.HASH_SIZE)
+    assert changes.read(0, 3) == [(b'create', b'h' * journal.HASH_SIZE), (b'delete', None),
+                                  (b'modify', b'm' * journal.HASH_SIZE)]
+    changes.close()
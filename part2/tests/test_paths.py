@@ -0,0 +1,41 @@
+import hashlib
+import os
+
+import pytest
+
+import server
+from conftest import path_message, recv_exactly
+from protocol import ClientDisconnectedException
+
+
+def test_sent_paths_stay_in_identifier():
+    assert server.identifier_path('abc', 'dir/file') == os.path.join('abc', 'dir', 'file')
+    assert server.identifier_path('abc', 'dir\\sub\\file') == os.path.join('abc', 'dir', 'sub', 'file')
+    assert server.identifier_path('abc', './dir//file') == os.path.join('abc', 'dir', 'file')
+    for sent_path in ['', '.', '..', '../blobs/ab/abcd', 'dir/../../other', 'dir\\..\\..\\other', '/etc/passwd',
+                      '\\etc', 'a\0b']:
+        with pytest.raises(ClientDisconnectedException):
+            server.identifier_path('abc', sent_path)
+
+
+def create_message(identifier, path, data):
+    return path_message(identifier, server.CREATE_COMMAND, 0, path) + len(data).to_bytes(4, 'little') + data
+
+
+def test_path_out_of_identifier_cant_poison_blob(start_server):
+    sync_server = start_server()
+    attacker = sync_server.new_identifier()
+    victim = sync_server.new_identifier()
+    content = b'real content'
+    name = hashlib.sha256(content).hexdigest()
+    with sync_server.connect() as sock:
+        sock.sendall(create_message(attacker, f'../blobs/{name[:2]}/{name}', b'EVIL'))
+        # Server closes the connection of the client that sent the path
+        assert sock.recv(1) == b''
+    assert sync_server.is_alive()
+
+    with sync_server.connect() as sock:
+        sock.sendall(create_message(victim, 'file', content) + b'\1' + victim + bytes([server.UPDATES_COMMAND]))
+        recv_exactly(sock, 4)
+    with open(os.path.join(sync_server.directory, victim.decode(), 'file'), 'rb') as f:
+        assert f.read() == content
@@ -0,0 +1,65 @@
+import pytest
+
+import protocol
+
+
+# Socket that gives the chunks, one chunk or its part for each recv_into
+class ChunksSocket:
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        size = min(len(chunk), len(view))
+        view[:size] = chunk[:size]
+        if size < len(chunk):
+            self.chunks.insert(0, chunk[size:])
+        return size
+
+
+def test_read_across_chunks():
+    reader = protocol.FrameReader(ChunksSocket(b'\x05\x00', b'\x00\x00hel', b'lo'), 16)
+    assert reader.read_int(4) == 5
+    assert reader.read_string(5) == 'hello'
+
+
+def test_unread_bytes_are_moved_to_buffer_start():
+    reader = protocol.FrameReader(ChunksSocket(b'a' * 12, b'bcdefghi'), 16)
+    assert bytes(reader.read(10)) == b'a' * 10
+    # 8 bytes from the 2 unread ones at offset 10 don't fit in the buffer
+    assert bytes(reader.read(8)) == b'aabcdefg'
+    assert len(reader.buffer) == 16
+    assert reader.start == 8 and reader.end == 10
+    assert bytes(reader.read(2)) == b'hi'
+
+
+def test_buffer_grows_for_big_read_and_shrinks_after_it():
+    data = bytes(range(100))
+    reader = protocol.FrameReader(ChunksSocket(data[:10], data[10:], b'xy'), 16)
+    assert bytes(reader.read(100)) == data
+    assert len(reader.buffer) >= 100
+    assert bytes(reader.read(2)) == b'xy'
+    assert len(reader.buffer) == 16
+
+
+def test_pushed_bytes_are_read_first():
+    reader = protocol.FrameReader(ChunksSocket(b'socket'), 8)
+    reader.push(b'pushed bytes')
+    assert bytes(reader.read(12)) == b'pushed bytes'
+    assert bytes(reader.read(6)) == b'socket'
+
+
+def test_read_to_passes_chunks():
+    reader = protocol.FrameReader(ChunksSocket(b'x' * 40, b'rest'), 16)
+    chunks = []
+    reader.read_to(lambda chunk: chunks.append(bytes(chunk)), 40)
+    assert b''.join(chunks) == b'x' * 40 and all(len(chunk) <= 16 for chunk in chunks)
+    assert bytes(reader.read(4)) == b'rest'
+
+
+def test_closed_socket_raises():
+    reader = protocol.FrameReader(ChunksSocket(b'ab'), 16)
+    with pytest.raises(protocol.ClientDisconnectedException):
+        reader.read(3)
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import time
+import zlib
+
+import compression
+import delta
+import protocol
+import server
+from conftest import open_session, path_message, recv_exactly, send_request
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + 10
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def path_payload(command, is_directory, path):
+    return bytes([command, is_directory]) + len(path).to_bytes(4, 'little') + path
+
+
+def test_malformed_request_fails_only_itself(start_server):
+    sync_server = start_server()
+    identifier = sync_server.new_identifier()
+    with sync_server.connect() as sock:
+        open_session(sock, identifier)
+        assert send_request(sock, 1, path_payload(server.CREATE_COMMAND, 1, b'\xff\xfe')) == server.REQUEST_FAILED
+        assert send_request(sock, 2, path_payload(server.CREATE_COMMAND, 1, b'a\0b')) == server.REQUEST_FAILED
+        # Request with more payload than the command reads is skipped whole
+        assert send_request(sock, 3, path_payload(server.DELETE_COMMAND, 0, b'gone') + b'extra') \
+               == server.REQUEST_FAILED
+        assert send_request(sock, 4, path_payload(server.CREATE_COMMAND, 1, b'directory')) == server.REQUEST_OK
+    assert (sync_server.directory / identifier.decode() / 'directory').is_dir()
+    assert sync_server.is_alive()
+
+
+def test_malformed_message_disconnects_only_its_client(start_server):
+    sync_server = start_server()
+    identifier = sync_server.new_identifier()
+    for path in [b'\xff\xfe', b'a\0b']:
+        with sync_server.connect() as sock:
+            sock.sendall(path_message(identifier, server.CREATE_COMMAND, 1, path))
+            assert sock.recv(1) == b''
+    with sync_server.connect() as sock:
+        sock.sendall(b'\1' + identifier + bytes([server.UPDATES_COMMAND]))
+        assert recv_exactly(sock, 4) == bytes(4)
+    assert sync_server.is_alive()
+
+
+def test_corrupt_compressed_file_fails_only_its_request(start_server):
+    sync_server = start_server()
+    identifier = sync_server.new_identifier()
+    with sync_server.connect() as sock:
+        open_session(sock, identifier)
+        features = bytes([server.ENABLE_FEATURES_COMMAND, server.FEATURE_COMPRESSION])
+        assert send_request(sock, 1, features) == server.REQUEST_OK
+        corrupt = (1000).to_bytes(4, 'little') + bytes([compression.ENCODING_ZLIB]) \
+            + compression.frame(b'\xff' * 64) + compression.frame(b'')
+        assert send_request(sock, 2, path_payload(server.CREATE_COMMAND, 0, b'file') + corrupt) \
+               == server.REQUEST_FAILED
+        content = b'content' * 1000
+        valid = len(content).to_bytes(4, 'little') + bytes([compression.ENCODING_ZLIB]) \
+            + compression.compress_data(content, compression.ENCODING_ZLIB)
+        assert send_request(sock, 3, path_payload(server.CREATE_COMMAND, 0, b'file') + valid) == server.REQUEST_OK
+    assert (sync_server.directory / identifier.decode() / 'file').read_bytes() == content
+    assert sync_server.is_alive()
+
+
+def test_corrupt_compressed_chunk_is_sent_again(start_server):
+    sync_server = start_server()
+    identifier = sync_server.new_identifier()
+    content = b'content' * 1000
+    content_hash = hashlib.sha256(content).digest()
+    data = b'\xff' * 64
+    chunk = protocol.CHUNK_HEADER.pack(len(content), len(data), zlib.crc32(data)) + data
+    with sync_server.connect() as sock:
+        sock.sendall(b'\1' + identifier + path_payload(server.CHUNKED_UPLOAD_COMMAND, 0, b'file')
+                     + protocol.CHUNKED_UPLOAD_HEADER.pack(len(content), content_hash, 0, compression.ENCODING_ZLIB)
+                     + chunk + protocol.CHUNK_HEADER.pack(0, 0, 0))
+        # Client is told to continue from the start of the file
+        assert recv_exactly(sock, 1)[0] == server.UPLOAD_OFFSET_COMMAND
+        is_directory, path_size = protocol.PATH_HEADER.unpack(recv_exactly(sock, protocol.PATH_HEADER.size))
+        assert recv_exactly(sock, path_size) == b'file'
+        assert protocol.UPLOAD_OFFSET.unpack(recv_exactly(sock, protocol.UPLOAD_OFFSET.size)) \
+               == (len(content), content_hash, 0)
+    assert sync_server.is_alive()
+
+
+def temp_files(sync_server):
+    temp_directory = sync_server.directory / server.TEMP_DIRECTORY
+    return [path for path in temp_directory.iterdir() if path.is_file()] if temp_directory.is_dir() else []
+
+
+def test_interrupted_delta_leaves_no_temp_file(start_server):
+    sync_server = start_server()
+    identifier = sync_server.new_identifier()
+    content = b'content' * 1000
+    with sync_server.connect() as sock:
+        sock.sendall(path_message(identifier, server.CREATE_COMMAND, 0, 'file') + len(content).to_bytes(4, 'little')
+                     + content)
+        sock.sendall(b'\1' + identifier + bytes([server.UPDATES_COMMAND]))
+        recv_exactly(sock, 4)
+    with sync_server.connect() as sock:
+        sock.sendall(path_message(identifier, server.MODIFY_DELTA_COMMAND, 0, 'file')
+                     + hashlib.sha256(content).digest() + (4096).to_bytes(4, 'little')
+                     + bytes([delta.DELTA_DATA]) + (1000).to_bytes(4, 'little') + b'partial')
+        time.sleep(0.2)
+        assert temp_files(sync_server)
+    wait_until(lambda: not temp_files(sync_server))
+    assert sync_server.is_alive()
+
+
+def test_temp_files_are_removed_at_start(start_server):
+    sync_server = start_server()
+    (sync_server.directory / server.TEMP_DIRECTORY).mkdir(exist_ok=True)
+    (sync_server.directory / server.TEMP_DIRECTORY / 'stale').write_bytes(b'stale')
+    sync_server.restart()
+    assert not temp_files(sync_server)
+
+
+def upload_offset(sock, identifier, path, content):
+    sock.sendall(path_message(identifier, server.UPLOAD_OFFSET_COMMAND, 0, path)
+                 + protocol.MANIFEST_FILE_HEADER.pack(len(content), hashlib.sha256(content).digest()))
+    assert recv_exactly(sock, 1)[0] == server.UPLOAD_OFFSET_COMMAND
+    _, path_size = protocol.PATH_HEADER.unpack(recv_exactly(sock, protocol.PATH_HEADER.size))
+    recv_exactly(sock, path_size)
+    return protocol.UPLOAD_OFFSET.unpack(recv_exactly(sock, protocol.UPLOAD_OFFSET.size))[2]
+
+
+def send_chunks(sock, identifier, path, content, offset, end):
+    chunks = b''
+    for start in range(offset, end, server.RESUME_CHUNK_SIZE):
+        data = content[start:start + server.RESUME_CHUNK_SIZE]
+        chunks += protocol.CHUNK_HEADER.pack(len(data), len(data), zlib.crc32(data)) + data
+    if end == len(content):
+        chunks += protocol.CHUNK_HEADER.pack(0, 0, 0)
+    sock.sendall(path_message(identifier, server.CHUNKED_UPLOAD_COMMAND, 0, path)
+                 + protocol.CHUNKED_UPLOAD_HEADER.pack(len(content), hashlib.sha256(content).digest(), offset,
+                                                       compression.ENCODING_RAW) + chunks)
+
+
+def partial_sizes(sync_server):
+    partial_directory = sync_server.directory / server.PARTIAL_DIRECTORY
+    return [path.stat().st_size for path in partial_directory.iterdir()] if partial_directory.is_dir() else []
+
+
+def test_upload_continues_after_cut_and_restart(start_server):
+    sync_server = start_server()
+    identifier = sync_server.new_identifier()
+    content = os.urandom(3 * server.RESUME_CHUNK_SIZE + 100)
+    with sync_server.connect() as sock:
+        assert upload_offset(sock, identifier, 'file', content) == 0
+        send_chunks(sock, identifier, 'file', content, 0, server.RESUME_CHUNK_SIZE)
+        wait_until(lambda: partial_sizes(sync_server) == [server.RESUME_CHUNK_SIZE])
+    with sync_server.connect() as sock:
+        # The partial file is continued with the sha256 the server kept
+        assert upload_offset(sock, identifier, 'file', content) == server.RESUME_CHUNK_SIZE
+        send_chunks(sock, identifier, 'file', content, server.RESUME_CHUNK_SIZE, 2 * server.RESUME_CHUNK_SIZE)
+        wait_until(lambda: partial_sizes(sync_server) == [2 * server.RESUME_CHUNK_SIZE])
+    sync_server.restart()
+    with sync_server.connect() as sock:
+        # After restart the partial file is hashed again before the server answers
+        assert upload_offset(sock, identifier, 'file', content) == 2 * server.RESUME_CHUNK_SIZE
+        send_chunks(sock, identifier, 'file', content, 2 * server.RESUME_CHUNK_SIZE, len(content))
+        sock.sendall(b'\1' + identifier + bytes([server.UPDATES_COMMAND]))
+        recv_exactly(sock, 4)
+    assert (sync_server.directory / identifier.decode() / 'file').read_bytes() == content
+
+
+def server_metrics(sock, identifier):
+    sock.sendall(b'\1' + identifier + bytes([server.STATS_COMMAND]))
+    assert recv_exactly(sock, 1)[0] == server.STATS_COMMAND
+    return json.loads(recv_exactly(sock, int.from_bytes(recv_exactly(sock, 4), 'little')))
+
+
+def test_command_time_is_without_waits_for_the_client(start_server):
+    sync_server = start_server(SYNC_METRICS='1')
+    identifier = sync_server.new_identifier()
+    content = b'content' * 1000
+    with sync_server.connect() as sock:
+        sock.sendall(path_message(identifier, server.CREATE_COMMAND, 0, 'file') + len(content).to_bytes(4, 'little'))
+        time.sleep(0.5)
+        sock.sendall(content)
+        wait_until(lambda: (sync_server.directory / identifier.decode() / 'file').is_file())
+    with sync_server.connect() as sock:
+        sock.sendall(b'\1' + identifier + bytes([server.PULL_COMMAND]))
+        # Pull of the file is made by read ahead thread
+        with sync_server.connect() as stats_sock:
+            wait_until(lambda: 'read_ahead.batch' in server_metrics(stats_sock, identifier)['latency'])
+            latency = server_metrics(stats_sock, identifier)['latency']
+    assert latency['command.create']['count'] == 1
+    assert latency['command.create']['max_seconds'] < 0.25
@@ -0,0 +1,58 @@
+import os
+import signal
+import socket
+import struct
+import time
+
+import pytest
+
+import server
+from conftest import recv_exactly
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'send_fds') or not os.path.isdir('/proc'),
+                                reason='workers need fork and passing sockets between processes')
+
+
+def worker_pids(sync_server):
+    pid = sync_server.process.pid
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + 10
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+# New identifiers are handed to the workers in turns, so both workers answer
+def both_workers_answer(sync_server):
+    return all(len(sync_server.new_identifier()) == 128 for _ in range(2))
+
+
+def test_client_reset_after_prefix_keeps_workers(start_server):
+    sync_server = start_server(SYNC_WORKERS='2')
+    identifier = sync_server.new_identifier()
+    for _ in range(4):
+        sock = sync_server.connect()
+        sock.sendall(b'\1' + identifier)
+        # Close with RST, the worker gets the socket after the client is gone
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        sock.close()
+    time.sleep(0.2)
+    assert both_workers_answer(sync_server)
+    with sync_server.connect() as sock:
+        sock.sendall(b'\1' + identifier + bytes([server.UPDATES_COMMAND]))
+        assert recv_exactly(sock, 4) == bytes(4)
+
+
+def test_exited_worker_is_restarted(start_server):
+    sync_server = start_server(SYNC_WORKERS='2')
+    # Server listens before it starts the workers
+    wait_until(lambda: len(worker_pids(sync_server)) == 2)
+    pids = worker_pids(sync_server)
+    os.kill(pids[0], signal.SIGKILL)
+    wait_until(lambda: pids[0] not in worker_pids(sync_server) and len(worker_pids(sync_server)) == 2)
+    assert both_workers_answer(sync_server)
+    assert sync_server.process.poll() is None